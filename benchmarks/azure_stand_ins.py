@@ -0,0 +1,352 @@
+import re
+import json
+import time
+import uuid
+import base64
+import random
+import threading
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+#text returned by the OCR stand-in, long enough to look like a one-page CV
+SYNTHETIC_CV_TEXT = "\n".join([
+    "Jane Doe",
+    "Senior Software Engineer",
+    "jane.doe@example.com | +27 82 000 0000 | Cape Town",
+    "Experience",
+    "2019 - present  Example Corp  Senior Software Engineer",
+    "Built document processing pipelines in Python on Azure.",
+    "2015 - 2019  Sample Ltd  Software Engineer",
+    "Maintained REST services and data integrations.",
+    "Education",
+    "2011 - 2014  BSc Computer Science, University of Somewhere",
+    "Skills",
+    "Python, Azure, SQL, Docker, Kubernetes",
+] * 3)
+
+#JSON object returned by the Azure OpenAI stand-in
+SYNTHETIC_CV_DETAILS = {
+    "name": "Jane Doe",
+    "email": "jane.doe@example.com",
+    "skills": ["Python", "Azure", "SQL", "Docker", "Kubernetes"],
+    "experience": [{"company": "Example Corp", "title": "Senior Software Engineer", "start": "2019"}],
+}
+
+
+class AzureStandInServer:
+    def __init__(self, latency_seconds=0.05, latency_jitter=0.5, error_rate_429=0.0, error_rate_5xx=0.0,
+                 ocr_running_seconds=1.0, retry_after_seconds=1, batch_running_seconds=2.0, failed_batch_requests=None,
+                 missing_batch_requests=None, batch_final_status="completed", host="127.0.0.1", port=0):
+        """
+        Local HTTP stand-in for the Azure endpoints the pipeline calls: the AAD token endpoint, Blob Storage
+        (single PUT, Put Block, Put Block List and user delegation key), Document Intelligence analyze,
+        Azure OpenAI chat completions and the Azure OpenAI Batch API (files and batches). All of them are
+        served from one port.
+
+        :param latency_seconds: Base latency added to every request.
+        :param latency_jitter: Fraction of the latency that is randomised.
+        :param error_rate_429: Fraction of requests answered with 429 and a Retry-After header.
+        :param error_rate_5xx: Fraction of requests answered with 503.
+        :param ocr_running_seconds: How long an OCR operation reports "running" before it succeeds.
+        :param retry_after_seconds: Retry-After value sent with 202 and 429 responses.
+        :param batch_running_seconds: How long a Batch API job reports "in_progress" before it completes.
+        :param failed_batch_requests: custom_ids of batch requests that fail. They are written to the error file.
+        :param missing_batch_requests: custom_ids of batch requests that are left out of both output files.
+        :param batch_final_status: Status a Batch API job ends with, e.g. "expired" for a job that only ran part of its requests.
+        """
+        self.latency_seconds = latency_seconds
+        self.latency_jitter = latency_jitter
+        self.error_rate_429 = error_rate_429
+        self.error_rate_5xx = error_rate_5xx
+        self.ocr_running_seconds = ocr_running_seconds
+        self.retry_after_seconds = retry_after_seconds
+        self.batch_running_seconds = batch_running_seconds
+        self.failed_batch_requests = set(failed_batch_requests or [])
+        self.missing_batch_requests = set(missing_batch_requests or [])
+        self.batch_final_status = batch_final_status
+        self.request_counts = Counter()
+        self.first_request_time = None
+        self.operations = {}
+        self.files = {}
+        self.batches = {}
+        self.lock = threading.Lock()
+
+        self.server = ThreadingHTTPServer((host, port), self._build_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    #environment variables that point the Application at this stand-in
+    def environment(self):
+        return {
+            "AZURE_VISION_ENDPOINT": self.base_url,
+            "AZURE_VISION_KEY": "stand-in",
+            "AZURE_VISION_MODEL_ID": "prebuilt-read",
+            "AZURE_STORAGE_ENDPOINT_URL": self.base_url,
+            "AZURE_STORAGE_TENANT_ID": "tenant",
+            "AZURE_STORAGE_GRANT_TYPE": "client_credentials",
+            "AZURE_STORAGE_CLIENT_ID": "client",
+            "AZURE_STORAGE_CLIENT_SECRET": "secret",
+            "AZURE_STORAGE_SCOPE": "https://storage.azure.com/.default",
+            "AZURE_STORAGE_ACCOUNT_URL": self.base_url,
+            "AZURE_STORAGE_ACCOUNT_CONTAINER_NAME": "container",
+            "AZURE_STORAGE_ACCOUNT_PREFIX": "benchmark",
+            "AZURE_STORAGE_FILE_TAGS": "source=benchmark",
+            "AZURE_STORAGE_SAS_VALID_HOURS": "1",
+            "AZURE_OPENAI_ENDPOINT": self.base_url.rstrip("/"),
+            "AZURE_OPENAI_DEPLOYMENT_NAME": "gpt-4o",
+            "AZURE_OPENAI_API_VERSION": "2024-08-01-preview",
+            "AZURE_OPENAI_KEY": "stand-in",
+            "AZURE_OPENAI_TEMPERATURE": "0",
+        }
+
+
+    #decide the route of a request, or None when it is not one of the stand-in endpoints
+    @staticmethod
+    def _route(method, path, query):
+        if method == "POST" and path.endswith("/oauth2/v2.0/token"):
+            return "token"
+        if method == "POST" and query.get("comp") == ["userdelegationkey"]:
+            return "delegation_key"
+        if method == "PUT" and query.get("comp") == ["block"]:
+            return "put_block"
+        if method == "PUT" and query.get("comp") == ["blocklist"]:
+            return "put_block_list"
+        if method == "PUT":
+            return "put_blob"
+        if method == "POST" and path.endswith(":analyze"):
+            return "ocr_submit"
+        if method == "GET" and "/analyzeResults/" in path:
+            return "ocr_poll"
+        if method == "POST" and path.endswith("/chat/completions"):
+            return "chat_completions"
+        if method == "POST" and path.endswith("/openai/files"):
+            return "batch_file_upload"
+        if method == "GET" and "/openai/files/" in path and path.endswith("/content"):
+            return "batch_file_content"
+        if method == "POST" and path.endswith("/openai/batches"):
+            return "batch_create"
+        if method == "GET" and "/openai/batches/" in path:
+            return "batch_get"
+        return None
+
+
+    #chat completion response for a request body, a keyed array when the request packs several CVs
+    @staticmethod
+    def _chat_completion(request):
+        content = "".join(str(message.get("content", "")) for message in request.get("messages", []))
+        prompt_tokens = len(content) // 4
+
+        #a request that packs several CVs gets a keyed JSON array with one result per CV
+        packed_ids = re.findall(r"<<<CV (\w+)>>>", content)
+        if packed_ids:
+            completion = json.dumps([{"id": packed_id, "result": SYNTHETIC_CV_DETAILS} for packed_id in packed_ids])
+        else:
+            completion = json.dumps(SYNTHETIC_CV_DETAILS)
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": "gpt-4o",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": completion}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(completion) // 4,
+                      "total_tokens": prompt_tokens + len(completion) // 4},
+        }
+
+
+    #current state of a batch job, writing its output file once it has run long enough
+    def _batch_state(self, batch_id):
+        with self.lock:
+            batch = self.batches.get(batch_id)
+            if batch is None:
+                return None
+            if batch["status"] == "in_progress" and time.monotonic() - batch["started"] >= self.batch_running_seconds:
+                output = []
+                errors = []
+                total = 0
+                for line in self.files[batch["input_file_id"]].decode("utf-8").splitlines():
+                    if not line.strip():
+                        continue
+                    request = json.loads(line)
+                    total += 1
+                    if request["custom_id"] in self.missing_batch_requests:
+                        continue
+                    if request["custom_id"] in self.failed_batch_requests:
+                        errors.append(json.dumps({"custom_id": request["custom_id"], "error": None,
+                                                  "response": {"status_code": 400, "body": {"error": {"code": "content_filter",
+                                                                                                      "message": "Stand-in failure"}}}}))
+                        continue
+                    output.append(json.dumps({"custom_id": request["custom_id"], "error": None,
+                                              "response": {"status_code": 200, "body": self._chat_completion(request["body"])}}))
+                output_file_id = f"file-{uuid.uuid4().hex}"
+                self.files[output_file_id] = ("\n".join(output) + "\n").encode("utf-8")
+                error_file_id = None
+                if errors:
+                    error_file_id = f"file-{uuid.uuid4().hex}"
+                    self.files[error_file_id] = ("\n".join(errors) + "\n").encode("utf-8")
+                batch.update({"status": self.batch_final_status, "output_file_id": output_file_id, "error_file_id": error_file_id,
+                              "request_counts": {"total": total, "completed": len(output), "failed": total - len(output)}})
+            return {key: value for key, value in batch.items() if key != "started"}
+
+
+    def _build_handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+            def do_PUT(self):
+                self._handle("PUT")
+
+            def _send(self, status, body=b"", content_type="application/json", headers=None):
+                if isinstance(body, (dict, list)):
+                    body = json.dumps(body).encode("utf-8")
+                elif isinstance(body, str):
+                    body = body.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _handle(self, method):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                route = stand_in._route(method, url.path, query)
+                with stand_in.lock:
+                    stand_in.request_counts[route or "unknown"] += 1
+                    if stand_in.first_request_time is None:
+                        stand_in.first_request_time = time.time()
+
+                time.sleep(stand_in.latency_seconds * random.uniform(1 - stand_in.latency_jitter, 1 + stand_in.latency_jitter))
+                if route is None:
+                    return self._send(404, {"error": {"code": "NotFound", "message": self.path}})
+
+                #fault injection, never on the token endpoint so every run can authenticate
+                if route != "token":
+                    draw = random.random()
+                    if draw < stand_in.error_rate_429:
+                        with stand_in.lock:
+                            stand_in.request_counts["injected_429"] += 1
+                        return self._send(429, {"error": {"code": "429", "message": "Rate limit is exceeded."}},
+                                          headers={"Retry-After": str(stand_in.retry_after_seconds)})
+                    if draw < stand_in.error_rate_429 + stand_in.error_rate_5xx:
+                        with stand_in.lock:
+                            stand_in.request_counts["injected_5xx"] += 1
+                        return self._send(503, {"error": {"code": "ServiceUnavailable", "message": "Injected failure."}})
+
+                return getattr(self, f"_{route}")(url, query, body)
+
+            def _token(self, url, query, body):
+                return self._send(200, {"token_type": "Bearer", "expires_in": 3599, "access_token": uuid.uuid4().hex})
+
+            def _delegation_key(self, url, query, body):
+                now = datetime.now(timezone.utc)
+                start = now.strftime("%Y-%m-%dT%H:%M:%SZ")
+                expiry = (now + timedelta(hours=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
+                key = base64.b64encode(uuid.uuid4().bytes * 2).decode()
+                xml = (f'<?xml version="1.0" encoding="utf-8"?><UserDelegationKey><SignedOid>oid</SignedOid>'
+                       f'<SignedTid>tid</SignedTid><SignedStart>{start}</SignedStart><SignedExpiry>{expiry}</SignedExpiry>'
+                       f'<SignedService>b</SignedService><SignedVersion>2020-12-06</SignedVersion><Value>{key}</Value></UserDelegationKey>')
+                return self._send(200, xml, content_type="application/xml")
+
+            def _put_blob(self, url, query, body):
+                return self._send(201)
+
+            def _put_block(self, url, query, body):
+                return self._send(201)
+
+            def _put_block_list(self, url, query, body):
+                return self._send(201)
+
+            def _ocr_submit(self, url, query, body):
+                operation_id = uuid.uuid4().hex
+                with stand_in.lock:
+                    stand_in.operations[operation_id] = time.monotonic()
+                model_path = url.path.rsplit(":analyze", 1)[0]
+                operation_location = f"{stand_in.base_url.rstrip('/')}{model_path}/analyzeResults/{operation_id}?api-version=2024-11-30"
+                return self._send(202, headers={"Operation-Location": operation_location, "Retry-After": str(stand_in.retry_after_seconds)})
+
+            def _ocr_poll(self, url, query, body):
+                operation_id = url.path.rsplit("/", 1)[-1]
+                with stand_in.lock:
+                    submitted = stand_in.operations.get(operation_id)
+                if submitted is None:
+                    return self._send(404, {"error": {"code": "NotFound", "message": operation_id}})
+                if time.monotonic() - submitted < stand_in.ocr_running_seconds:
+                    return self._send(200, {"status": "running"}, headers={"Retry-After": str(stand_in.retry_after_seconds)})
+                return self._send(200, {"status": "succeeded", "analyzeResult": {"content": SYNTHETIC_CV_TEXT}})
+
+            def _chat_completions(self, url, query, body):
+                return self._send(200, stand_in._chat_completion(json.loads(body or b"{}")))
+
+            def _batch_file_upload(self, url, query, body):
+                #take the file part out of the multipart form
+                boundary = self.headers.get("Content-Type", "").split("boundary=")[-1].encode()
+                content = b""
+                for part in body.split(b"--" + boundary):
+                    if b'name="file"' in part:
+                        content = part.split(b"\r\n\r\n", 1)[1].rsplit(b"\r\n", 1)[0]
+                file_id = f"file-{uuid.uuid4().hex}"
+                with stand_in.lock:
+                    stand_in.files[file_id] = content
+                return self._send(201, {"id": file_id, "object": "file", "purpose": "batch", "bytes": len(content), "status": "processed"})
+
+            def _batch_file_content(self, url, query, body):
+                file_id = url.path.rsplit("/", 2)[-2]
+                with stand_in.lock:
+                    content = stand_in.files.get(file_id)
+                if content is None:
+                    return self._send(404, {"error": {"code": "NotFound", "message": file_id}})
+                return self._send(200, content, content_type="application/octet-stream")
+
+            def _batch_create(self, url, query, body):
+                request = json.loads(body or b"{}")
+                batch_id = f"batch_{uuid.uuid4().hex}"
+                with stand_in.lock:
+                    if request.get("input_file_id") not in stand_in.files:
+                        return self._send(400, {"error": {"code": "invalidPayload", "message": "Unknown input_file_id"}})
+                    stand_in.batches[batch_id] = {"id": batch_id, "object": "batch", "endpoint": request.get("endpoint"),
+                                                  "input_file_id": request["input_file_id"], "completion_window": request.get("completion_window"),
+                                                  "status": "in_progress", "output_file_id": None, "error_file_id": None,
+                                                  "created_at": int(time.time()), "started": time.monotonic()}
+                return self._send(200, stand_in._batch_state(batch_id))
+
+            def _batch_get(self, url, query, body):
+                batch = stand_in._batch_state(url.path.rsplit("/", 1)[-1])
+                if batch is None:
+                    return self._send(404, {"error": {"code": "NotFound", "message": url.path}})
+                return self._send(200, batch)
+
+        return Handler
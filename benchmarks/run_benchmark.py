@@ -0,0 +1,204 @@
+"""
+Offline throughput benchmark for the CV pipeline.
+
+Starts local stand-ins for Blob Storage, Document Intelligence and Azure OpenAI, generates a synthetic corpus
+of PNG/JPEG/PDF CVs and drives Application.process_batch_async over it. Reports docs/sec, per-stage latency
+and peak memory, and can compare the result against an earlier report to catch regressions.
+
+Run from the repository root:
+    python -m benchmarks.run_benchmark --docs 200 --workers 32 --report bench.json
+    python -m benchmarks.run_benchmark --docs 200 --workers 32 --compare bench.json
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from PIL import Image, ImageDraw
+from benchmarks.azure_stand_ins import AzureStandInServer
+
+BENCHMARK_PROMPT = "Extract the CV details and respond with a JSON object with the keys name, email, skills and experience."
+
+
+#a one-page PDF with a real text layer, which takes the local text fast path
+def build_text_pdf(lines):
+    escaped = [line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") for line in lines]
+    stream = "BT /F1 11 Tf 50 800 Td 14 TL " + " ".join(f"({line}) '" for line in escaped) + " ET"
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents 4 0 R /Resources << /Font << /F1 5 0 R >> >> >>",
+        f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream",
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    output = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(output))
+        output += f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref_offset = len(output)
+    output += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    output += b"".join(f"{offset:010d} 00000 n \n".encode("latin-1") for offset in offsets)
+    output += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode("latin-1")
+    return output
+
+
+#a page image with some text and random noise, so every file has a different hash
+def build_page_image(index, width, height):
+    image = Image.new("L", (width, height), 255)
+    draw = ImageDraw.Draw(image)
+    for line in range(40):
+        draw.text((60, 60 + line * 30), f"Candidate {index} - line {line} - {random.random():.8f}", fill=0)
+    for _ in range(200):
+        draw.point((random.randrange(width), random.randrange(height)), fill=random.randrange(256))
+    return image
+
+
+#write the synthetic corpus and return the file paths
+def build_corpus(directory, docs, formats, width, height):
+    os.makedirs(directory, exist_ok=True)
+    file_names = []
+    for index in range(docs):
+        file_format = formats[index % len(formats)]
+        if file_format == "text-pdf":
+            file_name = os.path.join(directory, f"cv_{index:05d}_text.pdf")
+            lines = [f"Candidate {index}", f"Reference {random.random():.10f}"] + [f"Experience line {line} for candidate {index}" for line in range(40)]
+            with open(file_name, "wb") as f:
+                f.write(build_text_pdf(lines))
+        else:
+            extension = {"png": "png", "jpeg": "jpg", "pdf": "pdf"}[file_format]
+            file_name = os.path.join(directory, f"cv_{index:05d}.{extension}")
+            image = build_page_image(index, width, height)
+            buffer = io.BytesIO()
+            image.save(buffer, format={"png": "PNG", "jpeg": "JPEG", "pdf": "PDF"}[file_format])
+            with open(file_name, "wb") as f:
+                f.write(buffer.getvalue())
+        file_names.append(file_name)
+    return file_names
+
+
+#peak resident memory of this process in MB, where the platform reports it
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #Linux reports KB, macOS reports bytes
+    return round(peak / 1024 / (1024 if sys.platform == "darwin" else 1), 1)
+
+
+def run_benchmark(args):
+    stand_in = AzureStandInServer(latency_seconds=args.latency, error_rate_429=args.error_rate_429,
+                                  error_rate_5xx=args.error_rate_5xx, ocr_running_seconds=args.ocr_running_seconds,
+                                  retry_after_seconds=args.retry_after).start()
+    work_dir = tempfile.mkdtemp(prefix="cv_benchmark_")
+    try:
+        formats = args.formats.split(",")
+        file_names = build_corpus(os.path.join(work_dir, "corpus"), args.docs, formats, args.image_width, args.image_height)
+        with open(os.path.join(work_dir, "corpus.txt"), "w") as f:
+            f.write("\n".join(file_names))
+        with open(os.path.join(work_dir, "prompt.txt"), "w") as f:
+            f.write(BENCHMARK_PROMPT)
+
+        #point the Application at the stand-ins and keep its outputs inside the work directory
+        os.environ.update(stand_in.environment())
+        os.environ.update({
+            "CV_CACHE_ENABLED": "true" if args.with_cache else "false",
+            "CV_METRICS_JSONL_PATH": os.path.join(work_dir, "metrics", "spans.jsonl"),
+            "CV_METRICS_PROMETHEUS_PATH": os.path.join(work_dir, "metrics", "cv_pipeline.prom"),
+            "AZURE_VISION_POLL_DEADLINE_SECONDS": str(max(60, args.ocr_running_seconds * 10)),
+        })
+        os.chdir(work_dir)
+        os.makedirs("audit_log", exist_ok=True)
+
+        from main_application import Application
+        app = Application()
+
+        start = time.perf_counter()
+        results = app.process_batch(os.path.join(work_dir, "corpus.txt"), os.path.join(work_dir, "prompt.txt"), args.workers)
+        elapsed = time.perf_counter() - start
+        app.close_output()
+        if app.image_preprocessor is not None:
+            app.image_preprocessor.close()
+
+        summary = app.metrics.summary()
+        statuses = {}
+        for result in results:
+            statuses[result["status"]] = statuses.get(result["status"], 0) + 1
+        return {
+            "settings": vars(args),
+            "docs": len(results),
+            "statuses": statuses,
+            "elapsed_seconds": round(elapsed, 3),
+            "docs_per_second": round(len(results) / elapsed, 3) if elapsed else None,
+            "peak_rss_mb": peak_rss_mb(),
+            "stages": summary["stages"],
+            "counters": summary["counters"],
+            "stand_in_requests": dict(stand_in.request_counts),
+        }
+    finally:
+        stand_in.stop()
+
+
+#print the differences against an earlier report and return False when throughput regressed past the threshold
+def compare_reports(report, baseline, threshold):
+    print(f"docs/sec: {baseline['docs_per_second']} -> {report['docs_per_second']}")
+    for stage, values in sorted(report["stages"].items()):
+        if stage in baseline["stages"]:
+            print(f"  {stage:<12} p95 {baseline['stages'][stage]['p95_seconds']:.4f}s -> {values['p95_seconds']:.4f}s")
+    if baseline["docs_per_second"] and report["docs_per_second"] < baseline["docs_per_second"] * (1 - threshold):
+        print(f"REGRESSION: throughput dropped more than {threshold:.0%}")
+        return False
+    return True
+
+
+def print_report(report):
+    print(f"{report['docs']} docs in {report['elapsed_seconds']}s = {report['docs_per_second']} docs/sec, "
+          f"statuses {report['statuses']}, peak RSS {report['peak_rss_mb']} MB")
+    print(f"{'stage':<12} {'count':>6} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for stage, values in sorted(report["stages"].items()):
+        print(f"{stage:<12} {values['count']:>6} {values['p50_seconds']:>8.4f}s {values['p95_seconds']:>8.4f}s {values['p99_seconds']:>8.4f}s")
+    print(f"counters: {report['counters']}")
+    print(f"stand-in requests: {report['stand_in_requests']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark for the CV pipeline.")
+    parser.add_argument("--docs", type=int, default=100, help="Number of synthetic CVs")
+    parser.add_argument("--workers", type=int, default=32, help="Maximum number of CVs in flight at once")
+    parser.add_argument("--formats", default="png,jpeg,pdf,text-pdf", help="Comma separated mix of png, jpeg, pdf (scanned) and text-pdf")
+    parser.add_argument("--image-width", type=int, default=1240, help="Width of the synthetic page images")
+    parser.add_argument("--image-height", type=int, default=1754, help="Height of the synthetic page images")
+    parser.add_argument("--latency", type=float, default=0.05, help="Base latency of every stand-in request in seconds")
+    parser.add_argument("--ocr-running-seconds", type=float, default=1.0, help="How long OCR operations report running")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent by the stand-ins")
+    parser.add_argument("--error-rate-429", type=float, default=0.0, help="Fraction of stand-in requests answered with 429")
+    parser.add_argument("--error-rate-5xx", type=float, default=0.0, help="Fraction of stand-in requests answered with 503")
+    parser.add_argument("--with-cache", action="store_true", help="Keep the result cache enabled")
+    parser.add_argument("--report", help="Write the report as JSON to this file")
+    parser.add_argument("--compare", help="Compare against an earlier JSON report")
+    parser.add_argument("--regression-threshold", type=float, default=0.1, help="Allowed drop in docs/sec before --compare fails")
+    args = parser.parse_args()
+
+    #resolve paths before the benchmark changes into its work directory
+    report_path = os.path.abspath(args.report) if args.report else None
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+
+    report = run_benchmark(args)
+    print_report(report)
+    if report_path:
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+    if compare_path:
+        with open(compare_path) as f:
+            baseline = json.load(f)
+        if not compare_reports(report, baseline, args.regression_threshold):
+            sys.exit(1)
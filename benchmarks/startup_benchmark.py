@@ -0,0 +1,136 @@
+"""
+Startup time benchmark for the CV pipeline CLI.
+
+Every measurement runs main_application.py in a fresh Python process, the way a cron job or serverless function
+does, against local stand-ins for the Azure endpoints. Reports the median and worst of:
+    import          python -c "import main_application"
+    invalid_file    a run that stops at the file type check and exits with 1
+    first_request   from process start until the first request reaches the stand-ins
+    cold_run        a complete run of one CV with an empty cache
+    cache_hit       a complete run of the same CV when its OCR and LLM results are cached
+
+Run from the repository root:
+    python -m benchmarks.startup_benchmark --runs 5 --report startup.json
+    python -m benchmarks.startup_benchmark --profile-imports
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+from benchmarks.azure_stand_ins import AzureStandInServer
+from benchmarks.run_benchmark import BENCHMARK_PROMPT, build_corpus
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN_APPLICATION = os.path.join(REPOSITORY_ROOT, "main_application.py")
+
+
+#run a command in a fresh interpreter and return its wall time in seconds, its start time and its exit code
+def run_process(command, work_dir, environment):
+    start_time = time.time()
+    start = time.perf_counter()
+    completed = subprocess.run(command, cwd=work_dir, env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    return time.perf_counter() - start, start_time, completed.returncode, completed.stderr.decode(errors="replace")
+
+
+#the modules with the largest cumulative import time, from python -X importtime
+def profile_imports(work_dir, environment, top):
+    _, _, _, stderr = run_process([sys.executable, "-X", "importtime", "-c", "import main_application"], work_dir, environment)
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules.append((int(cumulative) / 1e6, name.rstrip()))
+    return sorted(modules, reverse=True)[:top]
+
+
+def summarize(values):
+    return {"median_seconds": round(statistics.median(values), 4), "max_seconds": round(max(values), 4), "runs": len(values)}
+
+
+def run_startup_benchmark(args):
+    stand_in = AzureStandInServer(latency_seconds=args.latency, ocr_running_seconds=args.ocr_running_seconds).start()
+    work_dir = tempfile.mkdtemp(prefix="cv_startup_benchmark_")
+    try:
+        cv_file = build_corpus(os.path.join(work_dir, "corpus"), 1, ["png"], 600, 850)[0]
+        invalid_file = os.path.join(work_dir, "corpus", "notes.txt")
+        with open(invalid_file, "w") as f:
+            f.write("This is not a CV.")
+        prompt_file = os.path.join(work_dir, "prompt.txt")
+        with open(prompt_file, "w") as f:
+            f.write(BENCHMARK_PROMPT)
+        os.makedirs(os.path.join(work_dir, "audit_log"), exist_ok=True)
+
+        #point the child processes at the stand-ins and keep their outputs inside the work directory
+        environment = dict(os.environ, **stand_in.environment())
+        environment.update({
+            "PYTHONPATH": REPOSITORY_ROOT,
+            "CV_JOB_STORE_ENABLED": "false",
+            "CV_CACHE_PATH": os.path.join(work_dir, "cache", "cv_cache.sqlite3"),
+            "CV_METRICS_JSONL_PATH": os.path.join(work_dir, "metrics", "spans.jsonl"),
+            "CV_METRICS_PROMETHEUS_PATH": os.path.join(work_dir, "metrics", "cv_pipeline.prom"),
+        })
+        run_command = [sys.executable, MAIN_APPLICATION, "--prompt", prompt_file]
+
+        timings = {"import": [], "invalid_file": [], "first_request": [], "cold_run": [], "cache_hit": []}
+        for _ in range(args.runs):
+            timings["import"].append(run_process([sys.executable, "-c", "import main_application"], work_dir, environment)[0])
+
+            elapsed, _, returncode, stderr = run_process(run_command + [invalid_file], work_dir, environment)
+            if returncode != 1:
+                raise RuntimeError(f"Expected the invalid file run to exit with 1, got {returncode}: {stderr}")
+            timings["invalid_file"].append(elapsed)
+
+            shutil.rmtree(os.path.join(work_dir, "cache"), ignore_errors=True)
+            stand_in.first_request_time = None
+            elapsed, start_time, returncode, stderr = run_process(run_command + [cv_file], work_dir, environment)
+            if returncode != 0 or stand_in.first_request_time is None:
+                raise RuntimeError(f"Cold run failed with exit code {returncode}: {stderr}")
+            timings["cold_run"].append(elapsed)
+            timings["first_request"].append(stand_in.first_request_time - start_time)
+
+            timings["cache_hit"].append(run_process(run_command + [cv_file], work_dir, environment)[0])
+
+        report = {
+            "python": sys.version.split()[0],
+            "settings": vars(args),
+            "timings": {name: summarize(values) for name, values in timings.items()},
+        }
+        if args.profile_imports:
+            report["slowest_imports"] = [{"module": name, "cumulative_seconds": round(seconds, 4)}
+                                         for seconds, name in profile_imports(work_dir, environment, args.profile_imports)]
+        return report
+    finally:
+        stand_in.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def print_report(report):
+    print(f"{'measurement':<14} {'median':>9} {'max':>9}")
+    for name, values in report["timings"].items():
+        print(f"{name:<14} {values['median_seconds']:>8.3f}s {values['max_seconds']:>8.3f}s")
+    for item in report.get("slowest_imports", []):
+        print(f"  {item['cumulative_seconds']:>8.4f}s  {item['module']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Startup time benchmark for the CV pipeline CLI.")
+    parser.add_argument("--runs", type=int, default=5, help="Number of fresh processes per measurement")
+    parser.add_argument("--latency", type=float, default=0.01, help="Base latency of every stand-in request in seconds")
+    parser.add_argument("--ocr-running-seconds", type=float, default=0.2, help="How long OCR operations report running")
+    parser.add_argument("--profile-imports", type=int, nargs="?", const=15, default=0,
+                        help="Also list the N modules that take longest to import (default 15)")
+    parser.add_argument("--report", help="Write the report as JSON to this file")
+    args = parser.parse_args()
+
+    report = run_startup_benchmark(args)
+    print_report(report)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,47 @@
+import asyncio
+import weakref
+
+
+#one shared client per event loop, so every stage of every document reuses the same connection pool
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_http_client(max_connections=100, max_keepalive_connections=20):
+    """
+    Return the shared httpx.AsyncClient for the running event loop, creating it on first use.
+
+    :param max_connections: Maximum number of concurrent connections in the pool (only used on creation).
+    :param max_keepalive_connections: Maximum number of idle connections kept alive (only used on creation).
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None or client.is_closed:
+        #imported on first use, so runs that never make a request do not pay for it
+        import httpx
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections),
+            timeout=None
+        )
+        _clients[loop] = client
+    return client
+
+
+async def close_async_http_client():
+    """Close the shared client of the running event loop, if there is one."""
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def run_sync(coroutine):
+    """
+    Run a coroutine to completion on a new event loop and close that loop's shared client afterwards.
+    This is what the synchronous wrapper classes use to call their async counterparts.
+    """
+    async def _runner():
+        try:
+            return await coroutine
+        finally:
+            await close_async_http_client()
+
+    return asyncio.run(_runner())
@@ -1,37 +1,158 @@
+import os
+import copy
+import json
+import queue
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+import threading
+import contextvars
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+
+#the pipeline stage the current task is in, e.g. "upload" or "llm". Set by MetricsManager.span, so every log
+#record written inside a stage carries it without the stage being passed around
+current_stage = contextvars.ContextVar("current_stage", default=None)
+
+#record attributes that are written as their own JSON fields when they are set
+STRUCTURED_FIELDS = ["unique_key", "document_id", "file_hash", "stage"]
+
+#one queue and background writer per log file, shared by every LogManager of the process
+_listeners = {}
+_listeners_lock = threading.Lock()
+
+
+@contextmanager
+def log_stage(stage):
+    token = current_stage.set(stage)
+    try:
+        yield
+    finally:
+        current_stage.reset(token)
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line, with the structured fields as keys of their own."""
+    def format(self, record):
+        entry = {
+            "timestamp": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextLogFormatter(logging.Formatter):
+    """The original plain text format, for people who read the log file directly."""
+    def __init__(self):
+        super().__init__("%(asctime)s - %(unique_key)s - %(name)s - %(levelname)s - %(message)s")
+
+    def format(self, record):
+        record.unique_key = getattr(record, "unique_key", None)
+        return super().format(record)
+
+
+class BufferedRotatingFileHandler(RotatingFileHandler):
+    """
+    RotatingFileHandler that only flushes once the log queue is drained, so a burst of records is written to
+    the file in one go instead of with one flush per record.
+    """
+    def __init__(self, log_queue, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.log_queue = log_queue
+
+    def flush(self):
+        if self.log_queue.empty():
+            super().flush()
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.flush()
+        super().close()
+
+
+class RecordQueueHandler(QueueHandler):
+    """
+    QueueHandler that keeps the exception of a record. The standard one formats the traceback into the message and
+    drops exc_info, so the JSON formatter could not write it as a field of its own. The queue never leaves the
+    process, so exc_info does not have to be pickled, and the traceback is formatted on the writer thread.
+    """
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class AuditLogAdapter(logging.LoggerAdapter):
+    """LoggerAdapter that adds its extra fields and the current stage to every record, next to any extra of the call."""
+    def process(self, msg, kwargs):
+        extra = dict(self.extra)
+        extra.setdefault("stage", current_stage.get())
+        extra.update(kwargs.get("extra") or {})
+        kwargs["extra"] = extra
+        return msg, kwargs
+
+
+#stop every background writer, writing out the records still in their queues
+def stop_log_listeners():
+    with _listeners_lock:
+        for listener in _listeners.values():
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
+        _listeners.clear()
+
+
+atexit.register(stop_log_listeners)
+
 
 class LogManager:
-    def __init__(self, unique_key='NO_KEY_PROVIDED', log_file="audit_log/cv_llm.log", max_bytes=5 * 1024 * 1024, level=logging.DEBUG):
+    def __init__(self, unique_key='NO_KEY_PROVIDED', log_file="audit_log/cv_llm.log", max_bytes=5 * 1024 * 1024, level=logging.DEBUG,
+                 log_format="json", backup_count=3, document_id=None):
         """
-        Initialize a logger with RotatingFileHandler.
+        Initialize a logger that hands its records to a queue. A background thread writes them to a rotating file,
+        so logging never waits on disk I/O or on other workers. The handlers are only set up by the first
+        LogManager for a log file; later ones share them and only add their own unique_key.
 
         :param unique_key: A unique identifier for the logs.
         :param log_file: Path to the log file.
         :param max_bytes: Maximum size of a log file before rotation (in bytes).
-        :param level: Logging level (e.g., logging.INFO, logging.DEBUG).
+        :param level: Logging level (e.g., logging.INFO, logging.DEBUG, or its name).
+        :param log_format: "json" for one JSON object per line with unique_key, document_id and stage fields, or "text".
+        :param backup_count: Number of rotated log files that are kept.
+        :param document_id: Identifies the document the logs are about, e.g. its file name.
         """
         self.unique_key = unique_key
+        self.document_id = document_id
         self.logger = logging.getLogger(log_file)
 
-        if not self.logger.hasHandlers():  # Avoid adding multiple handlers
-            self.logger.setLevel(level)
+        with _listeners_lock:
+            if not self.logger.hasHandlers():  # Avoid adding multiple handlers
+                self.logger.setLevel(level.upper() if isinstance(level, str) else level)
+
+                #the file handler only runs on the listener's thread, so rotation never contends between workers
+                log_queue = queue.SimpleQueue()
+                if os.path.dirname(log_file):
+                    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+                handler = BufferedRotatingFileHandler(log_queue, log_file, maxBytes=max_bytes, backupCount=backup_count)
+                handler.setFormatter(JsonLogFormatter() if log_format == "json" else TextLogFormatter())
 
-            #create a rotating file handler
-            handler = RotatingFileHandler(
-                log_file, maxBytes=max_bytes, backupCount=3
-            )
-            handler.setFormatter(
-                logging.Formatter(
-                    "%(asctime)s - %(unique_key)s - %(name)s - %(levelname)s - %(message)s"
-                )
-            )
+                listener = QueueListener(log_queue, handler, respect_handler_level=True)
+                listener.start()
+                _listeners[log_file] = listener
 
-            #add the handler to the logger
-            self.logger.addHandler(handler)
+                #add the queue handler to the logger
+                self.logger.addHandler(RecordQueueHandler(log_queue))
 
     def get_logger(self):
         """
-        Returns the configured logger instance with `unique_key` as default extra.
+        Returns the configured logger instance with `unique_key` and `document_id` as default extra.
         """
-        return logging.LoggerAdapter(self.logger, {'unique_key': self.unique_key})
+        return AuditLogAdapter(self.logger, {'unique_key': self.unique_key, 'document_id': self.document_id})
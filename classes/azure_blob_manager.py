@@ -1,12 +1,18 @@
-import requests
+import os
 import time
+import base64
+import asyncio
 from datetime import datetime, timedelta, timezone
 import xml.etree.ElementTree as ET
 from classes.azure_generate_user_delegated_sas_token import userDelegatedSasToken
+from classes.async_http_client import get_async_http_client, run_sync
+from classes.azure_credential_cache import shared_credential_cache
+from classes.resilience import DependencyUnavailableError, shared_resilience
 
 
-class AzureBlobManager:
-  def __init__(self, endpoint_url, tenant_id, grant_type, client_id, client_secret, scope, file_name, app_logging):
+class AsyncAzureBlobManager:
+  def __init__(self, endpoint_url, tenant_id, grant_type, client_id, client_secret, scope, file_name, app_logging, http_client=None, credential_cache=None,
+               resilience=None):
     self.endpoint_url = endpoint_url
     self.tenant_id = tenant_id
     self.grant_type = grant_type
@@ -14,101 +20,241 @@ class AzureBlobManager:
     self.client_secret = client_secret
     self.scope = scope
     self.headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-    self.token = None
-    self.token_expiry = None
     self.app_logging = app_logging
+    self.http_client = http_client
+
+    #timeouts, retries and circuit breakers shared with the other Azure clients
+    self.resilience = resilience or shared_resilience
 
-    #handle file_name
-    self.file_name = file_name
-    if "\\" in self.file_name:
-        self.file_name = file_name.split("\\")[-1]
+    #the token and user delegation key are shared with every other manager in the process
+    self.credential_cache = credential_cache or shared_credential_cache
+    self.token_cache_name = f"token|{endpoint_url}|{tenant_id}|{client_id}|{scope}"
 
-    #get the token during initialization
-    self._refresh_token() 
+    #handle file_name, keeping only the name for both Windows and POSIX paths
+    self.file_name = file_name.replace("\\", "/").split("/")[-1]
     
 
-  def _refresh_token(self):
-    """Fetch a new token and update expiry."""
+  #use the client passed in, or the shared client of the running event loop
+  def _get_http_client(self):
+    return self.http_client or get_async_http_client()
+
+
+  async def _fetch_token(self):
+    """Fetch a new token and return it with its expiry time."""
     payload = {
         'grant_type': self.grant_type,
         'client_id': self.client_id,
         'client_secret': self.client_secret,
         'scope': self.scope
     }
-    response = requests.post(f"{self.endpoint_url}{self.tenant_id}/oauth2/v2.0/token", headers=self.headers, data=payload)
+    response = await self.resilience.request(self._get_http_client(), "token", "POST", f"{self.endpoint_url}{self.tenant_id}/oauth2/v2.0/token",
+                                             self.app_logging, headers=self.headers, data=payload)
 
     token_data = response.json()
-    self.token = token_data.get('access_token')
+    token = token_data.get('access_token')
+    if token is None:
+      raise ValueError(f"No access token returned (HTTP {response.status_code}): {token_data.get('error_description')}")
     expires_in = token_data.get('expires_in', 3600)  # Default to 1 hour if not provided
-    self.token_expiry = time.time() + expires_in - 60  # Refresh 1 minute before expiry
+    return token, time.time() + expires_in  # The cache refreshes it before expiry
+
+
+  async def _refresh_token(self):
+    """Force a new token, even if the cached one has not expired."""
+    self.credential_cache.invalidate(self.token_cache_name)
+    return await self.credential_cache.get(self.token_cache_name, self._fetch_token)
   
 
-  def _get_token(self):
+  async def get_token(self):
+    """
+      Return the cached token, refreshing it shortly before it expires.
+
+      :raises DependencyUnavailableError: When no token could be fetched. Its reason says why, e.g. the HTTP status.
+    """
+    try:
+      return await self.credential_cache.get(self.token_cache_name, self._fetch_token)
+    except DependencyUnavailableError:
+      raise
+    except Exception as e:
+      raise DependencyUnavailableError("token", str(e)) from e
+
+
+  async def _get_token(self):
     try:
-      """Ensure the token is valid and return it."""
-      if self.token is None or time.time() >= self.token_expiry:
-          self._refresh_token()
-      return self.token
+      """Return the cached token, or None when it could not be fetched."""
+      return await self.get_token()
     except Exception as e:
       self.app_logging.error(f"Error getting token: {e}")
       return None
 
     
-  def upload_file(self, storage_url, container_name, prefix, file_type, data, azure_storage_file_tags):
+  async def upload_file(self, storage_url, container_name, prefix, file_type, data, azure_storage_file_tags):
     try:
       url = f"{storage_url}{container_name}/{prefix}/{self.file_name}"
       headers = {
-        'Authorization': f'Bearer {self._get_token()}',
+        'Authorization': f'Bearer {await self.get_token()}',
         'x-ms-blob-type': 'BlockBlob',
         'x-ms-version': '2020-04-08',
         'x-ms-tags': azure_storage_file_tags,
         'Content-Type': file_type
       }
-      response = requests.put(url, headers=headers, data=data)
+      response = await self.resilience.request(self._get_http_client(), "storage", "PUT", url, self.app_logging, headers=headers, content=data)
       return response
+    except DependencyUnavailableError:
+      raise
     except Exception as e:
       self.app_logging.error(f"Error uploading file: {e}")
       return None
 
-  
-  def get_user_delegated_sas_token(self, storage_url, container_name, prefix, delegation_key_valid_hours):
+
+  async def upload_file_from_path(self, storage_url, container_name, prefix, file_type, file_path, azure_storage_file_tags,
+                                  single_put_max_bytes=8 * 1024 * 1024, block_size=4 * 1024 * 1024, max_concurrency=4):
+    """
+      Upload a file from disk without reading it into memory at once. Small files go up in a single PUT, larger
+      files are split into blocks that are read and uploaded in parallel (Put Block), then committed with
+      Put Block List. At most max_concurrency blocks are held in memory at any time.
+    """
     try:
-      """
-        This function will first get the user delegation key, and then call class generate_user_delegated_sas_token
-        to generate the SAS token that will allow us to access the file.
-      """
-      url = f"{storage_url}?restype=service&comp=userdelegationkey"
+      file_size = os.path.getsize(file_path)
+      if file_size <= single_put_max_bytes:
+        data = await asyncio.to_thread(self._read_block, file_path, 0, file_size)
+        return await self.upload_file(storage_url, container_name, prefix, file_type, data, azure_storage_file_tags)
+
+      url = f"{storage_url}{container_name}/{prefix}/{self.file_name}"
+      token = await self.get_token()
+      semaphore = asyncio.Semaphore(max_concurrency)
+      block_ids = [base64.b64encode(f"{index:08d}".encode()).decode() for index in range((file_size + block_size - 1) // block_size)]
+
+      async def put_block(index, block_id):
+        async with semaphore:
+          data = await asyncio.to_thread(self._read_block, file_path, index * block_size, block_size)
+          response = await self.resilience.request(self._get_http_client(), "storage", "PUT", url, self.app_logging,
+                                                   params={'comp': 'block', 'blockid': block_id}, content=data,
+                                                   headers={'Authorization': f'Bearer {token}', 'x-ms-version': '2020-04-08'})
+          return response
+
+      #a block that was refused fails the upload with its response, so the caller sees the status code
+      responses = await asyncio.gather(*[put_block(index, block_id) for index, block_id in enumerate(block_ids)])
+      failed_response = next((response for response in responses if response.status_code >= 300), None)
+      if failed_response is not None:
+        self.app_logging.error(f"Block upload failed with status {failed_response.status_code}: {failed_response.text}")
+        return failed_response
+
+      #commit the uploaded blocks in order
+      block_list = "".join(f"<Latest>{block_id}</Latest>" for block_id in block_ids)
       headers = {
-        'Authorization': f'Bearer {self._get_token()}',
-        'x-ms-version': '2020-12-06',
+        'Authorization': f'Bearer {token}',
+        'x-ms-version': '2020-04-08',
+        'x-ms-tags': azure_storage_file_tags,
+        'x-ms-blob-content-type': file_type,
         'Content-Type': 'application/xml'
       }
+      payload = f"""<?xml version="1.0" encoding="utf-8"?><BlockList>{block_list}</BlockList>"""
+      response = await self.resilience.request(self._get_http_client(), "storage", "PUT", url, self.app_logging,
+                                               params={'comp': 'blocklist'}, headers=headers, content=payload)
+      self.app_logging.info(f"Uploaded {file_size} bytes in {len(block_ids)} blocks")
+      return response
+    except DependencyUnavailableError:
+      raise
+    except Exception as e:
+      self.app_logging.error(f"Error uploading file in blocks: {e}")
+      return None
 
-      # Calculate the current time (UTC) and expiry time
-      current_time = datetime.now(timezone.utc) #datetime.utcnow() deprecated
-      expiry_time = current_time + timedelta(hours=delegation_key_valid_hours)
-      start_time_str = current_time.strftime("%Y-%m-%dT%H:%M:%SZ")
-      expiry_time_str = expiry_time.strftime("%Y-%m-%dT%H:%M:%SZ")
-      payload = f"""<?xml version="1.0" encoding="utf-8"?><KeyInfo><Start>{start_time_str}</Start><Expiry>{expiry_time_str}</Expiry></KeyInfo>"""
-      response = requests.post(url, headers=headers, data=payload)
-
-      # Extract values from the XML
-      root = ET.fromstring(response.text)   
-      user_delegation_key_components = {
-          'SignedOid': root.find('SignedOid').text,
-          'SignedTid': root.find('SignedTid').text,
-          'SignedStart': root.find('SignedStart').text,
-          'SignedExpiry': root.find('SignedExpiry').text,
-          'SignedService': root.find('SignedService').text,
-          'SignedVersion': root.find('SignedVersion').text,
-          'Value': root.find('Value').text,
-      }
+
+  #read one block of a file from disk
+  @staticmethod
+  def _read_block(file_path, offset, size):
+    with open(file_path, 'rb') as f:
+      f.seek(offset)
+      return f.read(size)
+
+  
+  async def _fetch_user_delegation_key(self, storage_url, delegation_key_valid_hours):
+    """Fetch a new user delegation key and return its components with its expiry time."""
+    url = f"{storage_url}?restype=service&comp=userdelegationkey"
+    headers = {
+      'Authorization': f'Bearer {await self.get_token()}',
+      'x-ms-version': '2020-12-06',
+      'Content-Type': 'application/xml'
+    }
+
+    # Calculate the current time (UTC) and expiry time
+    current_time = datetime.now(timezone.utc) #datetime.utcnow() deprecated
+    expiry_time = current_time + timedelta(hours=delegation_key_valid_hours)
+    start_time_str = current_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+    expiry_time_str = expiry_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+    payload = f"""<?xml version="1.0" encoding="utf-8"?><KeyInfo><Start>{start_time_str}</Start><Expiry>{expiry_time_str}</Expiry></KeyInfo>"""
+    response = await self.resilience.request(self._get_http_client(), "storage", "POST", url, self.app_logging, headers=headers, content=payload)
+    if response.status_code >= 300:
+      raise DependencyUnavailableError("storage", f"user delegation key request failed with HTTP {response.status_code}")
+
+    # Extract values from the XML
+    root = ET.fromstring(response.text)   
+    user_delegation_key_components = {
+        'SignedOid': root.find('SignedOid').text,
+        'SignedTid': root.find('SignedTid').text,
+        'SignedStart': root.find('SignedStart').text,
+        'SignedExpiry': root.find('SignedExpiry').text,
+        'SignedService': root.find('SignedService').text,
+        'SignedVersion': root.find('SignedVersion').text,
+        'Value': root.find('Value').text,
+    }
+    key_expiry = datetime.strptime(user_delegation_key_components['SignedExpiry'], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
+    return user_delegation_key_components, key_expiry.timestamp()
+
+
+  async def get_user_delegated_sas_token(self, storage_url, container_name, prefix, delegation_key_valid_hours):
+    try:
+      """
+        This function will first get the cached user delegation key, and then call class generate_user_delegated_sas_token
+        to generate the SAS token that will allow us to access the file. Signing the token is local, so only the first
+        document (and one per key lifetime after that) pays for the delegation key request.
+      """
+      user_delegation_key_components = await self.credential_cache.get(
+          f"delegation_key|{storage_url}|{self.token_cache_name}",
+          lambda: self._fetch_user_delegation_key(storage_url, delegation_key_valid_hours))
 
       #Get the actual SAS token that will allow us to access the file
       sas_token = userDelegatedSasToken(user_delegation_key_components, storage_url, container_name, prefix, self.file_name)
       sas_token = sas_token.generate_token()
       
       return sas_token
+    except DependencyUnavailableError:
+      raise
     except Exception as e:
       self.app_logging.error(f"Error getting SAS Token: {e}")
-      return None
\ No newline at end of file
+      return None
+
+
+class AzureBlobManager:
+  """Synchronous wrapper around AsyncAzureBlobManager for callers that do not run an event loop."""
+  def __init__(self, endpoint_url, tenant_id, grant_type, client_id, client_secret, scope, file_name, app_logging):
+    self.async_manager = AsyncAzureBlobManager(endpoint_url, tenant_id, grant_type, client_id, client_secret, scope, file_name, app_logging)
+    self.file_name = self.async_manager.file_name
+    self.app_logging = app_logging
+
+    #get the token during initialization, from the process-wide cache when it is still valid
+    self._get_token()
+
+
+  def _refresh_token(self):
+    run_sync(self.async_manager._refresh_token())
+
+
+  def _get_token(self):
+    return run_sync(self.async_manager._get_token())
+
+
+  def get_token(self):
+    return run_sync(self.async_manager.get_token())
+
+
+  def upload_file(self, storage_url, container_name, prefix, file_type, data, azure_storage_file_tags):
+    return run_sync(self.async_manager.upload_file(storage_url, container_name, prefix, file_type, data, azure_storage_file_tags))
+
+
+  def upload_file_from_path(self, storage_url, container_name, prefix, file_type, file_path, azure_storage_file_tags, **upload_options):
+    return run_sync(self.async_manager.upload_file_from_path(storage_url, container_name, prefix, file_type, file_path, azure_storage_file_tags, **upload_options))
+
+
+  def get_user_delegated_sas_token(self, storage_url, container_name, prefix, delegation_key_valid_hours):
+    return run_sync(self.async_manager.get_user_delegated_sas_token(storage_url, container_name, prefix, delegation_key_valid_hours))
@@ -0,0 +1,68 @@
+import time
+import asyncio
+import weakref
+import threading
+
+
+class AzureCredentialCache:
+    def __init__(self, refresh_margin_seconds=300):
+        """
+        Process-wide cache for credentials that outlive a single document, such as the AAD access token
+        and the storage user delegation key.
+
+        :param refresh_margin_seconds: Credentials are refreshed this many seconds before they expire.
+        """
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.entries = {}
+        self.lock = threading.Lock()
+
+        #one refresh lock per credential and event loop, so concurrent callers wait on a single refresh
+        self.refresh_locks = weakref.WeakKeyDictionary()
+
+
+    #return the cached value if it is not about to expire, otherwise None
+    def _get_valid(self, name):
+        with self.lock:
+            entry = self.entries.get(name)
+        if entry is not None and time.time() < entry[1] - self.refresh_margin_seconds:
+            return entry[0]
+        return None
+
+
+    def _get_refresh_lock(self, name):
+        with self.lock:
+            loop_locks = self.refresh_locks.setdefault(asyncio.get_running_loop(), {})
+            return loop_locks.setdefault(name, asyncio.Lock())
+
+
+    async def get(self, name, fetch):
+        """
+        Return a cached credential, refreshing it first if it is missing or about to expire.
+
+        :param name: Cache key of the credential.
+        :param fetch: Coroutine function that fetches the credential and returns (value, expires_at epoch seconds).
+        """
+        value = self._get_valid(name)
+        if value is not None:
+            return value
+
+        async with self._get_refresh_lock(name):
+            #another caller may have refreshed it while we waited for the lock
+            value = self._get_valid(name)
+            if value is not None:
+                return value
+
+            value, expires_at = await fetch()
+            with self.lock:
+                self.entries[name] = (value, expires_at)
+            return value
+
+
+    #drop a credential so the next get fetches a new one
+    def invalidate(self, name):
+        with self.lock:
+            self.entries.pop(name, None)
+
+
+#the cache shared by every AsyncAzureBlobManager that is not given its own
+shared_credential_cache = AzureCredentialCache()
@@ -1,32 +1,159 @@
-import requests
 import time
+import asyncio
+import inspect
+from classes.async_http_client import get_async_http_client, run_sync
+from classes.resilience import DependencyUnavailableError, backoff_delay, shared_resilience
+from classes.langchain_chunk_manager import PAGE_BREAK
 
 
-class AzureDocIntel:
-    def __init__(self, full_endpoint, headers, sas_token, app_logging):
+class OcrPollingPolicy:
+    def __init__(self, initial_delay=0.5, max_delay=5.0, backoff_factor=1.5, jitter=0.2, deadline=120.0):
+        """
+        Decide how long to wait between polls of a Document Intelligence operation.
+
+        :param initial_delay: Seconds to wait before the first poll when the service gives no Retry-After.
+        :param max_delay: Upper bound for the backoff delay in seconds.
+        :param backoff_factor: Multiplier applied to the delay after every poll.
+        :param jitter: Fraction of the delay that is randomised, so concurrent documents do not poll in lockstep.
+        :param deadline: Overall seconds allowed from submit until a final status, after which the document fails.
+        """
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff_factor = backoff_factor
+        self.jitter = jitter
+        self.deadline = deadline
+
+
+    #a Retry-After header wins, otherwise back off exponentially with jitter. The wait is still bounded by the deadline
+    def next_delay(self, attempt, retry_after=None):
+        return backoff_delay(attempt, self.initial_delay, self.max_delay, self.backoff_factor, self.jitter, retry_after)
+
+
+class AsyncAzureDocIntel:
+    final_statuses = ['succeeded', 'failed', 'canceled']
+
+    def __init__(self, full_endpoint, headers, sas_token, app_logging, http_client=None, polling_policy=None, resilience=None):
         self.full_endpoint = full_endpoint
         self.headers = headers
         self.sas_token = sas_token
         self.app_logging = app_logging
+        self.http_client = http_client
+        self.polling_policy = polling_policy or OcrPollingPolicy()
+        self.resilience = resilience or shared_resilience
         self.payload = {"urlSource": self.sas_token}
+        self.poll_stats = {"status": None, "poll_count": 0, "submit_seconds": None, "time_to_result_seconds": None}
+
+
+    #use the client passed in, or the shared client of the running event loop
+    def _get_http_client(self):
+        return self.http_client or get_async_http_client()
 
 
-    def get_ocr_text(self):
+    async def get_ocr_text(self, operation_location=None, on_submitted=None):
+        """
+        Submit the document for OCR and poll until the operation reaches a final status.
+
+        :param operation_location: Operation-Location of an operation submitted earlier. When given, the submit is
+                                   skipped and that operation is polled, e.g. after a worker was restarted.
+        :param on_submitted: Called with the Operation-Location right after a new submit, before polling starts. It is
+                             awaited when it returns an awaitable, e.g. a checkpoint that writes to disk in a thread.
+        """
+        start = time.perf_counter()
+        deadline = time.monotonic() + self.polling_policy.deadline
+        status = None
+        response = None
+        retry_after = None
         try:
-            response = requests.post(self.full_endpoint, headers=self.headers, json=self.payload)
-            time.sleep(5)
-
-            #Call the returned endpoint in the operation location header until the status is no longer running
-            ocr_outcome = requests.get(response.headers.get('Operation-Location'), headers=self.headers)
-            while ocr_outcome.json().get("status") not in ['succeeded']:
-                print("wiating 5 seconds for ocr data....")
-                time.sleep(5)
-                ocr_outcome = requests.get(response.headers.get('Operation-Location'), headers=self.headers)
-            
-            text_only = ocr_outcome.json().get("analyzeResult").get("content")
-            return response, text_only
-        
+            http_client = self._get_http_client()
+            if operation_location is None:
+                response = await self.resilience.request(http_client, "ocr_submit", "POST", self.full_endpoint, self.app_logging,
+                                                         headers=self.headers, json=self.payload)
+                self.poll_stats["submit_seconds"] = round(time.perf_counter() - start, 3)
+                operation_location = response.headers.get('Operation-Location')
+                if operation_location is None:
+                    self.app_logging.error(f"OCR submit failed with status {response.status_code}: {response.text}")
+                    status = f"submit_http_{response.status_code}"
+                    return None, None
+                retry_after = response.headers.get('Retry-After')
+                if on_submitted is not None:
+                    result = on_submitted(operation_location)
+                    if inspect.isawaitable(result):
+                        await result
+            else:
+                self.app_logging.info("Resuming OCR operation submitted earlier")
+
+            #Call the returned endpoint in the operation location header until the operation reaches a final status
+            while status not in self.final_statuses:
+                remaining = self.polling_policy.deadline - (time.perf_counter() - start)
+                if remaining <= 0:
+                    self.app_logging.error(f"OCR did not finish within {self.polling_policy.deadline}s (last status: {status})")
+                    status = "timed_out"
+                    return None, None
+                await asyncio.sleep(min(self.polling_policy.next_delay(self.poll_stats["poll_count"], retry_after), remaining))
+
+                #a poll and its retries are cut off at the deadline too, so a slow poll cannot outlast it
+                ocr_outcome = await self.resilience.request(http_client, "ocr_poll", "GET", operation_location, self.app_logging,
+                                                            deadline=deadline, headers=self.headers)
+                self.poll_stats["poll_count"] += 1
+                if ocr_outcome.status_code == 404:
+                    #results are only kept for a limited time, so an old operation has to be submitted again
+                    self.app_logging.warning("OCR operation no longer exists")
+                    status = "not_found"
+                    return None, None
+                if ocr_outcome.status_code >= 400:
+                    #e.g. 401 or 403, which polling again will not fix, so the document fails at once instead of at the deadline
+                    self.app_logging.error(f"OCR poll failed with status {ocr_outcome.status_code}: {ocr_outcome.text}")
+                    status = f"http_{ocr_outcome.status_code}"
+                    return None, None
+                retry_after = ocr_outcome.headers.get('Retry-After')
+                status = ocr_outcome.json().get("status")
+                self.app_logging.debug(f"OCR status is {status} after {self.poll_stats['poll_count']} polls")
+
+            if status != 'succeeded':
+                self.app_logging.error(f"OCR operation {status}: {ocr_outcome.json().get('error')}")
+                return None, None
+
+            text_only = self._get_page_text(ocr_outcome.json().get("analyzeResult"))
+            return response or ocr_outcome, text_only
+
+        except DependencyUnavailableError:
+            status = "timed_out" if time.monotonic() >= deadline else "dependency_unavailable"
+            raise
         except Exception as e:
             self.app_logging.error(f"Error getting OCR text: {e}")
             return None, None
+        finally:
+            #record how the polling went so the policy can be tuned
+            self.poll_stats["status"] = status
+            self.poll_stats["time_to_result_seconds"] = round(time.perf_counter() - start, 3)
+            self.app_logging.info(f"OCR {status} after {self.poll_stats['poll_count']} polls in {self.poll_stats['time_to_result_seconds']}s")
+
+
+    #the content of the analyze result with a page break between the pages, taken from each page's spans, so repeated
+    #headers and footers can be found at the page edges. Results without pages are returned as they are
+    @staticmethod
+    def _get_page_text(analyze_result):
+        content = analyze_result.get("content")
+        pages = analyze_result.get("pages")
+        if not content or not pages:
+            return content
+        page_texts = []
+        for page in pages:
+            spans = page.get("spans") or []
+            page_texts.append("\n".join(content[span["offset"]:span["offset"] + span["length"]] for span in spans))
+        return PAGE_BREAK.join(page_texts)
+
+
+class AzureDocIntel:
+    """Synchronous wrapper around AsyncAzureDocIntel for callers that do not run an event loop."""
+    def __init__(self, full_endpoint, headers, sas_token, app_logging, polling_policy=None, resilience=None):
+        self.async_manager = AsyncAzureDocIntel(full_endpoint, headers, sas_token, app_logging, polling_policy=polling_policy, resilience=resilience)
+
+
+    def get_ocr_text(self, operation_location=None, on_submitted=None):
+        return run_sync(self.async_manager.get_ocr_text(operation_location, on_submitted))
+
 
+    @property
+    def poll_stats(self):
+        return self.async_manager.poll_stats
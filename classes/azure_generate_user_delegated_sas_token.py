@@ -1,7 +1,7 @@
 import hmac
 import hashlib
 import base64
-from urllib.parse import quote
+from urllib.parse import quote, urlparse
 
 
 class userDelegatedSasToken:
@@ -34,7 +34,7 @@ class userDelegatedSasToken:
 
     def generate_token(self):
         #Get the container name only and build the canonical resource
-        storage_account_name_only = self.storage_url.split('https://')[1].split('.')[0]
+        storage_account_name_only = urlparse(self.storage_url).hostname.split('.')[0]
         canonical_resource = f"/blob/{storage_account_name_only}/{self.container_name}/{self.prefix}/{self.file_name}"
 
         # Canonical string with all necessary fields
@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import asyncio
+from classes.async_http_client import get_async_http_client, run_sync
+from classes.resilience import shared_resilience
+
+
+class AsyncAzureOpenAIBatchManager:
+    final_statuses = ['completed', 'failed', 'expired', 'cancelled']
+
+    def __init__(self, endpoint, key, api_version, deployment_name, temperature, app_logging, http_client=None,
+                 poll_interval=60.0, deadline=24 * 3600.0, resilience=None):
+        """
+        Client for the Azure OpenAI Batch API: upload a JSONL file of chat completion requests, create a batch job,
+        poll it until it finishes and download the results. Batch jobs are billed at batch pricing and use their
+        own quota, so they do not compete with interactive requests.
+
+        :param endpoint: Azure OpenAI endpoint, e.g. https://xxxxx.openai.azure.com
+        :param deployment_name: A deployment of the Global-Batch (or Data Zone Batch) type.
+        :param poll_interval: Seconds between polls of the batch status.
+        :param deadline: Seconds wait_for_batch waits for a final status before it gives up.
+        """
+        self.endpoint = endpoint.rstrip("/")
+        self.key = key
+        self.api_version = api_version
+        self.deployment_name = deployment_name
+        self.temperature = temperature
+        self.app_logging = app_logging
+        self.http_client = http_client
+        self.poll_interval = poll_interval
+        self.deadline = deadline
+        self.headers = {"api-key": self.key}
+        self.resilience = resilience or shared_resilience
+
+
+    #use the client passed in, or the shared client of the running event loop
+    def _get_http_client(self):
+        return self.http_client or get_async_http_client()
+
+
+    #send a request with the shared timeouts, retries and circuit breaker of Azure OpenAI. Uploads and batch creation
+    #use the openai_batch_submit endpoint, which is not retried after a timeout so a batch is never created twice
+    async def _request(self, method, url, endpoint="openai_batch", **kwargs):
+        return await self.resilience.request(self._get_http_client(), endpoint, method, url, self.app_logging, headers=self.headers, **kwargs)
+
+
+    def _url(self, path):
+        return f"{self.endpoint}/openai/{path}?api-version={self.api_version}"
+
+
+    #one line of the batch input file per chat completion request
+    def build_request_lines(self, requests):
+        """
+        :param requests: (custom_id, messages) pairs, where messages is a list of {"role": ..., "content": ...} dicts.
+        :return: The JSONL content of the batch input file.
+        """
+        lines = []
+        for custom_id, messages in requests:
+            body = {"model": self.deployment_name, "messages": messages}
+            if self.temperature is not None:
+                body["temperature"] = float(self.temperature)
+            lines.append(json.dumps({"custom_id": custom_id, "method": "POST", "url": "/chat/completions", "body": body}))
+        return "\n".join(lines) + "\n"
+
+
+    async def upload_file(self, content, file_name):
+        try:
+            response = await self._request("POST", self._url("files"), "openai_batch_submit", data={"purpose": "batch"},
+                                           files={"file": (file_name, content.encode("utf-8"), "application/jsonl")})
+            response.raise_for_status()
+            return response.json()["id"]
+        except Exception as e:
+            self.app_logging.error(f"Error uploading batch input file: {e}")
+            return None
+
+
+    async def create_batch(self, input_file_id, completion_window="24h"):
+        try:
+            payload = {"input_file_id": input_file_id, "endpoint": "/chat/completions", "completion_window": completion_window}
+            response = await self._request("POST", self._url("batches"), "openai_batch_submit", json=payload)
+            response.raise_for_status()
+            return response.json()
+        except Exception as e:
+            self.app_logging.error(f"Error creating batch: {e}")
+            return None
+
+
+    #write the requests to a local JSONL file, upload it and create a batch job for it, returning the batch
+    async def submit(self, requests, file_path):
+        content = self.build_request_lines(requests)
+        with open(file_path, "w") as f:
+            f.write(content)
+        input_file_id = await self.upload_file(content, os.path.basename(file_path))
+        if input_file_id is None:
+            return None
+        batch = await self.create_batch(input_file_id)
+        if batch is not None:
+            self.app_logging.info(f"Created batch {batch['id']} with {len(requests)} requests")
+        return batch
+
+
+    async def get_batch(self, batch_id):
+        try:
+            response = await self._request("GET", self._url(f"batches/{batch_id}"))
+            response.raise_for_status()
+            return response.json()
+        except Exception as e:
+            self.app_logging.error(f"Error getting batch {batch_id}: {e}")
+            return None
+
+
+    #poll the batch until it reaches a final status or the deadline passes, and return its last state
+    async def wait_for_batch(self, batch_id):
+        start = time.monotonic()
+        while True:
+            batch = await self.get_batch(batch_id)
+            if batch is not None and batch.get("status") in self.final_statuses:
+                return batch
+            if time.monotonic() - start > self.deadline:
+                self.app_logging.error(f"Batch {batch_id} did not finish within {self.deadline}s")
+                return batch
+            self.app_logging.debug(f"Batch {batch_id} is {batch.get('status') if batch else 'unknown'}, "
+                                   f"{(batch or {}).get('request_counts')}")
+            await asyncio.sleep(self.poll_interval)
+
+
+    async def download_file(self, file_id):
+        try:
+            response = await self._request("GET", self._url(f"files/{file_id}/content"))
+            response.raise_for_status()
+            return response.text
+        except Exception as e:
+            self.app_logging.error(f"Error downloading batch file {file_id}: {e}")
+            return None
+
+
+    async def get_results(self, batch):
+        """
+        Download the output of a finished batch. A batch that expired, was cancelled or failed can still have an
+        output file with the requests that ran before it stopped.
+
+        :return: A dict of custom_id to the message content of its response. Requests that failed or never ran are missing.
+        """
+        results = {}
+        if not batch.get("output_file_id"):
+            self.app_logging.error(f"Batch {batch.get('id')} has no output file (status {batch.get('status')})")
+        else:
+            content = await self.download_file(batch["output_file_id"])
+            for line in (content or "").splitlines():
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                response = record.get("response") or {}
+                if record.get("error") or response.get("status_code") != 200:
+                    self.app_logging.error(f"Batch request {record.get('custom_id')} failed: {record.get('error') or response.get('body')}")
+                    continue
+                results[record["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+
+        if batch.get("error_file_id"):
+            for line in ((await self.download_file(batch["error_file_id"])) or "").splitlines():
+                if line.strip():
+                    record = json.loads(line)
+                    self.app_logging.error(f"Batch request {record.get('custom_id')} failed: {record.get('error') or record.get('response')}")
+        return results
+
+
+class AzureOpenAIBatchManager:
+    """Synchronous wrapper around AsyncAzureOpenAIBatchManager for callers that do not run an event loop."""
+    def __init__(self, endpoint, key, api_version, deployment_name, temperature, app_logging, poll_interval=60.0, deadline=24 * 3600.0):
+        self.async_manager = AsyncAzureOpenAIBatchManager(endpoint, key, api_version, deployment_name, temperature, app_logging,
+                                                          poll_interval=poll_interval, deadline=deadline)
+
+
+    def submit(self, requests, file_path):
+        return run_sync(self.async_manager.submit(requests, file_path))
+
+
+    def get_batch(self, batch_id):
+        return run_sync(self.async_manager.get_batch(batch_id))
+
+
+    def wait_for_batch(self, batch_id):
+        return run_sync(self.async_manager.wait_for_batch(batch_id))
+
+
+    def get_results(self, batch):
+        return run_sync(self.async_manager.get_results(batch))
@@ -0,0 +1,202 @@
+import os
+import gzip
+import json
+import time
+import threading
+import importlib.util
+
+OUTPUT_MODES = ["files", "jsonl"]
+OUTPUT_NAMINGS = ["source", "hash"]
+
+#hex characters of the file hash in front of a source file name, enough to keep different CVs apart
+SOURCE_NAME_HASH_LENGTH = 12
+
+
+class CvOutputWriter:
+    def __init__(self, output_dir, app_logging, mode="files", naming="source", jsonl_path=None, export_path=None, buffer_records=1000):
+        """
+        Writes the extracted CV details, either as one JSON file per CV or as records appended to one JSON Lines file.
+
+        :param output_dir: Folder for the per-CV JSON files.
+        :param mode: "files" writes one JSON file per CV with an atomic rename, "jsonl" appends one line per CV to jsonl_path.
+        :param naming: Name the per-CV files after the source file, prefixed with the start of its SHA-256 so files with
+                       the same name in different folders do not collide ("source"), or after the full SHA-256 ("hash").
+        :param jsonl_path: The JSON Lines file for the "jsonl" mode. Defaults to cv_details.jsonl in output_dir.
+        :param export_path: Optional extra copy of every record, as gzip compressed NDJSON (.gz) or Parquet (.parquet).
+        :param buffer_records: Number of records buffered before they are written to the JSON Lines file or export.
+        """
+        if mode not in OUTPUT_MODES:
+            raise ValueError(f"Unknown output mode {mode}, expected one of {OUTPUT_MODES}")
+        if naming not in OUTPUT_NAMINGS:
+            raise ValueError(f"Unknown output naming {naming}, expected one of {OUTPUT_NAMINGS}")
+        #pyarrow is optional, it is only needed for the Parquet export and only imported once that is written
+        if export_path and export_path.endswith(".parquet") and importlib.util.find_spec("pyarrow") is None:
+            raise ValueError("The Parquet export needs pyarrow, install it or export to .ndjson.gz instead")
+
+        self.output_dir = output_dir
+        self.app_logging = app_logging
+        self.mode = mode
+        self.naming = naming
+        self.jsonl_path = jsonl_path or os.path.join(output_dir, "cv_details.jsonl")
+        self.export_path = export_path
+        self.buffer_records = buffer_records
+        self.lock = threading.Lock()
+
+        #records waiting to be appended, each with the job key it belongs to, and the open export file
+        self.jsonl_buffer = []
+        self.export_buffer = []
+        self.export_file = None
+        self.parquet_writer = None
+
+        #job key: [number of buffers its record still waits in, output file], and the jobs whose records are all written
+        self.pending_jobs = {}
+        self.written_jobs = []
+
+
+    def write(self, cv_details, file_name, file_hash=None, unique_key=None, job_key=None):
+        """
+        Write the CV details of one source file. In the "jsonl" mode and for the export the record is only buffered,
+        so its job is handed back once the record has been flushed, not when it is passed in.
+
+        :param job_key: Key of the CV's job in the job store, or None.
+        :return: The path of the file the CV details are written to, and a list of (job_key, output_file) of the jobs
+                 whose records are now written, which can include this one and records buffered earlier.
+        """
+        record = {
+            "file_name": file_name,
+            "file_hash": file_hash,
+            "unique_key": unique_key,
+            "processed_at": round(time.time(), 3),
+            "cv_details": cv_details,
+        }
+        output_file = self._write_file(cv_details, file_name, file_hash) if self.mode == "files" else self.jsonl_path
+
+        with self.lock:
+            buffers = (self.mode == "jsonl") + bool(self.export_path)
+            if job_key is not None:
+                if buffers:
+                    self.pending_jobs[job_key] = [buffers, output_file]
+                else:
+                    self.written_jobs.append((job_key, output_file))
+            if self.mode == "jsonl":
+                self.jsonl_buffer.append((json.dumps(record), job_key))
+                if len(self.jsonl_buffer) >= self.buffer_records:
+                    self._flush_jsonl()
+            if self.export_path:
+                self.export_buffer.append((record, job_key))
+                if len(self.export_buffer) >= self.buffer_records:
+                    self._flush_export()
+            return output_file, self._take_written_jobs()
+
+
+    #write everything that is buffered, e.g. at the end of a batch, and return the (job_key, output_file) of the
+    #jobs whose records are now written
+    def flush(self):
+        with self.lock:
+            self._flush_jsonl()
+            self._flush_export()
+            return self._take_written_jobs()
+
+
+    #flush, then close the export. A Parquet file is only readable once it is closed
+    def close(self):
+        with self.lock:
+            self._flush_jsonl()
+            self._flush_export()
+            if self.parquet_writer is not None:
+                self.parquet_writer.close()
+                self.parquet_writer = None
+            if self.export_file is not None:
+                self.export_file.close()
+                self.export_file = None
+            return self._take_written_jobs()
+
+
+    #count a flushed record of a job, which is written once it is out of every buffer. Runs inside the lock
+    def _record_flushed(self, job_key):
+        pending = self.pending_jobs.get(job_key)
+        if pending is None:
+            return
+        pending[0] -= 1
+        if pending[0] == 0:
+            del self.pending_jobs[job_key]
+            self.written_jobs.append((job_key, pending[1]))
+
+
+    #hand back the written jobs once. Runs inside the lock
+    def _take_written_jobs(self):
+        written_jobs = self.written_jobs
+        self.written_jobs = []
+        return written_jobs
+
+
+    #write the JSON to a temporary file next to the target and rename it, so readers never see a partial file
+    def _write_file(self, cv_details, file_name, file_hash):
+        source_name = os.path.basename(file_name.replace("\\", "/"))
+        if self.naming == "hash" and file_hash:
+            output_name = file_hash
+        elif file_hash:
+            #the extension is kept, so 1.png and 1.pdf do not share a name either
+            output_name = f"{file_hash[:SOURCE_NAME_HASH_LENGTH]}_{source_name}"
+        else:
+            output_name = source_name
+        output_file = os.path.join(self.output_dir, f"{output_name}.json")
+        temp_file = f"{output_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(temp_file, "w") as f:
+            json.dump(cv_details, f, indent=2)
+        os.replace(temp_file, output_file)
+        return output_file
+
+
+    #append the buffered lines to the JSON Lines file in one write
+    def _flush_jsonl(self):
+        if not self.jsonl_buffer:
+            return
+        if os.path.dirname(self.jsonl_path):
+            os.makedirs(os.path.dirname(self.jsonl_path), exist_ok=True)
+        with open(self.jsonl_path, "a") as f:
+            f.write("\n".join(line for line, job_key in self.jsonl_buffer) + "\n")
+        for line, job_key in self.jsonl_buffer:
+            self._record_flushed(job_key)
+        self.jsonl_buffer = []
+
+
+    #append the buffered records to the export, as one gzip member or one Parquet row group
+    def _flush_export(self):
+        if not self.export_buffer:
+            return
+        records = [record for record, job_key in self.export_buffer]
+        try:
+            if os.path.dirname(self.export_path):
+                os.makedirs(os.path.dirname(self.export_path), exist_ok=True)
+
+            if self.export_path.endswith(".parquet"):
+                import pyarrow
+                import pyarrow.parquet
+
+                #CV details differ per prompt, so they are stored as a JSON string column
+                table = pyarrow.table({
+                    "file_name": [record["file_name"] for record in records],
+                    "file_hash": [record["file_hash"] for record in records],
+                    "unique_key": [record["unique_key"] for record in records],
+                    "processed_at": [record["processed_at"] for record in records],
+                    "cv_details": [json.dumps(record["cv_details"]) for record in records],
+                })
+                if self.parquet_writer is None:
+                    self.parquet_writer = pyarrow.parquet.ParquetWriter(self.export_path, table.schema, compression="zstd")
+                self.parquet_writer.write_table(table)
+            else:
+                if self.export_file is None:
+                    self.export_file = gzip.open(self.export_path, "at", encoding="utf-8")
+                self.export_file.write("".join(json.dumps(record) + "\n" for record in records))
+                self.export_file.flush()
+            for record, job_key in self.export_buffer:
+                self._record_flushed(job_key)
+        except Exception as e:
+            #the jobs are not handed back, so they keep their CV details and a rerun writes them again
+            self.app_logging.error(f"Error writing the output export: {e}")
+            for record, job_key in self.export_buffer:
+                self.pending_jobs.pop(job_key, None)
+        self.export_buffer = []
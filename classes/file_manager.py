@@ -1,6 +1,17 @@
-import io
-import magic
-from PIL import Image
+import os
+import mmap
+import hashlib
+import threading
+
+#the file type is detected from this many leading bytes
+HEADER_SIZE = 8 * 1024
+
+#brands in the ftyp box of HEIF/HEIC files
+HEIF_BRANDS = [b'heic', b'heix', b'hevc', b'hevx', b'heim', b'heis', b'mif1', b'msf1']
+
+#loading the libmagic database is expensive, so one handle is created per process and shared behind a lock
+_magic_handle = None
+_magic_lock = threading.Lock()
 
 
 class FileManager:
@@ -12,17 +23,37 @@ class FileManager:
     
     #get and then return the file type and its contents
     def get_file_type_and_contents(self):
-        file_contents = self._read_file()
-        if file_contents is not None:
-            self.file_type = self._check_if_image(file_contents)
+        self.get_file_type()
+        file_contents = self._read_file() if self.file_type is not None else None
+        return self.file_type, file_contents
+
+    
+    #get the file type by looking only at the header of the file, so large files are never fully loaded
+    def get_file_type(self):
+        header = self._read_header()
+        if header is not None:
+            self.file_type = self._check_signature(header)
 
             if self.file_type is None:
-                self.file_type = self._check_if_pdf(file_contents)
+                self.file_type = self._check_with_magic(header)
 
         if self.file_type is None:
             self.app_logging.error("Could not determine file type")
 
-        return self.file_type, file_contents
+        return self.file_type
+
+    
+    #sha256 of the file contents, read in chunks to keep memory bounded
+    def get_file_hash(self, chunk_size=1024 * 1024):
+        try:
+            file_hash = hashlib.sha256()
+            with open(self.file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b""):
+                    file_hash.update(chunk)
+            return file_hash.hexdigest()
+        except Exception as e:
+            self.app_logging.error(f"Could not hash the file: {e}")
+            return None
 
     
     #read file from disk
@@ -36,27 +67,51 @@ class FileManager:
             return None
 
     
-    #check if the file is an image using Pillow for accurate checking
-    def _check_if_image(self, data):
+    #memory-map the file and copy only its first HEADER_SIZE bytes
+    def _read_header(self):
         try:
-            image = Image.open(io.BytesIO(data))
-            file_type = image.format.lower()
-            if file_type == 'png':
-                return 'image/png'
-            elif file_type in ['jpeg', 'jpg']:
-                return 'image/jpeg'
-            return None
+            with open(self.file_path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return b""
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    return mapped[:HEADER_SIZE]
         except Exception as e:
+            self.app_logging.error(f"Could not read the file: {e}")
             return None
 
     
-    #check if file type is a PDF using the magic library
-    def _check_if_pdf(self, data):
+    #check the file type against the signatures of the formats we receive
+    def _check_signature(self, data):
+        if data.startswith(b'\x89PNG\r\n\x1a\n'):
+            return 'image/png'
+        elif data.startswith(b'\xff\xd8\xff'):
+            return 'image/jpeg'
+        elif data.startswith(b'II*\x00') or data.startswith(b'MM\x00*'):
+            return 'image/tiff'
+        elif data.startswith(b'BM') and len(data) >= 14:
+            return 'image/bmp'
+        elif data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+            return 'image/webp'
+        elif data[4:8] == b'ftyp' and data[8:12] in HEIF_BRANDS:
+            return 'image/heif'
+        elif b'%PDF-' in data[:1024]:
+            return 'application/pdf'
+        elif data.startswith(b'PK\x03\x04') and b'word/' in data:
+            return 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+        return None
+
+    
+    #fall back to libmagic for headers without a known signature, e.g. a DOCX whose word/ entries come later
+    def _check_with_magic(self, data):
+        global _magic_handle
         try:
-            mime = magic.Magic(mime=True)
-            file_type = mime.from_buffer(data)
-            if file_type == 'application/pdf':
-                return 'application/pdf'
+            with _magic_lock:
+                if _magic_handle is None:
+                    import magic
+                    _magic_handle = magic.Magic(mime=True)
+                file_type = _magic_handle.from_buffer(data)
+            if file_type in ['application/pdf', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document']:
+                return file_type
             return None
         except Exception as e:
             return None
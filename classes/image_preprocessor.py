@@ -0,0 +1,105 @@
+import os
+import asyncio
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+#image types that are worth shrinking before upload. Multi-page TIFFs are left alone
+PREPROCESS_FILE_TYPES = ['image/jpeg', 'image/png', 'image/bmp', 'image/tiff']
+
+
+#runs in a worker process, so it only takes and returns plain values
+def preprocess_image(file_path, output_path, max_long_edge, grayscale, jpeg_quality):
+    """
+    Rotate an image upright using its EXIF orientation, downscale it so its long edge is at most max_long_edge,
+    optionally convert it to grayscale, and save it as a JPEG.
+
+    :return: The size in bytes of the new file, or None if the image was skipped.
+    """
+    #imported here, so only the worker processes load Pillow
+    from PIL import Image, ImageOps
+
+    with Image.open(file_path) as image:
+        if getattr(image, "n_frames", 1) > 1:
+            return None
+
+        #let the JPEG decoder scale down by 1/2, 1/4 or 1/8 while decoding, which is much cheaper than a full decode
+        if image.format == "JPEG":
+            image.draft("L" if grayscale else "RGB", (max_long_edge, max_long_edge))
+        image = ImageOps.exif_transpose(image)
+
+        #flatten transparency onto white, otherwise transparent areas turn black
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGBA", image.size, (255, 255, 255, 255))
+            image = Image.alpha_composite(background, image)
+        image = image.convert("L" if grayscale else "RGB")
+
+        if max(image.size) > max_long_edge:
+            image.thumbnail((max_long_edge, max_long_edge), Image.LANCZOS)
+        image.save(output_path, format="JPEG", quality=jpeg_quality, optimize=True)
+    return os.path.getsize(output_path)
+
+
+class ImagePreprocessor:
+    def __init__(self, max_long_edge=3508, grayscale=True, jpeg_quality=85, min_bytes=512 * 1024, max_workers=None, temp_dir=None):
+        """
+        Shrinks photographed or scanned CVs before they are uploaded and OCR'd. The CPU work runs on a process pool,
+        so many images are processed in parallel across cores without blocking the event loop.
+
+        :param max_long_edge: Long edge in pixels after downscaling. 3508 is an A4 page at 300 DPI, which is plenty for OCR.
+        :param grayscale: Convert to grayscale, which OCR does not need colour for.
+        :param jpeg_quality: JPEG quality of the recompressed image.
+        :param min_bytes: Smaller files are uploaded as they are.
+        :param max_workers: Number of worker processes, defaults to the number of CPUs.
+        :param temp_dir: Folder for the preprocessed files, defaults to the system temp folder.
+        """
+        self.max_long_edge = max_long_edge
+        self.grayscale = grayscale
+        self.jpeg_quality = jpeg_quality
+        self.min_bytes = min_bytes
+        self.max_workers = max_workers
+        self.temp_dir = temp_dir
+        self.executor = None
+
+
+    #the pool is only started once the first image needs it. Forking a process that runs an event loop, threads and
+    #open connections can deadlock the child, so workers are started by a fork server, or spawned where there is none (Windows)
+    def _get_executor(self):
+        if self.executor is None:
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context(start_method))
+        return self.executor
+
+
+    async def preprocess(self, file_name, file_type, app_logging):
+        """
+        Preprocess an image on the process pool.
+
+        :return: (path, file type) of a smaller JPEG, which the caller deletes once it is uploaded, or None when the
+                 original file should be used, e.g. for PDFs, small files or images that would not get smaller.
+        """
+        original_bytes = os.path.getsize(file_name)
+        if file_type not in PREPROCESS_FILE_TYPES or original_bytes < self.min_bytes:
+            return None
+
+        file_descriptor, output_path = tempfile.mkstemp(suffix=".jpg", dir=self.temp_dir)
+        os.close(file_descriptor)
+        try:
+            new_bytes = await asyncio.get_running_loop().run_in_executor(self._get_executor(), preprocess_image, file_name, output_path,
+                                                                         self.max_long_edge, self.grayscale, self.jpeg_quality)
+        except Exception as e:
+            app_logging.warning(f"Could not preprocess the image, uploading the original: {e}")
+            new_bytes = None
+
+        if new_bytes is None or new_bytes >= original_bytes:
+            os.remove(output_path)
+            return None
+        app_logging.info(f"Preprocessed image from {original_bytes} to {new_bytes} bytes")
+        return output_path, 'image/jpeg'
+
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
@@ -0,0 +1,114 @@
+import os
+import time
+import sqlite3
+import threading
+
+#pipeline stages in order, a job records the last one it completed
+JOB_STAGES = ["received", "uploaded", "sas_issued", "ocr_submitted", "ocr_done", "llm_done", "saved"]
+
+#columns that can be written with checkpoint
+JOB_FIELDS = ["file_name", "file_hash", "blob_name", "sas_url", "sas_expires_at", "operation_location",
+              "ocr_text", "cv_details", "output_file", "error"]
+
+
+class JobStore:
+    def __init__(self, db_path, app_logging):
+        """
+        Durable record of where every document is in the pipeline, stored in a local SQLite file. Each checkpoint
+        is committed before the next stage starts, so a worker that is restarted after a crash can continue a
+        document from its last completed stage instead of paying for the upload, OCR and LLM calls again.
+
+        :param db_path: Path to the SQLite database file. The folder is created if it does not exist.
+        """
+        self.db_path = db_path
+        self.app_logging = app_logging
+        self.lock = threading.Lock()
+
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_key TEXT PRIMARY KEY,
+                stage TEXT NOT NULL,
+                file_name TEXT,
+                file_hash TEXT,
+                blob_name TEXT,
+                sas_url TEXT,
+                sas_expires_at REAL,
+                operation_location TEXT,
+                ocr_text TEXT,
+                cv_details TEXT,
+                output_file TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_stage ON jobs (stage)")
+        self.connection.commit()
+
+
+    #return the job as a dict, or None if it has never been seen
+    def get(self, job_key):
+        try:
+            with self.lock:
+                row = self.connection.execute("SELECT * FROM jobs WHERE job_key = ?", (job_key,)).fetchone()
+            return dict(row) if row is not None else None
+        except Exception as e:
+            self.app_logging.error(f"Error reading from job store: {e}")
+            return None
+
+
+    def checkpoint(self, job_key, stage=None, **fields):
+        """
+        Record that a job completed a stage, together with what is needed to resume after it.
+
+        :param job_key: Key of the job.
+        :param stage: The stage that was just completed, or None to only update fields.
+        :param fields: Values for any of the JOB_FIELDS columns. None clears a column.
+        """
+        unknown = set(fields) - set(JOB_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown job fields: {sorted(unknown)}")
+        if stage is not None and stage not in JOB_STAGES:
+            raise ValueError(f"Unknown job stage: {stage}")
+
+        try:
+            now = time.time()
+            columns = list(fields)
+            updates = ", ".join([f"{column} = excluded.{column}" for column in columns] +
+                                ["stage = COALESCE(?, stage)", "updated_at = excluded.updated_at"])
+            with self.lock:
+                self.connection.execute(
+                    f"INSERT INTO jobs (job_key, stage, {''.join(f'{column}, ' for column in columns)}created_at, updated_at) "
+                    f"VALUES (?, ?, {''.join('?, ' for column in columns)}?, ?) "
+                    f"ON CONFLICT (job_key) DO UPDATE SET {updates}",
+                    (job_key, stage or JOB_STAGES[0], *fields.values(), now, now, stage))
+                self.connection.commit()
+        except Exception as e:
+            self.app_logging.error(f"Error writing to job store: {e}")
+
+
+    #delete jobs that were not updated for ttl_seconds, finished or not, so the store does not grow forever
+    def prune(self, ttl_seconds):
+        try:
+            with self.lock:
+                deleted = self.connection.execute("DELETE FROM jobs WHERE updated_at < ?", (time.time() - ttl_seconds,)).rowcount
+                self.connection.commit()
+            if deleted:
+                self.app_logging.info(f"Pruned {deleted} jobs older than {ttl_seconds}s from the job store")
+        except Exception as e:
+            self.app_logging.error(f"Error pruning the job store: {e}")
+
+
+    #jobs that were started but never saved, oldest first
+    def unfinished(self):
+        try:
+            with self.lock:
+                rows = self.connection.execute("SELECT * FROM jobs WHERE stage != 'saved' ORDER BY created_at").fetchall()
+            return [dict(row) for row in rows]
+        except Exception as e:
+            self.app_logging.error(f"Error reading from job store: {e}")
+            return []
@@ -1,32 +1,144 @@
-from langchain_community.document_loaders import PyPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+import re
+from collections import Counter
 from io import BytesIO
+from classes.token_counter import count_tokens
+
+#lines that only hold a page marker, e.g. "Page 2", "Page 2 of 3", "2 of 3" or "- 2 -". Bare numbers such as "2019"
+#or "03/2020" are not matched, because in a CV they are employment dates
+PAGE_NUMBER_PATTERN = re.compile(r"^\W*(page\s*\d{1,3}(\s*(of|/)\s*\d{1,3})?|\d{1,3}\s*of\s*\d{1,3}|[-\u2013\u2014]\s*\d{1,3}\s*[-\u2013\u2014])\W*$",
+                                 re.IGNORECASE)
+
+#a page reference inside a longer line
+PAGE_REFERENCE_PATTERN = re.compile(r"page\s*\d+(\s*(of|/)\s*\d+)?")
+
+#separates the pages of an extracted text, so headers and footers can be told apart from lines in the body of a page
+PAGE_BREAK = "\f"
+
+#a year, so repeated lines with dates, e.g. two roles held in the same years, are never dropped as headers or footers
+YEAR_PATTERN = re.compile(r"\b(19|20)\d{2}\b")
 
 
 class LangchainChunkManager:
-    def __init__(self, file_contents, file_type, app_logging):
+    def __init__(self, file_contents, file_type, app_logging, max_chunk_tokens=None, model_name="gpt-4o", overlap_ratio=0.05,
+                 strip_layout_noise=False, min_repeated_lines=3, min_repeated_line_length=20, page_edge_lines=3):
         """
         Initialize LangchainManager.
 
-        :param file_contents: The binary contents of the file (PDF or text).
+        :param file_contents: The binary contents of the file (PDF or text), or the path of a PDF file on disk.
         :param file_type: The type of the input ("pdf" or "text").
+        :param max_chunk_tokens: Token budget per chunk. Text that fits is sent as one chunk. None keeps the old 30000 character chunks.
+        :param model_name: Model or deployment name used to pick the tokenizer.
+        :param overlap_ratio: Fraction of max_chunk_tokens repeated between neighbouring chunks.
+        :param strip_layout_noise: Remove page numbers and repeated header/footer lines before chunking.
+        :param min_repeated_lines: A line that occurs this many times is treated as a header or footer.
+        :param min_repeated_line_length: Shorter repeated lines, such as section titles, are kept.
+        :param page_edge_lines: Only this many lines at the top and bottom of each page can be a header or footer.
         """
         self.file_contents = file_contents
         self.file_type = file_type
         self.app_logging = app_logging
         self.chunk_size = 30000 #number of characters
+        self.max_chunk_tokens = max_chunk_tokens
+        self.model_name = model_name
+        self.overlap_ratio = overlap_ratio
+        self.strip_layout_noise = strip_layout_noise
+        self.min_repeated_lines = min_repeated_lines
+        self.min_repeated_line_length = min_repeated_line_length
+        self.page_edge_lines = page_edge_lines
 
     
-    #get text from PDF binary contents
+    #get the text of every page from PDF binary contents or path (PyPDFLoader only accepts a file path, so read with pypdf directly)
+    def _extract_pages_from_pdf(self):
+        from pypdf import PdfReader
+        source = BytesIO(self.file_contents) if isinstance(self.file_contents, bytes) else self.file_contents
+        reader = PdfReader(source)
+        return [page.extract_text() or "" for page in reader.pages]
+
+
+    #get text from PDF binary contents or path, with a page break between the pages
     def _extract_text_from_pdf(self):
-        loader = PyPDFLoader(BytesIO(self.file_contents))
-        documents = loader.load()
-        return " ".join([doc.page_content for doc in documents])
+        return PAGE_BREAK.join(self._extract_pages_from_pdf())
+
+    
+    #get the PDF text layer if it is good enough to skip OCR, otherwise None. Every page is checked, because a CV
+    #that is typed on page 1 and has scanned pages after it still needs OCR for those pages
+    def get_pdf_text_layer(self, min_chars=200, min_printable_ratio=0.9, min_page_chars=50):
+        try:
+            pages = [page.strip() for page in self._extract_pages_from_pdf()]
+        except Exception as e:
+            self.app_logging.warning(f"Could not read the PDF text layer: {e}")
+            return None
+        text = PAGE_BREAK.join(pages)
+
+        #scanned PDFs have no text layer, and PDFs with broken font maps produce mostly unprintable characters
+        if len(text) < min_chars:
+            self.app_logging.info(f"PDF text layer has {len(text)} characters, falling back to OCR")
+            return None
+        for page_number, page in enumerate(pages, start=1):
+            if len(page) < min_page_chars:
+                self.app_logging.info(f"PDF text layer has {len(page)} characters on page {page_number} of {len(pages)}, falling back to OCR")
+                return None
+        printable_ratio = sum(1 for c in text if c.isprintable() or c.isspace()) / len(text)
+        if printable_ratio < min_printable_ratio:
+            self.app_logging.info(f"PDF text layer is only {printable_ratio:.0%} printable, falling back to OCR")
+            return None
+        return text
+
+    
+    #drop page numbers and headers/footers repeated on every page (keeping their first occurrence), and collapse whitespace.
+    #Only lines at the top or bottom of a page are compared, so a line repeated in the body, such as the same tools
+    #listed under every job, is kept. A text without page breaks is one page, which has no repeated headers
+    def _strip_layout_noise(self, text):
+        pages = [[re.sub(r"[ \t]+", " ", line).strip() for line in page.splitlines()] for page in text.split(PAGE_BREAK)]
+
+        #footers such as "Jane Doe - Page 2" differ per page, so their page numbers are masked before lines are compared
+        edges = []
+        for lines in pages:
+            positions = [index for index, line in enumerate(lines) if line]
+            edge_positions = set(positions[:self.page_edge_lines] + positions[-self.page_edge_lines:])
+            edges.append({index: PAGE_REFERENCE_PATTERN.sub("page #", lines[index].lower()) for index in edge_positions})
+        counts = Counter(key for page_edges in edges for key in page_edges.values())
+
+        seen = set()
+        kept = []
+        for lines, page_edges in zip(pages, edges):
+            for index, line in enumerate(lines):
+                if PAGE_NUMBER_PATTERN.match(line):
+                    continue
+                key = page_edges.get(index)
+                if key is not None and counts[key] >= self.min_repeated_lines and len(line) >= self.min_repeated_line_length \
+                        and not YEAR_PATTERN.search(line):
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                kept.append(line)
+
+        cleaned = re.sub(r"\n{3,}", "\n\n", "\n".join(kept)).strip()
+        self.app_logging.debug(f"Layout noise removed {len(text) - len(cleaned)} of {len(text)} characters")
+        return cleaned
+
+
+    #token count of a text with the deployment's tokenizer
+    def _count_tokens(self, text):
+        return count_tokens(text, self.model_name)
 
     
     #slit text to make it manageable for the LLM
     def _split_text(self, text):
-        splitter = RecursiveCharacterTextSplitter(chunk_size=self.chunk_size, chunk_overlap=self.chunk_size * 0.15, separators=["\n", ". "])
+        #langchain is slow to import, so it is only loaded when a text is actually split
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+        if self.max_chunk_tokens is None:
+            splitter = RecursiveCharacterTextSplitter(chunk_size=self.chunk_size, chunk_overlap=self.chunk_size * 0.15, separators=["\n", ". "])
+            return splitter.split_text(text)
+
+        #most CVs fit the context window, and then one chunk means one LLM call and no overlap tokens
+        if self._count_tokens(text) <= self.max_chunk_tokens:
+            return [text]
+        splitter = RecursiveCharacterTextSplitter(chunk_size=self.max_chunk_tokens,
+                                                  chunk_overlap=int(self.max_chunk_tokens * self.overlap_ratio),
+                                                  length_function=self._count_tokens,
+                                                  separators=["\n\n", "\n", ". ", " "])
         return splitter.split_text(text)
 
     
@@ -37,6 +149,10 @@ class LangchainChunkManager:
                 text = self._extract_text_from_pdf()
             elif self.file_type == "text":
                 text = self.file_contents
+            if self.strip_layout_noise:
+                text = self._strip_layout_noise(text)
+            else:
+                text = text.replace(PAGE_BREAK, "\n")
             return self._split_text(text)
         except Exception as e:
             self.app_logging.error(f"Error processing langchain chunk text: {e}")
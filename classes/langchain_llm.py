@@ -1,11 +1,24 @@
-from langchain_openai import AzureChatOpenAI
-from langchain.prompts import ChatPromptTemplate
-from langchain.schema import HumanMessage
+import json
+import asyncio
+from classes.token_counter import count_tokens
+from classes.resilience import DependencyUnavailableError
 
 class LangchainLLMManager:
-    def __init__(self, prompt, text, endpoint, deployment_name, api_version, key, temperature, max_tokens, app_logger):
+    def __init__(self, prompt, endpoint, deployment_name, api_version, key, temperature, max_tokens, app_logger, http_async_client=None, max_concurrency=8,
+                 rate_limiter=None, max_retries=5, completion_token_estimate=1000, resilience=None):
+        """
+        Long-lived Azure OpenAI client, meant to be created once per process and shared across documents.
+
+        :param prompt: The system prompt. It is compiled into a prompt template once.
+        :param http_async_client: Shared httpx.AsyncClient, so all LLM calls reuse one connection pool.
+        :param max_concurrency: Maximum number of requests in flight to the deployment at once.
+        :param rate_limiter: Shared AzureOpenAIRateLimiter that keeps requests within the TPM/RPM quota, or None.
+        :param max_retries: How many times a request that got a 429 response is retried after its retry-after period.
+        :param completion_token_estimate: Completion tokens assumed per request when max_tokens is not set.
+        :param resilience: Shared ResilienceManager. Its "llm" policy sets the request timeout and how often timeouts and
+                           5xx responses are retried, and its circuit breaker fails requests fast while Azure OpenAI is down.
+        """
         self.prompt = prompt
-        self.text = text
         self.endpoint = endpoint
         self.deployment_name = deployment_name
         self.api_version = api_version
@@ -13,38 +26,198 @@ class LangchainLLMManager:
         self.temperature = temperature
         self.max_tokens = max_tokens
         self.app_logger = app_logger
+        self.http_async_client = http_async_client
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.completion_token_estimate = completion_token_estimate
+        self.resilience = resilience
+
+        #langchain and the openai SDK take a long time to import, so they are only loaded once an LLM client is
+        #actually needed, not when the module is imported. Runs that end early or only hit the cache skip them
+        from langchain.prompts import ChatPromptTemplate
+
+        #compile the system prompt once instead of on every call
+        self.prompt_template = ChatPromptTemplate.from_messages([
+            ("system", self.prompt.replace("{","").replace("}","")),
+            ("human", "{input}")
+        ])
 
         #get an instance of the azure OpenAI LLM
         self.llm = self._initialize_llm()
 
-    
+
     def _initialize_llm(self):
         try:
+            from langchain_openai import AzureChatOpenAI
             return AzureChatOpenAI(
                 azure_endpoint=self.endpoint,
                 api_version=self.api_version,
                 azure_deployment=self.deployment_name,
                 openai_api_key=self.key,
                 temperature=self.temperature,
-                max_tokens=self.max_tokens
+                max_tokens=self.max_tokens,
+                http_async_client=self.http_async_client,
+                timeout=self.resilience.policy("llm").timeout if self.resilience is not None else None,
+                max_retries=0 #429s are retried here, in step with the shared rate limiter
             )
         except Exception as e:
             self.app_logger.error(f"Error initializing LLM: {e}")
             return None
 
-    
-    #generate a response from the LLM using the provided prompt and text
-    def generate_response(self):
+
+    #build the chat messages from the compiled prompt and the given text
+    def _build_messages(self, text):
+        from langchain.schema import HumanMessage
+
+        #give the user input which will be the CV data
+        formatted_prompt = self.prompt_template.format_prompt(input=text)
+        return [HumanMessage(content=formatted_prompt.to_string())]
+
+
+    #the same messages as plain dicts, for requests that are not sent through langchain such as Batch API input files
+    def build_chat_messages(self, text):
+        return [{"role": "user", "content": message.content} for message in self._build_messages(text)]
+
+
+    #estimate the tokens a request counts against the quota: the prompt and CV text plus the expected completion
+    def _estimate_tokens(self, messages, completion_tokens=None):
+        prompt_tokens = sum(count_tokens(message.content, self.deployment_name) for message in messages)
+        return prompt_tokens + (self.max_tokens or completion_tokens or self.completion_token_estimate)
+
+
+    #get the wait time from a 429 response, preferring Azure's millisecond header
+    @staticmethod
+    def _get_retry_after(error, attempt):
+        headers = error.response.headers
+        try:
+            if headers.get("retry-after-ms") is not None:
+                return float(headers.get("retry-after-ms")) / 1000
+            if headers.get("retry-after") is not None:
+                return float(headers.get("retry-after"))
+        except ValueError:
+            pass
+        return float(2 ** attempt)
+
+
+    #parse the JSON object in an LLM response, which may be wrapped in a markdown code fence
+    @staticmethod
+    def parse_json_response(content):
+        content = content.strip()
+        if content.startswith("```"):
+            content = content.split("\n", 1)[1] if "\n" in content else ""
+            content = content.rsplit("```", 1)[0]
+        return json.loads(content)
+
+
+    #generate a response from the LLM using the compiled prompt and text
+    def generate_response(self, text, app_logger=None):
+        app_logger = app_logger or self.app_logger
         try:
-            prompt_template = ChatPromptTemplate.from_messages([
-                ("system", self.prompt.replace("{","").replace("}","")),
-                ("human", "{input}")
-            ])
-
-            #give the user input which will be the CV data
-            formatted_prompt = prompt_template.format_prompt(input=self.text)
-            response = self.llm([HumanMessage(content=formatted_prompt.to_string())])
+            response = self.llm(self._build_messages(text))
             return response.content
         except Exception as e:
-            self.app_logger.error(f"Error generating LLM response: {e}")
-            return None
\ No newline at end of file
+            app_logger.error(f"Error generating LLM response: {e}")
+            return None
+
+
+    #send one request within the rate limit. The reservation is given back when the request is not answered, so
+    #every attempt of a logical request holds its tokens only once and a request that fails holds none.
+    #Every outcome is recorded with the circuit breaker: any answer from the service, including a 4xx such as a
+    #429 or a content filter, means it is up, while 5xx responses, connection errors and other errors count as failures
+    async def _ainvoke(self, messages, estimated_tokens, app_logger):
+        from openai import APIStatusError
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire(estimated_tokens)
+        breaker, trial = None, False
+        try:
+            if self.resilience is not None:
+                breaker, trial = self.resilience.check_circuit("llm")
+            async with self.semaphore:
+                response = await self.llm.ainvoke(messages)
+            if breaker is not None:
+                breaker.record_success()
+            return response
+        except BaseException as e:
+            if self.rate_limiter is not None:
+                self.rate_limiter.release(estimated_tokens)
+            if breaker is not None:
+                if isinstance(e, APIStatusError) and e.status_code < 500:
+                    breaker.record_success()
+                elif isinstance(e, Exception):
+                    self.resilience.record_failure("llm", app_logger)
+            raise
+        finally:
+            #a cancelled trial records no outcome, but must not keep the half-open circuit closed to everyone forever
+            if trial:
+                breaker.release_trial()
+
+
+    #generate a response without blocking the event loop, using the shared async http client.
+    #completion_tokens overrides the completion estimate, e.g. for a request that packs several CVs
+    async def agenerate_response(self, text, app_logger=None, stats=None, completion_tokens=None):
+        app_logger = app_logger or self.app_logger
+        stats = stats if stats is not None else {}
+        from openai import RateLimitError, APIConnectionError, InternalServerError
+        try:
+            messages = self._build_messages(text)
+            estimated_tokens = self._estimate_tokens(messages, completion_tokens)
+            attempt, server_errors = 0, 0
+            while True:
+                try:
+                    response = await self._ainvoke(messages, estimated_tokens, app_logger)
+                except RateLimitError as e:
+                    if attempt == self.max_retries:
+                        raise
+                    retry_after = self._get_retry_after(e, attempt)
+                    attempt += 1
+                    stats["retries"] = stats.get("retries", 0) + 1
+                    app_logger.warning(f"Azure OpenAI returned 429, retrying in {retry_after}s (attempt {attempt} of {self.max_retries})")
+                    if self.rate_limiter is not None:
+                        self.rate_limiter.pause(retry_after)
+                    else:
+                        await asyncio.sleep(retry_after)
+                    continue
+                except (APIConnectionError, InternalServerError) as e:
+                    #timeouts, connection errors and 5xx responses are retried with backoff
+                    if self.resilience is None:
+                        raise
+                    policy = self.resilience.policy("llm")
+                    server_errors += 1
+                    if server_errors >= policy.max_attempts:
+                        raise DependencyUnavailableError("llm", f"{type(e).__name__} after {server_errors} attempts") from e
+                    delay = policy.next_delay(server_errors - 1)
+                    stats["retries"] = stats.get("retries", 0) + 1
+                    app_logger.warning(f"Azure OpenAI failed with {type(e).__name__}, retrying in {delay:.1f}s "
+                                       f"(attempt {server_errors} of {policy.max_attempts})")
+                    await asyncio.sleep(delay)
+                    continue
+
+                if response.usage_metadata:
+                    stats["tokens"] = stats.get("tokens", 0) + response.usage_metadata.get("total_tokens", 0)
+                if self.rate_limiter is not None and response.usage_metadata:
+                    self.rate_limiter.record_usage(estimated_tokens, response.usage_metadata.get("total_tokens"))
+                return response.content
+        except DependencyUnavailableError:
+            raise
+        except Exception as e:
+            app_logger.error(f"Error generating LLM response: {e}")
+            return None
+
+
+    #send all chunks concurrently and return their parsed JSON in chunk order, or None if any chunk fails.
+    #token usage and 429 retries are added up in stats when a dict is passed
+    async def agenerate_json_responses(self, texts, app_logger=None, stats=None):
+        app_logger = app_logger or self.app_logger
+        responses = await asyncio.gather(*[self.agenerate_response(text, app_logger, stats) for text in texts])
+
+        results = []
+        for index, response in enumerate(responses):
+            if response is None:
+                return None
+            try:
+                results.append(self.parse_json_response(response))
+            except ValueError as e:
+                app_logger.error(f"LLM response for chunk {index} is not valid JSON: {e}")
+                return None
+        return results
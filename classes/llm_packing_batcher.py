@@ -0,0 +1,147 @@
+import asyncio
+from classes.token_counter import count_tokens
+from classes.resilience import DependencyUnavailableError
+
+#added in front of a packed request, so the model answers every CV separately with a keyed JSON array
+PACKING_INSTRUCTIONS = (
+    "The input below contains {count} separate CVs. Each CV starts with a line <<<CV id>>> and ends with a line <<<END CV id>>>.\n"
+    "Apply the instructions to every CV on its own, without mixing information between CVs.\n"
+    "Respond with only a JSON array with one element per CV, in the form {{\"id\": \"<CV id>\", \"result\": <the JSON object for that CV>}}.\n\n"
+)
+
+
+class LlmPackingBatcher:
+    def __init__(self, llm_manager, max_input_tokens, completion_tokens_per_document=1000, max_documents=5, max_wait_seconds=0.2):
+        """
+        Packs several short CVs into one LLM request, so the system prompt is billed once per request instead of once per CV.
+        CVs are collected until the request is full or max_wait_seconds passed since the first one arrived.
+
+        :param llm_manager: The LangchainLLMManager that sends the requests.
+        :param max_input_tokens: Tokens available per request for CV text plus the expected completions.
+        :param completion_tokens_per_document: Completion tokens reserved for the answer of each packed CV.
+        :param max_documents: Maximum number of CVs in one request.
+        :param max_wait_seconds: How long the first CV of a request waits for others to join it.
+        """
+        self.llm_manager = llm_manager
+        self.max_input_tokens = max_input_tokens
+        self.completion_tokens_per_document = completion_tokens_per_document
+        self.max_documents = max_documents
+        self.max_wait_seconds = max_wait_seconds
+
+        #CVs waiting for the next request: (text, tokens, future, app_logger, stats)
+        self.pending = []
+        self.pending_tokens = 0
+        self.flush_handle = None
+        self.tasks = set()
+
+
+    async def extract(self, text, app_logger=None, stats=None):
+        """
+        Extract the JSON result of one CV, packed together with other CVs that arrive at about the same time.
+
+        :return: The parsed JSON result of this CV, or None if it failed.
+        :raises DependencyUnavailableError: When Azure OpenAI is unavailable, as an unpacked request would.
+        """
+        loop = asyncio.get_running_loop()
+        tokens = count_tokens(text, self.llm_manager.deployment_name) + self.completion_tokens_per_document
+
+        #start a new request if this CV would not fit in the current one
+        if self.pending and self.pending_tokens + tokens > self.max_input_tokens:
+            self._flush()
+
+        future = loop.create_future()
+        self.pending.append((text, tokens, future, app_logger or self.llm_manager.app_logger, stats))
+        self.pending_tokens += tokens
+        if len(self.pending) >= self.max_documents:
+            self._flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.max_wait_seconds, self._flush)
+        return await future
+
+
+    #send the pending CVs as one request in the background
+    def _flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.pending:
+            return
+        batch = self.pending
+        self.pending = []
+        self.pending_tokens = 0
+
+        task = asyncio.get_running_loop().create_task(self._send(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+
+    #build the request text with every CV between its own markers
+    @staticmethod
+    def _pack(texts):
+        parts = [PACKING_INSTRUCTIONS.format(count=len(texts))]
+        for index, text in enumerate(texts):
+            parts.append(f"<<<CV cv{index + 1}>>>\n{text}\n<<<END CV cv{index + 1}>>>\n")
+        return "\n".join(parts)
+
+
+    #split a packed response into the results of the CVs, or None if it does not have exactly one result per CV
+    @staticmethod
+    def _unpack(content, count, parse_json_response):
+        try:
+            parsed = parse_json_response(content)
+        except ValueError:
+            return None
+        if isinstance(parsed, dict) and len(parsed) == 1 and isinstance(next(iter(parsed.values())), list):
+            parsed = next(iter(parsed.values()))
+        if not isinstance(parsed, list):
+            return None
+
+        results = {str(item.get("id")): item.get("result") for item in parsed if isinstance(item, dict)}
+        ordered = [results.get(f"cv{index + 1}") for index in range(count)]
+        if any(result is None for result in ordered):
+            return None
+        return ordered
+
+
+    #send one CV on its own and return its parsed JSON, or None
+    async def _send_single(self, text, app_logger, stats):
+        results = await self.llm_manager.agenerate_json_responses([text], app_logger, stats)
+        return results[0] if results else None
+
+
+    async def _send(self, batch):
+        texts = [item[0] for item in batch]
+        app_logger = batch[0][3]
+        try:
+            if len(batch) == 1:
+                results = [await self._send_single(texts[0], app_logger, batch[0][4])]
+            else:
+                packed_stats = {}
+                content = await self.llm_manager.agenerate_response(self._pack(texts), app_logger, packed_stats,
+                                                                    completion_tokens=self.completion_tokens_per_document * len(batch))
+                results = self._unpack(content, len(batch), self.llm_manager.parse_json_response) if content is not None else None
+
+                #share the tokens of the packed request between its CVs, in proportion to their size
+                total_tokens = sum(item[1] for item in batch)
+                for text, tokens, future, logger, stats in batch:
+                    if stats is not None:
+                        stats["packed_documents"] = len(batch)
+                        stats["tokens"] = stats.get("tokens", 0) + round(packed_stats.get("tokens", 0) * tokens / total_tokens)
+                        stats["retries"] = stats.get("retries", 0) + packed_stats.get("retries", 0)
+
+                if results is None:
+                    app_logger.warning(f"Packed response for {len(batch)} CVs could not be split per CV, sending them one by one")
+                    results = await asyncio.gather(*[self._send_single(text, logger, stats) for text, tokens, future, logger, stats in batch])
+        except DependencyUnavailableError as e:
+            #every CV of the request failed for the same reason, so each caller gets it like an unpacked request would
+            for text, tokens, future, logger, stats in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        except Exception as e:
+            app_logger.error(f"Error sending packed LLM request: {e}")
+            results = [None] * len(batch)
+
+        for (text, tokens, future, logger, stats), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
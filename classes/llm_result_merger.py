@@ -0,0 +1,107 @@
+import re
+import json
+
+#a numeric field with this name on an object ranks it against conflicting objects from other chunks
+CONFIDENCE_FIELD = "confidence"
+
+
+#values that carry no information and never win over a real value
+def _is_empty(value):
+    return value is None or value == "" or value == [] or value == {}
+
+
+#compare scalars without caring about case, surrounding whitespace or repeated spaces
+def _normalize(value):
+    if isinstance(value, str):
+        return re.sub(r"\s+", " ", value).strip().casefold()
+    return value
+
+
+#a hashable key that is equal for items that are the same after normalisation
+def _item_key(value):
+    if isinstance(value, dict):
+        return json.dumps({key: _item_key(item) for key, item in value.items() if not _is_empty(item)}, sort_keys=True, default=str)
+    if isinstance(value, list):
+        return json.dumps([_item_key(item) for item in value], default=str)
+    return json.dumps(_normalize(value), default=str)
+
+
+#two objects describe the same thing when all scalar fields they both fill in agree, and they share at least one
+def _same_entity(left, right):
+    shared = 0
+    for key, value in left.items():
+        other = right.get(key)
+        if key == CONFIDENCE_FIELD or _is_empty(value) or _is_empty(other) or isinstance(value, (dict, list)) or isinstance(other, (dict, list)):
+            continue
+        if _normalize(value) != _normalize(other):
+            return False
+        shared += 1
+    return shared > 0
+
+
+def _confidence(value):
+    if isinstance(value, dict) and isinstance(value.get(CONFIDENCE_FIELD), (int, float)):
+        return value[CONFIDENCE_FIELD]
+    return None
+
+
+#union of two lists in order of first appearance. Duplicates are dropped, and objects for the same entity
+#(e.g. one job split over two chunks) are merged into one
+def _merge_lists(left, right):
+    merged = list(left)
+    keys = {_item_key(item) for item in merged}
+    for item in right:
+        if _item_key(item) in keys:
+            continue
+        if isinstance(item, dict):
+            match = next((index for index, existing in enumerate(merged) if isinstance(existing, dict) and _same_entity(existing, item)), None)
+            if match is not None:
+                merged[match] = _merge_values(merged[match], item)
+                keys.add(_item_key(merged[match]))
+                continue
+        merged.append(item)
+        keys.add(_item_key(item))
+    return merged
+
+
+#merge the value from a later chunk into the value from an earlier one
+def _merge_values(left, right):
+    if _is_empty(left):
+        return right
+    if _is_empty(right):
+        return left
+
+    if isinstance(left, dict) and isinstance(right, dict):
+        #the object with the higher confidence wins scalar conflicts, otherwise the earlier chunk does
+        left_confidence, right_confidence = _confidence(left), _confidence(right)
+        if left_confidence is not None and right_confidence is not None and right_confidence > left_confidence:
+            merged = {key: _merge_values(right.get(key), value) for key, value in left.items()}
+            merged.update({key: value for key, value in right.items() if key not in left})
+            return merged
+        merged = {key: _merge_values(value, right.get(key)) for key, value in left.items()}
+        merged.update({key: value for key, value in right.items() if key not in left})
+        return merged
+
+    if isinstance(left, list) or isinstance(right, list):
+        return _merge_lists(left if isinstance(left, list) else [left], right if isinstance(right, list) else [right])
+
+    #scalar conflict: the earlier chunk wins
+    return left
+
+
+def merge_llm_results(results):
+    """
+    Merge the parsed JSON results of the chunks of one CV into a single result, without another LLM call.
+
+    Objects are merged key by key. Lists are unioned in order of first appearance with duplicates removed, and list
+    objects that describe the same entity are merged. Conflicting scalars are resolved by the "confidence" field of
+    their objects when both have one, otherwise the value from the earliest chunk is kept. The result only depends
+    on the chunk order, so the same chunks always give the same output.
+
+    :param results: Parsed JSON results in chunk order.
+    :return: The merged result, or None when there are no results.
+    """
+    merged = None
+    for result in results:
+        merged = result if merged is None else _merge_values(merged, result)
+    return merged
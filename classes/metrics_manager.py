@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from classes.audit_log_manager import log_stage
+
+
+class MetricsManager:
+    def __init__(self, jsonl_path=None, max_samples=10000):
+        """
+        Collects per-stage timings and counters for the CV pipeline.
+
+        :param jsonl_path: When set, every finished span is appended to this file as one JSON line.
+        :param max_samples: Number of most recent durations kept per stage for the percentiles.
+        """
+        self.jsonl_path = jsonl_path
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.durations = defaultdict(lambda: deque(maxlen=self.max_samples))
+        self.duration_sums = defaultdict(float)
+        self.duration_counts = defaultdict(int)
+        self.counters = defaultdict(float)
+
+        #spans are appended to a buffered file handle, flush() writes them out
+        self.jsonl_file = None
+        if self.jsonl_path:
+            if os.path.dirname(self.jsonl_path):
+                os.makedirs(os.path.dirname(self.jsonl_path), exist_ok=True)
+            self.jsonl_file = open(self.jsonl_path, "a")
+
+
+    #time the code in the with block as one stage of one document
+    @contextmanager
+    def span(self, unique_key, stage, **attributes):
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            #log records written inside the span carry its stage
+            with log_stage(stage):
+                yield attributes
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            self.record(unique_key, stage, time.perf_counter() - start, status, **attributes)
+
+
+    #record a stage duration that was measured elsewhere, e.g. OCR polling inside AsyncAzureDocIntel
+    def record(self, unique_key, stage, seconds, status="ok", **attributes):
+        with self.lock:
+            self.durations[stage].append(seconds)
+            self.duration_sums[stage] += seconds
+            self.duration_counts[stage] += 1
+
+            if self.jsonl_file is not None:
+                record = {"timestamp": time.time(), "unique_key": unique_key, "stage": stage,
+                          "seconds": round(seconds, 6), "status": status, **attributes}
+                self.jsonl_file.write(json.dumps(record) + "\n")
+
+
+    def flush(self):
+        if self.jsonl_file is not None:
+            with self.lock:
+                self.jsonl_file.flush()
+
+
+    #add to a counter such as bytes, tokens or retries of a stage
+    def increment(self, name, stage, value=1):
+        if value:
+            with self.lock:
+                self.counters[(name, stage)] += value
+
+
+    @staticmethod
+    def _percentile(sorted_values, percentile):
+        index = min(int(round(percentile * (len(sorted_values) - 1))), len(sorted_values) - 1)
+        return sorted_values[index]
+
+
+    #count, sum and p50/p95/p99 per stage, plus all counters
+    def summary(self):
+        with self.lock:
+            stages = {}
+            for stage, values in self.durations.items():
+                sorted_values = sorted(values)
+                stages[stage] = {
+                    "count": self.duration_counts[stage],
+                    "sum_seconds": round(self.duration_sums[stage], 6),
+                    "p50_seconds": round(self._percentile(sorted_values, 0.50), 6),
+                    "p95_seconds": round(self._percentile(sorted_values, 0.95), 6),
+                    "p99_seconds": round(self._percentile(sorted_values, 0.99), 6),
+                }
+            counters = {f"{name}.{stage}": value for (name, stage), value in self.counters.items()}
+        return {"stages": stages, "counters": counters}
+
+
+    #render the metrics in the Prometheus text exposition format
+    def to_prometheus(self):
+        summary = self.summary()
+        with self.lock:
+            counters = dict(self.counters)
+        lines = [
+            "# HELP cv_pipeline_stage_seconds Duration of each CV pipeline stage.",
+            "# TYPE cv_pipeline_stage_seconds summary",
+        ]
+        for stage, values in sorted(summary["stages"].items()):
+            for quantile in ["50", "95", "99"]:
+                lines.append(f'cv_pipeline_stage_seconds{{stage="{stage}",quantile="0.{quantile}"}} {values[f"p{quantile}_seconds"]}')
+            lines.append(f'cv_pipeline_stage_seconds_sum{{stage="{stage}"}} {values["sum_seconds"]}')
+            lines.append(f'cv_pipeline_stage_seconds_count{{stage="{stage}"}} {values["count"]}')
+
+        for name in sorted({name for (name, stage) in counters}):
+            lines.append(f"# TYPE cv_pipeline_{name}_total counter")
+            for (counter_name, stage), value in sorted(counters.items()):
+                if counter_name == name:
+                    lines.append(f'cv_pipeline_{name}_total{{stage="{stage}"}} {value:g}')
+        return "\n".join(lines) + "\n"
+
+
+    #write the Prometheus text to a file, e.g. for the node_exporter textfile collector
+    def write_prometheus(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(self.to_prometheus())
+        os.replace(temp_path, path)
@@ -0,0 +1,177 @@
+import os
+import re
+import time
+import random
+import sqlite3
+import hashlib
+import threading
+from array import array
+
+#a Mersenne prime larger than the 64 bit shingle hashes, for the MinHash permutations
+MERSENNE_PRIME = (1 << 61) - 1
+
+
+class NearDuplicateIndex:
+    def __init__(self, db_path, app_logging, threshold=0.95, num_permutations=128, bands=16, shingle_size=3,
+                 min_shingles=20, max_entries=100000):
+        """
+        MinHash/LSH index over the normalised OCR text of processed CVs, stored in a local SQLite file. It finds
+        earlier CVs with almost the same text, e.g. the same CV exported again as a PNG instead of a PDF, or with a
+        typo fixed, so their structured extraction can be reused instead of calling the LLM again.
+
+        :param db_path: Path to the SQLite database file. The folder is created if it does not exist.
+        :param threshold: Minimum estimated Jaccard similarity of the word shingles for a CV to count as a near-duplicate.
+        :param num_permutations: Number of MinHash values per CV. More values give a more precise estimate.
+        :param bands: Number of LSH bands the MinHash values are split into. Candidates share at least one band.
+        :param shingle_size: Number of words per shingle.
+        :param min_shingles: Shorter texts are not matched, because a few words are not enough to tell CVs apart.
+        :param max_entries: Once the index holds more CVs, the oldest are dropped.
+        """
+        if num_permutations % bands:
+            raise ValueError("num_permutations must be a multiple of bands")
+        self.db_path = db_path
+        self.app_logging = app_logging
+        self.threshold = threshold
+        self.num_permutations = num_permutations
+        self.bands = bands
+        self.rows_per_band = num_permutations // bands
+        self.shingle_size = shingle_size
+        self.min_shingles = min_shingles
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+        #fixed seed, so signatures stored by earlier runs stay comparable
+        generator = random.Random(1)
+        self.permutations = [(generator.randrange(1, MERSENNE_PRIME), generator.randrange(0, MERSENNE_PRIME))
+                             for _ in range(num_permutations)]
+
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS documents (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                scope TEXT NOT NULL,
+                file_hash TEXT NOT NULL,
+                file_name TEXT,
+                signature BLOB NOT NULL,
+                cv_details TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )""")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS bands (
+                scope TEXT NOT NULL,
+                band INTEGER NOT NULL,
+                bucket INTEGER NOT NULL,
+                document_id INTEGER NOT NULL
+            )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS bands_bucket ON bands (scope, band, bucket)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS bands_document_id ON bands (document_id)")
+        self.connection.commit()
+
+
+    #lower case words only, so OCR differences in punctuation, case, layout and whitespace do not matter
+    @staticmethod
+    def normalize(text):
+        return re.sub(r"[\W_]+", " ", text.casefold()).split()
+
+
+    #64 bit hashes of the word shingles of the text
+    def _shingle_hashes(self, text):
+        words = self.normalize(text)
+        shingles = {" ".join(words[index:index + self.shingle_size]) for index in range(max(len(words) - self.shingle_size + 1, 0))}
+        return [int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little") for shingle in shingles]
+
+
+    def signature(self, text):
+        """
+        MinHash signature of a text. CPU bound, so async callers should run it in a thread.
+
+        :return: A list of num_permutations integers, or None when the text has fewer than min_shingles shingles.
+        """
+        hashes = self._shingle_hashes(text or "")
+        if len(hashes) < self.min_shingles:
+            return None
+        return [min((a * value + b) % MERSENNE_PRIME for value in hashes) & 0xFFFFFFFF for a, b in self.permutations]
+
+
+    #one bucket per band: a hash of the signature values in that band
+    def _buckets(self, signature):
+        buckets = []
+        for band in range(self.bands):
+            values = array("I", signature[band * self.rows_per_band:(band + 1) * self.rows_per_band]).tobytes()
+            buckets.append((band, int.from_bytes(hashlib.blake2b(values, digest_size=7).digest(), "little")))
+        return buckets
+
+
+    #fraction of MinHash values two signatures share, an estimate of the Jaccard similarity of their shingles
+    @staticmethod
+    def similarity(left, right):
+        return sum(1 for a, b in zip(left, right) if a == b) / len(left)
+
+
+    def find(self, scope, signature):
+        """
+        Find the most similar earlier CV.
+
+        :param scope: Only CVs indexed with the same scope are matched, e.g. a hash of the prompt and model settings.
+        :param signature: MinHash signature from signature().
+        :return: A dict with the file_hash, file_name, cv_details (JSON text) and similarity of the best match at or
+                 above the threshold, or None.
+        """
+        if signature is None:
+            return None
+        try:
+            with self.lock:
+                candidate_ids = set()
+                for band, bucket in self._buckets(signature):
+                    rows = self.connection.execute("SELECT document_id FROM bands WHERE scope = ? AND band = ? AND bucket = ?",
+                                                   (scope, band, bucket)).fetchall()
+                    candidate_ids.update(row[0] for row in rows)
+                if not candidate_ids:
+                    return None
+                placeholders = ",".join("?" * len(candidate_ids))
+                rows = self.connection.execute(f"SELECT file_hash, file_name, signature, cv_details FROM documents WHERE id IN ({placeholders})",
+                                               list(candidate_ids)).fetchall()
+
+            best = None
+            for file_hash, file_name, stored_signature, cv_details in rows:
+                similarity = self.similarity(signature, array("I", stored_signature))
+                if similarity >= self.threshold and (best is None or similarity > best["similarity"]):
+                    best = {"file_hash": file_hash, "file_name": file_name, "cv_details": cv_details, "similarity": round(similarity, 4)}
+            return best
+        except Exception as e:
+            self.app_logging.warning(f"Near-duplicate lookup failed: {e}")
+            return None
+
+
+    def add(self, scope, signature, file_hash, file_name, cv_details):
+        """
+        Index the extraction of a CV so later near-duplicates can reuse it.
+
+        :param cv_details: The structured extraction as JSON text.
+        """
+        if signature is None:
+            return
+        try:
+            with self.lock:
+                cursor = self.connection.execute(
+                    "INSERT INTO documents (scope, file_hash, file_name, signature, cv_details, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (scope, file_hash, file_name, array("I", signature).tobytes(), cv_details, time.time()))
+                self.connection.executemany("INSERT INTO bands (scope, band, bucket, document_id) VALUES (?, ?, ?, ?)",
+                                            [(scope, band, bucket, cursor.lastrowid) for band, bucket in self._buckets(signature)])
+                self._evict()
+                self.connection.commit()
+        except Exception as e:
+            self.app_logging.warning(f"Could not add the CV to the near-duplicate index: {e}")
+
+
+    #drop the oldest CVs once the index holds more than max_entries. Runs inside the lock
+    def _evict(self):
+        count = self.connection.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+        if count <= self.max_entries:
+            return
+        cutoff = self.connection.execute("SELECT id FROM documents ORDER BY id LIMIT 1 OFFSET ?", (count - self.max_entries,)).fetchone()[0]
+        self.connection.execute("DELETE FROM bands WHERE document_id < ?", (cutoff,))
+        self.connection.execute("DELETE FROM documents WHERE id < ?", (cutoff,))
@@ -0,0 +1,75 @@
+import time
+import asyncio
+import threading
+
+
+class AzureOpenAIRateLimiter:
+    def __init__(self, tokens_per_minute=None, requests_per_minute=None):
+        """
+        Shared token bucket that keeps Azure OpenAI calls within the deployment's TPM and RPM quota.
+        Every caller reserves its capacity up front and then sleeps until the bucket has refilled,
+        so requests are queued in arrival order instead of bursting into 429s.
+
+        :param tokens_per_minute: Tokens per minute quota, or None to not limit tokens.
+        :param requests_per_minute: Requests per minute quota, or None to not limit requests.
+        """
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.available_tokens = float(tokens_per_minute or 0)
+        self.available_requests = float(requests_per_minute or 0)
+        self.blocked_until = 0.0
+        self.last_refill = time.monotonic()
+
+        #a thread lock rather than an asyncio lock, so one limiter can be shared across event loops
+        self.lock = threading.Lock()
+
+
+    #add the capacity that refilled since the last call, up to one minute of quota
+    def _refill(self, now):
+        elapsed_minutes = (now - self.last_refill) / 60
+        self.last_refill = now
+        if self.tokens_per_minute:
+            self.available_tokens = min(self.tokens_per_minute, self.available_tokens + elapsed_minutes * self.tokens_per_minute)
+        if self.requests_per_minute:
+            self.available_requests = min(self.requests_per_minute, self.available_requests + elapsed_minutes * self.requests_per_minute)
+
+
+    #reserve capacity for one request of the estimated size and wait until it is available
+    async def acquire(self, estimated_tokens):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait_seconds = max(self.blocked_until - now, 0.0)
+            if self.tokens_per_minute:
+                self.available_tokens -= estimated_tokens
+                wait_seconds = max(wait_seconds, -self.available_tokens / self.tokens_per_minute * 60)
+            if self.requests_per_minute:
+                self.available_requests -= 1
+                wait_seconds = max(wait_seconds, -self.available_requests / self.requests_per_minute * 60)
+
+        if wait_seconds > 0:
+            await asyncio.sleep(wait_seconds)
+        return wait_seconds
+
+
+    #give back the difference once the actual token usage of a request is known
+    def record_usage(self, estimated_tokens, actual_tokens):
+        if self.tokens_per_minute and actual_tokens is not None:
+            with self.lock:
+                self.available_tokens = min(self.tokens_per_minute, self.available_tokens + estimated_tokens - actual_tokens)
+
+
+    #give back the whole reservation of a request that was not answered, e.g. a 429, 5xx or timeout, so its
+    #retry does not count against the quota twice and a failed request does not hold capacity
+    def release(self, estimated_tokens):
+        with self.lock:
+            if self.tokens_per_minute:
+                self.available_tokens = min(self.tokens_per_minute, self.available_tokens + estimated_tokens)
+            if self.requests_per_minute:
+                self.available_requests = min(self.requests_per_minute, self.available_requests + 1)
+
+
+    #stop all callers for the retry-after period of a 429 response
+    def pause(self, seconds):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
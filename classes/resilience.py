@@ -0,0 +1,277 @@
+import time
+import random
+import asyncio
+import threading
+
+#status codes that mean the request was not handled and can be sent again
+RETRYABLE_STATUS_CODES = [408, 429, 500, 502, 503, 504]
+
+#for requests that are not idempotent, e.g. an OCR submit that starts a billed operation, only the status codes where
+#the service says it did not accept the request are retried
+NON_IDEMPOTENT_RETRYABLE_STATUS_CODES = [429, 503]
+
+#the dependency each endpoint belongs to. Endpoints of one dependency share a circuit breaker
+ENDPOINT_DEPENDENCIES = {
+    "token": "entra_id",
+    "storage": "blob_storage",
+    "ocr_submit": "document_intelligence",
+    "ocr_poll": "document_intelligence",
+    "llm": "azure_openai",
+    "openai_batch": "azure_openai",
+    "openai_batch_submit": "azure_openai",
+}
+
+#endpoints whose requests start work that is billed or cannot be undone, so they are never sent twice after a timeout
+NON_IDEMPOTENT_ENDPOINTS = ["ocr_submit", "openai_batch_submit"]
+
+
+#seconds to wait before the next attempt: a Retry-After sent by the service wins (capped at retry_after_cap when one is
+#given), otherwise back off exponentially with jitter. Shared by the endpoint retries and the OCR polling
+def backoff_delay(attempt, initial_delay, max_delay, backoff_factor, jitter, retry_after=None, retry_after_cap=None):
+    if retry_after is not None:
+        try:
+            delay = max(float(retry_after), 0.0)
+            return delay if retry_after_cap is None else min(delay, retry_after_cap)
+        except ValueError:
+            pass
+    delay = min(initial_delay * (backoff_factor ** attempt), max_delay)
+    return delay * random.uniform(1 - jitter, 1 + jitter)
+
+
+class DependencyUnavailableError(Exception):
+    """A request to an Azure dependency failed after its retries, or was not sent because the dependency's circuit is open."""
+    def __init__(self, endpoint, reason):
+        self.endpoint = endpoint
+        self.dependency = ENDPOINT_DEPENDENCIES.get(endpoint, endpoint)
+        self.reason = reason
+        super().__init__(f"{self.dependency} ({endpoint}): {reason}")
+
+
+class EndpointPolicy:
+    def __init__(self, timeout=30.0, max_attempts=4, initial_delay=0.5, max_delay=30.0, backoff_factor=2.0, jitter=0.2):
+        """
+        How requests to one endpoint are timed out and retried.
+
+        :param timeout: Seconds a single attempt may take, including connecting and reading the response.
+        :param max_attempts: Attempts per request, including the first one.
+        :param initial_delay: Seconds to wait before the first retry when the service gives no Retry-After.
+        :param max_delay: Upper bound for the wait between attempts, also for a Retry-After sent by the service.
+        :param backoff_factor: Multiplier applied to the delay after every attempt.
+        :param jitter: Fraction of the delay that is randomised, so concurrent documents do not retry in lockstep.
+        """
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff_factor = backoff_factor
+        self.jitter = jitter
+
+
+    #a Retry-After header wins, up to max_delay, otherwise back off exponentially with jitter
+    def next_delay(self, attempt, retry_after=None):
+        return backoff_delay(attempt, self.initial_delay, self.max_delay, self.backoff_factor, self.jitter, retry_after, self.max_delay)
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=5, reset_seconds=30.0):
+        """
+        Stops sending requests to a dependency after failure_threshold consecutive failures (timeouts, connection
+        errors and 5xx responses), so documents fail at once instead of each waiting for its own retries. After
+        reset_seconds one trial request is let through: if it succeeds the circuit closes, otherwise it opens again.
+
+        :param name: Name of the dependency, used in error messages.
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+
+    #whether a request may be sent now: False, True, or "trial" for the one request let through a half-open circuit
+    def allow(self):
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = "half_open"
+                self.trial_in_flight = False
+            if self.state == "half_open" and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return "trial"
+            return False
+
+
+    #seconds until the next trial request is allowed
+    def retry_in(self):
+        with self.lock:
+            if self.state != "open":
+                return 0.0
+            return max(self.reset_seconds - (time.monotonic() - self.opened_at), 0.0)
+
+
+    #the dependency answered, even if it was with a 4xx or 429
+    def record_success(self):
+        with self.lock:
+            self.state = "closed"
+            self.failures = 0
+            self.trial_in_flight = False
+
+
+    #the trial request ended without saying anything about the dependency, e.g. because its task was cancelled, so
+    #the next request can be the trial instead. A no-op once the trial recorded its outcome
+    def release_trial(self):
+        with self.lock:
+            if self.state == "half_open":
+                self.trial_in_flight = False
+
+
+    #returns True when this failure opened the circuit
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+
+class ResilienceManager:
+    def __init__(self, policies=None, default_policy=None, failure_threshold=5, reset_seconds=30.0, metrics=None):
+        """
+        Shared timeouts, retries and circuit breakers for every request to the Azure dependencies.
+
+        :param policies: EndpointPolicy per endpoint name, see ENDPOINT_DEPENDENCIES for the names.
+        :param default_policy: Policy of endpoints without one of their own.
+        :param failure_threshold: Consecutive failures after which a dependency's circuit opens.
+        :param reset_seconds: Seconds an open circuit waits before it lets a trial request through.
+        :param metrics: MetricsManager that counts retries and opened circuits per endpoint, or None.
+        """
+        self.policies = policies or {}
+        self.default_policy = default_policy or EndpointPolicy()
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.metrics = metrics
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+
+    def policy(self, endpoint):
+        return self.policies.get(endpoint, self.default_policy)
+
+
+    def breaker(self, endpoint):
+        dependency = ENDPOINT_DEPENDENCIES.get(endpoint, endpoint)
+        with self.lock:
+            if dependency not in self.breakers:
+                self.breakers[dependency] = CircuitBreaker(dependency, self.failure_threshold, self.reset_seconds)
+            return self.breakers[dependency]
+
+
+    #fail at once when the dependency's circuit is open. Returns the breaker, and whether this request is the trial
+    #of a half-open circuit, which the caller has to release when it ends without an outcome
+    def check_circuit(self, endpoint):
+        breaker = self.breaker(endpoint)
+        permit = breaker.allow()
+        if not permit:
+            raise DependencyUnavailableError(endpoint, f"circuit is open after {breaker.failures} consecutive failures, "
+                                                       f"next try in {breaker.retry_in():.0f}s")
+        return breaker, permit == "trial"
+
+
+    #count a failure, and log when it opened the circuit
+    def record_failure(self, endpoint, app_logging):
+        breaker = self.breaker(endpoint)
+        if breaker.record_failure():
+            app_logging.error(f"Circuit for {breaker.name} opened after {breaker.failures} consecutive failures")
+            self._increment("circuit_opened", endpoint)
+
+
+    def _increment(self, name, endpoint):
+        if self.metrics is not None:
+            self.metrics.increment(name, endpoint)
+
+
+    async def request(self, http_client, endpoint, method, url, app_logging, deadline=None, **kwargs):
+        """
+        Send a request with the endpoint's timeout, retrying timeouts, connection errors and 429/5xx responses with
+        backoff, in step with the dependency's circuit breaker.
+
+        :param http_client: The httpx.AsyncClient to send the request with.
+        :param endpoint: Endpoint name that selects the policy and circuit breaker, e.g. "storage" or "ocr_submit".
+        :param deadline: time.monotonic() by which the request has to be answered, or None. Every attempt's timeout is
+                         cut to the time left, and no attempt is started once it has passed.
+        :param kwargs: Passed on to httpx, e.g. headers, params, content, data or json.
+        :return: The response, which can still have a status code that is not retried, such as 400 or 404.
+        :raises DependencyUnavailableError: When the circuit is open, the deadline passed or the last attempt failed. Its reason says why.
+        """
+        import httpx
+
+        policy = self.policy(endpoint)
+        idempotent = endpoint not in NON_IDEMPOTENT_ENDPOINTS
+        retryable_status_codes = RETRYABLE_STATUS_CODES if idempotent else NON_IDEMPOTENT_RETRYABLE_STATUS_CODES
+        reason = None
+        for attempt in range(policy.max_attempts):
+            timeout = policy.timeout
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DependencyUnavailableError(endpoint, f"deadline passed after {attempt} attempts" + (f", last {reason}" if reason else ""))
+                timeout = min(timeout, remaining)
+            breaker, trial = self.check_circuit(endpoint)
+            retry_after = None
+            try:
+                response = await http_client.request(method, url, timeout=timeout, **kwargs)
+            except (httpx.TimeoutException, httpx.TransportError) as e:
+                #a timeout that was cut short by the deadline says nothing about the dependency
+                if timeout == policy.timeout or not isinstance(e, httpx.TimeoutException):
+                    self.record_failure(endpoint, app_logging)
+                reason = f"{type(e).__name__} after {timeout:.1f}s timeout" if isinstance(e, httpx.TimeoutException) else type(e).__name__
+
+                #a request that is not idempotent may have been handled, so it is only sent again if it never got there
+                if not idempotent and not isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+                    raise DependencyUnavailableError(endpoint, f"{reason}, not retried because the request is not idempotent") from e
+            except Exception:
+                #any other error of the request still ends a half-open trial, and counts against the circuit
+                self.record_failure(endpoint, app_logging)
+                raise
+            else:
+                if response.status_code >= 500 and response.status_code not in retryable_status_codes:
+                    self.record_failure(endpoint, app_logging)
+                    if response.status_code in RETRYABLE_STATUS_CODES:
+                        raise DependencyUnavailableError(endpoint, f"HTTP {response.status_code}, not retried because the request is not idempotent")
+                    #e.g. 501 Not Implemented or 505 HTTP Version Not Supported, which fail again however often they are sent
+                    raise DependencyUnavailableError(endpoint, f"HTTP {response.status_code}, not retried because the service will not handle the request")
+                if response.status_code not in retryable_status_codes:
+                    breaker.record_success()
+                    return response
+
+                #throttling means the service is up, so only server errors count against the circuit
+                if response.status_code == 429:
+                    breaker.record_success()
+                else:
+                    self.record_failure(endpoint, app_logging)
+                reason = f"HTTP {response.status_code}"
+                retry_after = response.headers.get("retry-after")
+            finally:
+                #a cancelled trial records no outcome, but must not keep the half-open circuit closed to everyone forever
+                if trial:
+                    breaker.release_trial()
+
+            if attempt == policy.max_attempts - 1:
+                raise DependencyUnavailableError(endpoint, f"{reason} after {policy.max_attempts} attempts")
+            delay = policy.next_delay(attempt, retry_after)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                raise DependencyUnavailableError(endpoint, f"{reason}, not retried because the deadline passes first")
+            self._increment("retries", endpoint)
+            app_logging.warning(f"{method} {endpoint} failed with {reason}, retrying in {delay:.1f}s (attempt {attempt + 1} of {policy.max_attempts})")
+            await asyncio.sleep(delay)
+
+
+#the manager used by clients that are not given one of their own
+shared_resilience = ResilienceManager()
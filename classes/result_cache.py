@@ -0,0 +1,96 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+class ResultCache:
+    def __init__(self, db_path, ttl_seconds, max_bytes, app_logging):
+        """
+        Content-addressed cache for OCR text and LLM output, stored in a local SQLite file.
+
+        :param db_path: Path to the SQLite database file. The folder is created if it does not exist.
+        :param ttl_seconds: Entries older than this are treated as missing and evicted.
+        :param max_bytes: Once the cached values exceed this size, the least recently used entries are evicted.
+        """
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.app_logging = app_logging
+        self.lock = threading.Lock()
+
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS cache (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+        self.connection.commit()
+
+
+    #sha256 hex digest of bytes or text
+    @staticmethod
+    def hash_content(content):
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        return hashlib.sha256(content).hexdigest()
+
+
+    #key for the LLM output of a given OCR text, prompt and model settings
+    @staticmethod
+    def llm_key(ocr_text, prompt, deployment_name, temperature):
+        return ResultCache.hash_content(f"{ResultCache.hash_content(ocr_text)}|{ResultCache.hash_content(prompt)}|{deployment_name}|{temperature}")
+
+
+    def get(self, namespace, key):
+        try:
+            with self.lock:
+                row = self.connection.execute("SELECT value, created_at FROM cache WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+                if row is None:
+                    return None
+                if time.time() - row[1] > self.ttl_seconds:
+                    self.connection.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (namespace, key))
+                    self.connection.commit()
+                    return None
+                self.connection.execute("UPDATE cache SET accessed_at = ? WHERE namespace = ? AND key = ?", (time.time(), namespace, key))
+                self.connection.commit()
+                return row[0]
+        except Exception as e:
+            self.app_logging.error(f"Error reading from result cache: {e}")
+            return None
+
+
+    def set(self, namespace, key, value):
+        try:
+            now = time.time()
+            with self.lock:
+                self.connection.execute("INSERT OR REPLACE INTO cache (namespace, key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                                        (namespace, key, value, len(value.encode("utf-8")), now, now))
+                self._evict(now)
+                self.connection.commit()
+        except Exception as e:
+            self.app_logging.error(f"Error writing to result cache: {e}")
+
+
+    #drop expired entries, then the least recently used ones until the cache fits in max_bytes
+    def _evict(self, now):
+        self.connection.execute("DELETE FROM cache WHERE created_at < ?", (now - self.ttl_seconds,))
+        total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return
+
+        for namespace, key, size in self.connection.execute("SELECT namespace, key, size FROM cache ORDER BY accessed_at").fetchall():
+            if total_bytes <= self.max_bytes:
+                break
+            self.connection.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (namespace, key))
+            total_bytes -= size
@@ -0,0 +1,36 @@
+from functools import lru_cache
+
+
+#tiktoken is optional, without it token counts are estimated from the text length. It is imported on first use,
+#so runs that never count tokens do not pay for loading it
+@lru_cache(maxsize=8)
+def _get_encoding(model_name):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            #deployment names do not have to match model names, o200k_base is the encoding of the gpt-4o family
+            return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        #tiktoken downloads its encoding files on first use, which fails on hosts without internet access
+        return None
+
+
+def count_tokens(text, model_name="gpt-4o"):
+    """
+    Count the tokens in a text for the given model.
+
+    :param text: The text to count.
+    :param model_name: Model or deployment name used to pick the tokenizer.
+    :return: The exact token count when tiktoken is available, otherwise an estimate of one token per 4 characters.
+    """
+    if not text:
+        return 0
+    encoding = _get_encoding(model_name)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
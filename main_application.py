@@ -1,26 +1,120 @@
 import os
+import json
+import glob
+import time
 import random
 import string
+import asyncio
+import argparse
+from urllib.parse import urlparse, parse_qs
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 from classes.file_manager import FileManager
-from classes.azure_blob_manager import AzureBlobManager
-from classes.azure_document_intelligence import AzureDocIntel
+from classes.async_http_client import get_async_http_client, run_sync
+from classes.azure_blob_manager import AsyncAzureBlobManager
+from classes.azure_document_intelligence import AsyncAzureDocIntel, OcrPollingPolicy
 from classes.langchain_chunk_manager import LangchainChunkManager
 from classes.langchain_llm import LangchainLLMManager
 from classes.audit_log_manager import LogManager
+from classes.result_cache import ResultCache
+from classes.rate_limiter import AzureOpenAIRateLimiter
+from classes.azure_credential_cache import AzureCredentialCache
+from classes.metrics_manager import MetricsManager
+from classes.job_store import JobStore, JOB_STAGES
+from classes.cv_output_writer import CvOutputWriter
+from classes.token_counter import count_tokens
+from classes.llm_result_merger import merge_llm_results
+from classes.llm_packing_batcher import LlmPackingBatcher
+from classes.azure_openai_batch_manager import AsyncAzureOpenAIBatchManager
+from classes.image_preprocessor import ImagePreprocessor
+from classes.near_duplicate_index import NearDuplicateIndex
+from classes.resilience import ResilienceManager, EndpointPolicy, DependencyUnavailableError
+
+#file types that Azure Document Intelligence can read
+OCR_FILE_TYPES = [
+    'application/pdf',
+    'image/jpeg',
+    'image/png',
+    'image/tiff',
+    'image/bmp',
+    'image/heif',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+]
 
 
 class Application:
     def __init__(self):
         # Load environment variables
         load_dotenv()
-        
-        # Setup logger
-        self.log_manager = LogManager(unique_key=self._generate_random_key())
-        self.app_logging = self.log_manager.get_logger()
-        
+
         # Initialize Azure configurations
         self.config_variables = self._load_config_variables()
+
+        # Setup logger. Records go through a queue to a background writer, so logging never blocks a worker
+        self.log_manager = LogManager(unique_key=self._generate_random_key(),
+                                      log_file=self.config_variables["log_file"],
+                                      max_bytes=self.config_variables["log_max_bytes"],
+                                      level=self.config_variables["log_level"],
+                                      log_format=self.config_variables["log_format"],
+                                      backup_count=self.config_variables["log_backup_count"])
+        self.app_logging = self.log_manager.get_logger()
+
+        # Setup the local OCR and LLM result cache
+        self.result_cache = None
+        if self.config_variables["cache_enabled"]:
+            self.result_cache = ResultCache(self.config_variables["cache_path"],
+                                            self.config_variables["cache_ttl_seconds"],
+                                            self.config_variables["cache_max_bytes"],
+                                            self.app_logging)
+
+        # Per-document stage checkpoints, so an interrupted batch resumes instead of starting over
+        self.job_store = None
+        if self.config_variables["job_store_enabled"]:
+            self.job_store = JobStore(self.config_variables["job_store_path"], self.app_logging)
+            self.job_store.prune(self.config_variables["job_store_ttl_seconds"])
+
+        # Optional reuse of the extraction of an earlier CV with almost the same text
+        self.near_duplicate_index = None
+        if self.config_variables["near_duplicate_enabled"]:
+            self.near_duplicate_index = NearDuplicateIndex(self.config_variables["near_duplicate_path"],
+                                                           self.app_logging,
+                                                           self.config_variables["near_duplicate_threshold"],
+                                                           max_entries=self.config_variables["near_duplicate_max_entries"])
+
+        # Optional shrinking of large images on a process pool before upload
+        self.image_preprocessor = None
+        if self.config_variables["preprocess_enabled"]:
+            self.image_preprocessor = ImagePreprocessor(self.config_variables["preprocess_max_long_edge"],
+                                                        self.config_variables["preprocess_grayscale"],
+                                                        self.config_variables["preprocess_jpeg_quality"],
+                                                        self.config_variables["preprocess_min_bytes"],
+                                                        self.config_variables["preprocess_max_workers"])
+
+        # Where the extracted CV details are written
+        self.output_writer = CvOutputWriter(self.config_variables["output_dir"],
+                                            self.app_logging,
+                                            self.config_variables["output_mode"],
+                                            self.config_variables["output_naming"],
+                                            self.config_variables["output_jsonl_path"],
+                                            self.config_variables["output_export_path"],
+                                            self.config_variables["output_buffer_records"])
+
+        # The AAD token and user delegation key are fetched once and shared across documents
+        self.credential_cache = AzureCredentialCache(self.config_variables["azure_storage_credential_refresh_margin_seconds"])
+
+        # Per-stage timings and counters, tied to each document's log tracing key
+        self.metrics = MetricsManager(self.config_variables["metrics_jsonl_path"])
+
+        # Timeouts, retries and circuit breakers for every request to Azure, shared by all documents
+        self.resilience = self._get_resilience_manager()
+
+        # LLM clients are created once per prompt and event loop, then shared across documents
+        self.llm_managers = {}
+        self.llm_packers = {}
+
+        # One rate limiter per process keeps all LLM calls within the deployment's quota
+        self.rate_limiter = AzureOpenAIRateLimiter(self.config_variables["azure_openai_max_tokens_per_minute"],
+                                                   self.config_variables["azure_openai_max_requests_per_minute"])
     
     
     #generate random string for log tracing
@@ -28,6 +122,11 @@ class Application:
         return ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
     
     
+    #convert an optional environment variable to int, None when it is not set
+    def _optional_int(self, value):
+        return int(value) if value else None
+
+
     #load all config variables
     def _load_config_variables(self):
         return {
@@ -39,6 +138,9 @@ class Application:
                 "Ocp-Apim-Subscription-Key": f"{os.environ.get("AZURE_VISION_KEY")}"
             },
             "azure_vision_full_endpoint": f"{os.environ.get("AZURE_VISION_ENDPOINT")}documentintelligence/documentModels/{os.environ.get("AZURE_VISION_MODEL_ID")}:analyze?api-version=2024-11-30",
+            "azure_vision_poll_initial_seconds": float(os.environ.get("AZURE_VISION_POLL_INITIAL_SECONDS", 0.5)),
+            "azure_vision_poll_max_seconds": float(os.environ.get("AZURE_VISION_POLL_MAX_SECONDS", 5)),
+            "azure_vision_poll_deadline_seconds": float(os.environ.get("AZURE_VISION_POLL_DEADLINE_SECONDS", 120)),
             # azure auth variables
             "azure_storage_endpoint_url": os.environ.get("AZURE_STORAGE_ENDPOINT_URL"),
             "azure_storage_tenant_id": os.environ.get("AZURE_STORAGE_TENANT_ID"),
@@ -52,35 +154,497 @@ class Application:
             "azure_storage_account_prefix": os.environ.get("AZURE_STORAGE_ACCOUNT_PREFIX"),
             "azure_storage_file_tags": os.environ.get("AZURE_STORAGE_FILE_TAGS"),
             "azure_storage_sas_valid_hours": int(os.environ.get("AZURE_STORAGE_SAS_VALID_HOURS")),
+            "azure_storage_credential_refresh_margin_seconds": int(os.environ.get("AZURE_STORAGE_CREDENTIAL_REFRESH_MARGIN_SECONDS", 300)),
             # azure openai variables
             "azure_openai_endpoint": os.environ.get("AZURE_OPENAI_ENDPOINT"),
             "azure_openai_deployment_name": os.environ.get("AZURE_OPENAI_DEPLOYMENT_NAME"),
             "azure_openai_api_version": os.environ.get("AZURE_OPENAI_API_VERSION"),
             "azure_openai_key": os.environ.get("AZURE_OPENAI_KEY"),
             "azure_openai_temperature": os.environ.get("AZURE_OPENAI_TEMPERATURE"),
-            #"azure_openai_max_tokens_per_minute": os.environ.get("AZURE_OPENAI_MAX_TOKENS_PER_MINUTE") #TODO: use this
+            "azure_openai_max_concurrency": int(os.environ.get("AZURE_OPENAI_MAX_CONCURRENCY", 8)),
+            "azure_openai_max_tokens_per_minute": self._optional_int(os.environ.get("AZURE_OPENAI_MAX_TOKENS_PER_MINUTE")),
+            "azure_openai_max_requests_per_minute": self._optional_int(os.environ.get("AZURE_OPENAI_MAX_REQUESTS_PER_MINUTE")),
+            "azure_openai_max_retries": int(os.environ.get("AZURE_OPENAI_MAX_RETRIES", 5)),
+            "azure_openai_completion_token_estimate": int(os.environ.get("AZURE_OPENAI_COMPLETION_TOKEN_ESTIMATE", 1000)),
+            "azure_openai_context_tokens": int(os.environ.get("AZURE_OPENAI_CONTEXT_TOKENS", 128000)),
+            # azure openai batch variables
+            "azure_openai_batch_deployment_name": os.environ.get("AZURE_OPENAI_BATCH_DEPLOYMENT_NAME", os.environ.get("AZURE_OPENAI_DEPLOYMENT_NAME")),
+            "azure_openai_batch_api_version": os.environ.get("AZURE_OPENAI_BATCH_API_VERSION", "2024-10-21"),
+            "llm_batch_dir": os.environ.get("CV_LLM_BATCH_DIR", "batch_jobs"),
+            "llm_batch_max_requests_per_file": int(os.environ.get("CV_LLM_BATCH_MAX_REQUESTS_PER_FILE", 50000)),
+            "llm_batch_poll_seconds": float(os.environ.get("CV_LLM_BATCH_POLL_SECONDS", 60)),
+            # chunking variables
+            "chunk_max_tokens": self._optional_int(os.environ.get("CV_CHUNK_MAX_TOKENS")),
+            "chunk_overlap_ratio": float(os.environ.get("CV_CHUNK_OVERLAP_RATIO", 0.05)),
+            "chunk_strip_layout_noise": os.environ.get("CV_CHUNK_STRIP_LAYOUT_NOISE", "true").lower() == "true",
+            "chunk_page_edge_lines": int(os.environ.get("CV_CHUNK_PAGE_EDGE_LINES", 3)),
+            # multi-CV packing variables
+            "packing_enabled": os.environ.get("CV_PACKING_ENABLED", "false").lower() == "true",
+            "packing_max_documents": int(os.environ.get("CV_PACKING_MAX_DOCUMENTS", 5)),
+            "packing_max_document_tokens": int(os.environ.get("CV_PACKING_MAX_DOCUMENT_TOKENS", 4000)),
+            "packing_max_wait_seconds": float(os.environ.get("CV_PACKING_MAX_WAIT_SECONDS", 0.2)),
+            # blob upload variables
+            "upload_single_put_max_bytes": int(os.environ.get("CV_UPLOAD_SINGLE_PUT_MAX_BYTES", 8 * 1024 * 1024)),
+            "upload_block_size_bytes": int(os.environ.get("CV_UPLOAD_BLOCK_SIZE_BYTES", 4 * 1024 * 1024)),
+            "upload_max_concurrency": int(os.environ.get("CV_UPLOAD_MAX_CONCURRENCY", 4)),
+            # image preprocessing variables
+            "preprocess_enabled": os.environ.get("CV_PREPROCESS_ENABLED", "false").lower() == "true",
+            "preprocess_max_long_edge": int(os.environ.get("CV_PREPROCESS_MAX_LONG_EDGE", 3508)),
+            "preprocess_grayscale": os.environ.get("CV_PREPROCESS_GRAYSCALE", "true").lower() == "true",
+            "preprocess_jpeg_quality": int(os.environ.get("CV_PREPROCESS_JPEG_QUALITY", 85)),
+            "preprocess_min_bytes": int(os.environ.get("CV_PREPROCESS_MIN_BYTES", 512 * 1024)),
+            "preprocess_max_workers": self._optional_int(os.environ.get("CV_PREPROCESS_WORKERS")),
+            # metrics variables
+            "metrics_jsonl_path": os.environ.get("CV_METRICS_JSONL_PATH", "metrics/cv_pipeline_spans.jsonl"),
+            "metrics_prometheus_path": os.environ.get("CV_METRICS_PROMETHEUS_PATH", "metrics/cv_pipeline.prom"),
+            # batch processing variables
+            "batch_max_workers": int(os.environ.get("CV_BATCH_MAX_WORKERS", 8)),
+            "http_max_connections": int(os.environ.get("CV_HTTP_MAX_CONNECTIONS", 100)),
+            # local PDF text layer variables
+            "pdf_text_min_chars": int(os.environ.get("CV_PDF_TEXT_MIN_CHARS", 200)),
+            "pdf_text_min_printable_ratio": float(os.environ.get("CV_PDF_TEXT_MIN_PRINTABLE_RATIO", 0.9)),
+            "pdf_text_min_page_chars": int(os.environ.get("CV_PDF_TEXT_MIN_PAGE_CHARS", 50)),
+            # result cache variables
+            "cache_enabled": os.environ.get("CV_CACHE_ENABLED", "true").lower() == "true",
+            "cache_path": os.environ.get("CV_CACHE_PATH", "cache/cv_cache.sqlite3"),
+            "cache_ttl_seconds": int(os.environ.get("CV_CACHE_TTL_SECONDS", 7 * 24 * 3600)),
+            "cache_max_bytes": int(os.environ.get("CV_CACHE_MAX_BYTES", 500 * 1024 * 1024)),
+            # output variables
+            "output_dir": os.environ.get("CV_OUTPUT_DIR", "cv_details_output"),
+            "output_mode": os.environ.get("CV_OUTPUT_MODE", "files"),
+            "output_naming": os.environ.get("CV_OUTPUT_NAMING", "source"),
+            "output_jsonl_path": os.environ.get("CV_OUTPUT_JSONL_PATH"),
+            "output_export_path": os.environ.get("CV_OUTPUT_EXPORT_PATH"),
+            "output_buffer_records": int(os.environ.get("CV_OUTPUT_BUFFER_RECORDS", 1000)),
+            # job store variables
+            "job_store_enabled": os.environ.get("CV_JOB_STORE_ENABLED", "true").lower() == "true",
+            "job_store_path": os.environ.get("CV_JOB_STORE_PATH", "jobs/cv_jobs.sqlite3"),
+            "job_store_ttl_seconds": int(os.environ.get("CV_JOB_STORE_TTL_SECONDS", 7 * 24 * 3600)),
+            # near-duplicate variables
+            "near_duplicate_enabled": os.environ.get("CV_NEAR_DUPLICATE_ENABLED", "false").lower() == "true",
+            "near_duplicate_path": os.environ.get("CV_NEAR_DUPLICATE_PATH", "cache/cv_near_duplicates.sqlite3"),
+            "near_duplicate_threshold": float(os.environ.get("CV_NEAR_DUPLICATE_THRESHOLD", 0.95)),
+            "near_duplicate_max_entries": int(os.environ.get("CV_NEAR_DUPLICATE_MAX_ENTRIES", 100000)),
+            # resilience variables
+            "timeout_token_seconds": float(os.environ.get("CV_TIMEOUT_TOKEN_SECONDS", 10)),
+            "timeout_storage_seconds": float(os.environ.get("CV_TIMEOUT_STORAGE_SECONDS", 60)),
+            "timeout_ocr_seconds": float(os.environ.get("CV_TIMEOUT_OCR_SECONDS", 30)),
+            "timeout_llm_seconds": float(os.environ.get("CV_TIMEOUT_LLM_SECONDS", 120)),
+            "timeout_openai_batch_seconds": float(os.environ.get("CV_TIMEOUT_OPENAI_BATCH_SECONDS", 300)),
+            "retry_max_attempts": int(os.environ.get("CV_RETRY_MAX_ATTEMPTS", 4)),
+            "retry_initial_seconds": float(os.environ.get("CV_RETRY_INITIAL_SECONDS", 0.5)),
+            "retry_max_seconds": float(os.environ.get("CV_RETRY_MAX_SECONDS", 30)),
+            "circuit_failure_threshold": int(os.environ.get("CV_CIRCUIT_FAILURE_THRESHOLD", 5)),
+            "circuit_reset_seconds": float(os.environ.get("CV_CIRCUIT_RESET_SECONDS", 30)),
+            # logging variables
+            "log_file": os.environ.get("CV_LOG_FILE", "audit_log/cv_llm.log"),
+            "log_level": os.environ.get("CV_LOG_LEVEL", "DEBUG"),
+            "log_format": os.environ.get("CV_LOG_FORMAT", "json"),
+            "log_max_bytes": int(os.environ.get("CV_LOG_MAX_BYTES", 5 * 1024 * 1024)),
+            "log_backup_count": int(os.environ.get("CV_LOG_BACKUP_COUNT", 3)),
         }
     
 
+    #one policy per endpoint: its own timeout, with the same retry settings for all
+    def _get_resilience_manager(self):
+        def policy(timeout_name):
+            return EndpointPolicy(self.config_variables[timeout_name],
+                                  self.config_variables["retry_max_attempts"],
+                                  self.config_variables["retry_initial_seconds"],
+                                  self.config_variables["retry_max_seconds"])
+        return ResilienceManager({"token": policy("timeout_token_seconds"),
+                                  "storage": policy("timeout_storage_seconds"),
+                                  "ocr_submit": policy("timeout_ocr_seconds"),
+                                  "ocr_poll": policy("timeout_ocr_seconds"),
+                                  "llm": policy("timeout_llm_seconds"),
+                                  "openai_batch": policy("timeout_openai_batch_seconds"),
+                                  "openai_batch_submit": policy("timeout_openai_batch_seconds")},
+                                 failure_threshold=self.config_variables["circuit_failure_threshold"],
+                                 reset_seconds=self.config_variables["circuit_reset_seconds"],
+                                 metrics=self.metrics)
+
+
     def process_files(self, file_name, prompt_file):
         """Process the file by reading and analyzing it."""
         # Read the prompt
         prompt = self._read_prompt(prompt_file)
         
-        # Get file details
-        file_manager = FileManager(file_name, self.app_logging)
-        file_type, file_contents = file_manager.get_file_type_and_contents()
+        result = run_sync(self._process_document(file_name, prompt, self._get_document_logger(self.log_manager.unique_key, file_name)))
+        run_sync(self.flush_output_async())
+        self.export_metrics()
+        if result["status"] == "invalid_file_type":
+            exit(1)
+        return result
+
+
+    def process_batch(self, source, prompt_file, max_workers=None):
+        """Synchronous entry point for process_batch_async."""
+        return run_sync(self.process_batch_async(source, prompt_file, max_workers))
+
+
+    async def process_batch_async(self, source, prompt_file, max_workers=None):
+        """
+        Process many CV files concurrently on the running event loop.
+
+        :param source: A directory, a glob pattern, a manifest file with one CV path per line, or a list of paths.
+        :param prompt_file: Path to the LLM prompt file.
+        :param max_workers: Maximum number of CVs in flight at once. Defaults to CV_BATCH_MAX_WORKERS.
+        :return: A list with one result dict per file, in the same order as the resolved files.
+        """
+        prompt = self._read_prompt(prompt_file)
+        file_names = source if isinstance(source, list) else self._resolve_batch_files(source)
+        max_workers = max_workers or self.config_variables["batch_max_workers"]
+        self.app_logging.info(f"Starting batch of {len(file_names)} files with {max_workers} workers")
+
+        batch_start = time.perf_counter()
+        semaphore = asyncio.Semaphore(max_workers)
+        results = await asyncio.gather(*[self._process_batch_file(file_name, prompt, semaphore) for file_name in file_names])
+
+        await self.flush_output_async()
+        self.export_metrics()
+        succeeded = sum(1 for result in results if result["status"] == "succeeded")
+        self.app_logging.info(f"Finished batch: {succeeded}/{len(results)} succeeded in {time.perf_counter() - batch_start:.2f}s")
+        return results
+
+
+    def resume_batch(self, prompt_file, max_workers=None):
+        """Continue every job in the job store that was started but never saved, e.g. after the process was killed."""
+        if self.job_store is None:
+            self.app_logging.error("The job store is disabled, there is nothing to resume.")
+            return []
+        file_names = sorted({job["file_name"] for job in self.job_store.unfinished() if job["file_name"] and os.path.isfile(job["file_name"])})
+        self.app_logging.info(f"Resuming {len(file_names)} unfinished jobs")
+        return run_sync(self.process_batch_async(file_names, prompt_file, max_workers))
+
+
+    def submit_llm_batch(self, source, prompt_file, max_workers=None):
+        """Synchronous entry point for submit_llm_batch_async."""
+        return run_sync(self.submit_llm_batch_async(source, prompt_file, max_workers))
+
+
+    async def submit_llm_batch_async(self, source, prompt_file, max_workers=None):
+        """
+        Run many CV files through upload and OCR now, and queue their LLM extraction as Azure OpenAI Batch API jobs
+        instead of calling the deployment directly. CVs whose LLM output is already cached are saved right away.
+        Collect the results later with collect_llm_batch.
+
+        :param source: A directory, a glob pattern, a manifest file with one CV path per line, or a list of paths.
+        :return: A list with one result dict per file. Queued files have the status queued_for_llm_batch and their batch id.
+        """
+        prompt = self._read_prompt(prompt_file)
+        file_names = source if isinstance(source, list) else self._resolve_batch_files(source)
+        semaphore = asyncio.Semaphore(max_workers or self.config_variables["batch_max_workers"])
+        queued = []
+        results = await asyncio.gather(*[self._process_batch_file(file_name, prompt, semaphore, queued) for file_name in file_names])
+        await self.flush_output_async()
+
+        batch_ids = await self._submit_llm_batch_documents(queued, prompt)
+        for result in results:
+            if result["status"] == "queued_for_llm_batch":
+                result["llm_batch_id"] = batch_ids.get(result["file_name"])
+                if result["llm_batch_id"] is None:
+                    result.update({"status": "failed", "error": "Could not submit the LLM batch"})
+        self.export_metrics()
+        return results
+
+
+    def collect_llm_batch(self, batch_id, wait=True):
+        """Synchronous entry point for collect_llm_batch_async."""
+        return run_sync(self.collect_llm_batch_async(batch_id, wait))
+
+
+    async def collect_llm_batch_async(self, batch_id, wait=True):
+        """
+        Fetch the results of a Batch API job submitted by submit_llm_batch and save them like a synchronous run would.
+
+        :param batch_id: Id of the batch, as returned by submit_llm_batch.
+        :param wait: Poll until the batch reaches a final status, otherwise only check it once.
+        :return: A list with one result dict per CV in the batch.
+        """
+        manifest_path = os.path.join(self.config_variables["llm_batch_dir"], f"{batch_id}.json")
+        try:
+            with open(manifest_path, "r") as f:
+                manifest = json.load(f)
+        except Exception as e:
+            self.app_logging.error(f"Could not read the manifest of batch {batch_id}: {e}")
+            return []
+
+        batch_manager = self._get_llm_batch_manager()
+        batch = await (batch_manager.wait_for_batch(batch_id) if wait else batch_manager.get_batch(batch_id))
+        status = batch.get("status") if batch else None
+        if status not in batch_manager.final_statuses:
+            return [{"file_name": document["file_name"], "status": "llm_batch_pending", "error": f"Batch is {status}"}
+                    for document in manifest["documents"].values()]
+        #a batch that expired or was cancelled still has the output of the requests that ran, so only the rest fail
+        contents = await batch_manager.get_results(batch)
+
+        results = []
+        for job_key, document in manifest["documents"].items():
+            app_logging = self._get_document_logger(document["unique_key"], document["file_name"])
+            chunk_results = []
+            for index in range(document["chunks"]):
+                content = contents.get(f"{job_key}:{index}")
+                try:
+                    chunk_results.append(LangchainLLMManager.parse_json_response(content) if content is not None else None)
+                except ValueError as e:
+                    app_logging.error(f"Batch response for chunk {index} is not valid JSON: {e}")
+                    chunk_results.append(None)
+            if not chunk_results or any(chunk_result is None for chunk_result in chunk_results):
+                results.append({"file_name": document["file_name"], "status": "failed", "error": f"No CV details returned by batch ({status})"})
+                continue
+
+            cv_details = merge_llm_results(chunk_results)
+            await self._cache_set("llm_json", document["llm_key"], json.dumps(cv_details))
+            await self._near_duplicate_add(document.get("near_duplicate_scope"), document.get("near_duplicate_signature"),
+                                     document["file_hash"], document["file_name"], cv_details)
+            await self._job_checkpoint(job_key, "llm_done", cv_details=json.dumps(cv_details))
+            output_file = await self._write_output(cv_details, document["file_name"], document["file_hash"], document["unique_key"], job_key)
+            results.append({"file_name": document["file_name"], "status": "succeeded", "output_file": output_file})
+
+        await self.flush_output_async()
+        manifest.update({"status": status, "collected_at": time.time()})
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+        succeeded = sum(1 for result in results if result["status"] == "succeeded")
+        self.app_logging.info(f"Collected batch {batch_id}: {succeeded}/{len(results)} succeeded")
+        return results
+
+
+    #flush the span log and write the Prometheus metrics file
+    def export_metrics(self):
+        self.metrics.flush()
+        if self.config_variables["metrics_prometheus_path"]:
+            self.metrics.write_prometheus(self.config_variables["metrics_prometheus_path"])
+
+
+    #resolve a directory, glob pattern or manifest file to a sorted list of file paths
+    def _resolve_batch_files(self, source):
+        if os.path.isdir(source):
+            file_names = [os.path.join(source, name) for name in os.listdir(source)]
+        elif glob.has_magic(source):
+            file_names = glob.glob(source, recursive=True)
+        elif os.path.isfile(source):
+            with open(source, "r") as f:
+                file_names = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+            return file_names
+        else:
+            self.app_logging.error(f"Batch source {source} is not a directory, glob pattern or manifest file.")
+            return []
+        return sorted(file_name for file_name in file_names if os.path.isfile(file_name))
+
+
+    #process one file of a batch with its own log tracing key, once a slot in the semaphore is free.
+    #the CV details are only kept in the result when asked for, so large batches do not hold them all in memory
+    async def _process_batch_file(self, file_name, prompt, semaphore, llm_batch=None, keep_details=False):
+        unique_key = self._generate_random_key()
+        app_logging = self._get_document_logger(unique_key, file_name)
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                result = await self._process_document(file_name, prompt, app_logging, llm_batch)
+            except Exception as e:
+                app_logging.error(f"Unhandled error processing {file_name}: {e}")
+                result = {"file_name": file_name, "status": "failed", "error": str(e)}
+        if not keep_details:
+            result.pop("cv_details", None)
+        result["unique_key"] = unique_key
+        result["elapsed_seconds"] = round(time.perf_counter() - start, 3)
+        app_logging.info(f"Processed {file_name}: {result['status']} in {result['elapsed_seconds']}s")
+        return result
+
+
+    #a logger for one document. It shares the application's log file and writer, and tags its records with the document
+    def _get_document_logger(self, unique_key, file_name):
+        return LogManager(unique_key=unique_key, log_file=self.config_variables["log_file"], document_id=file_name).get_logger()
+
+
+    #run a single document through vision and LLM, returning a result dict instead of exiting.
+    #when an llm_batch list is passed, documents that need the LLM are added to it for the Batch API instead
+    async def _process_document(self, file_name, prompt, app_logging, llm_batch=None):
+        unique_key = app_logging.extra["unique_key"]
+
+        # Get the file type from the file header only, off the event loop
+        file_manager = FileManager(file_name, app_logging)
+        with self.metrics.span(unique_key, "sniff"):
+            file_type = await asyncio.to_thread(file_manager.get_file_type)
         
         # Process vision and LLM if valid file type
-        if file_type in ['application/pdf', 'image/jpeg', 'image/png']:
-            cv_details = self._azure_vision(file_name, file_type, file_contents, prompt)
-            if cv_details is not None:
-                self._save_cv_details(cv_details)
+        if file_type not in OCR_FILE_TYPES:
+            app_logging.error("CV file type could not be determined or not valid.")
+            return {"file_name": file_name, "status": "invalid_file_type", "error": "CV file type could not be determined or not valid."}
+
+        #OCR text is cached on the hash of the file bytes, so a re-uploaded CV skips upload and OCR
+        with self.metrics.span(unique_key, "read", bytes=os.path.getsize(file_name)) as attributes:
+            file_hash = await asyncio.to_thread(file_manager.get_file_hash)
+        self.metrics.increment("bytes", "read", attributes["bytes"])
+        if file_hash is None:
+            return {"file_name": file_name, "status": "failed", "error": "Could not read the file"}
+        app_logging.extra["file_hash"] = file_hash
+
+        #a job is one file content with one prompt and model settings, so a restarted run finds the checkpoints of the
+        #same document, but a run with another deployment or temperature does not reuse its LLM output
+        job_key = ResultCache.hash_content(f"{file_hash}|{ResultCache.hash_content(prompt)}|"
+                                           f"{self.config_variables['azure_openai_deployment_name']}|{self.config_variables['azure_openai_temperature']}")
+        job = await self._job_get(job_key, app_logging)
+        await self._job_checkpoint(job_key, None if job else "received", file_name=file_name, file_hash=file_hash)
+
+        ocr_text = job.get("ocr_text") or await self._cache_get("ocr", file_hash, app_logging)
+
+        #born-digital PDFs already have a text layer, so try that locally before paying for OCR
+        if ocr_text is None and file_type == 'application/pdf':
+            with self.metrics.span(unique_key, "pdf_text"):
+                ocr_text = await asyncio.to_thread(self._get_pdf_text_layer, file_name, app_logging)
+
+        if ocr_text is None:
+            try:
+                ocr_text = await self._azure_vision(file_name, file_type, app_logging, job_key, job)
+            except DependencyUnavailableError as e:
+                app_logging.error(f"OCR stage failed: {e}")
+                return {"file_name": file_name, "status": "failed", "error": str(e)}
+            if not ocr_text:
+                return {"file_name": file_name, "status": "failed", "error": "No OCR text returned"}
+            await self._cache_set("ocr", file_hash, ocr_text)
+        if not job.get("ocr_text"):
+            await self._job_checkpoint(job_key, "ocr_done", ocr_text=ocr_text)
+
+        #LLM output is cached on the OCR text, prompt and model settings
+        llm_key = ResultCache.llm_key(ocr_text, prompt, self.config_variables["azure_openai_deployment_name"], self.config_variables["azure_openai_temperature"])
+        cached_cv_details = job.get("cv_details") or await self._cache_get("llm_json", llm_key, app_logging)
+
+        #the same CV in another format or with trivial edits has different bytes, but almost the same text
+        near_duplicate_scope, near_duplicate_signature, near_duplicate = None, None, None
+        if cached_cv_details is None and self.near_duplicate_index is not None:
+            with self.metrics.span(unique_key, "near_duplicate") as attributes:
+                near_duplicate_scope = self._get_near_duplicate_scope(prompt)
+                near_duplicate_signature = await asyncio.to_thread(self.near_duplicate_index.signature, ocr_text)
+                near_duplicate = await asyncio.to_thread(self.near_duplicate_index.find, near_duplicate_scope, near_duplicate_signature)
+                attributes["matched"] = near_duplicate is not None
+            if near_duplicate is not None:
+                app_logging.info(f"Reusing the CV details of near-duplicate {near_duplicate['file_name']} "
+                                 f"(similarity {near_duplicate['similarity']})")
+                self.metrics.increment("reused", "near_duplicate")
+                cached_cv_details = near_duplicate.pop("cv_details")
+                await self._cache_set("llm_json", llm_key, cached_cv_details)
+
+        if cached_cv_details is not None:
+            cv_details = json.loads(cached_cv_details)
+        elif llm_batch is not None:
+            llm_batch.append({"file_name": file_name, "file_hash": file_hash, "job_key": job_key, "llm_key": llm_key,
+                              "unique_key": unique_key, "ocr_text": ocr_text,
+                              "near_duplicate_scope": near_duplicate_scope, "near_duplicate_signature": near_duplicate_signature})
+            return {"file_name": file_name, "status": "queued_for_llm_batch"}
         else:
-            self.app_logging.error("CV file type could not be determined or not valid.")
-            exit(1)
+            try:
+                cv_details = await self._langchain_chunking(ocr_text, prompt, app_logging)
+            except DependencyUnavailableError as e:
+                app_logging.error(f"LLM stage failed: {e}")
+                return {"file_name": file_name, "status": "failed", "error": str(e)}
+            if cv_details is None:
+                return {"file_name": file_name, "status": "failed", "error": "No CV details returned"}
+            await self._cache_set("llm_json", llm_key, json.dumps(cv_details))
+            await self._near_duplicate_add(near_duplicate_scope, near_duplicate_signature, file_hash, file_name, cv_details)
+        if not job.get("cv_details"):
+            await self._job_checkpoint(job_key, "llm_done", cv_details=json.dumps(cv_details))
+
+        output_file = await self._write_output(cv_details, file_name, file_hash, unique_key, job_key)
+        result = {"file_name": file_name, "status": "succeeded", "output_file": output_file, "cv_details": cv_details}
+        if near_duplicate is not None:
+            result["near_duplicate_of"] = near_duplicate
+        return result
+
+
+    #near-duplicates only share an extraction when it was made with the same prompt and model settings
+    def _get_near_duplicate_scope(self, prompt):
+        return ResultCache.hash_content(f"{ResultCache.hash_content(prompt)}|{self.config_variables['azure_openai_deployment_name']}|"
+                                        f"{self.config_variables['azure_openai_temperature']}")
+
+
+    #index a new extraction for later near-duplicates, when the index is enabled and the text was long enough to sign
+    async def _near_duplicate_add(self, scope, signature, file_hash, file_name, cv_details):
+        if self.near_duplicate_index is not None and signature is not None:
+            await asyncio.to_thread(self.near_duplicate_index.add, scope, signature, file_hash, file_name, json.dumps(cv_details))
+
+
+    #extract the PDF text layer, or None if it or one of its pages is empty or below the quality threshold
+    def _get_pdf_text_layer(self, file_name, app_logging):
+        langchain_manager = LangchainChunkManager(file_name, "application/pdf", app_logging)
+        text = langchain_manager.get_pdf_text_layer(self.config_variables["pdf_text_min_chars"],
+                                                    self.config_variables["pdf_text_min_printable_ratio"],
+                                                    self.config_variables["pdf_text_min_page_chars"])
+        if text is not None:
+            app_logging.info("Using the PDF text layer, skipping blob upload and OCR")
+        return text
+
+
+    #look up a cached result, if caching is enabled
+    async def _cache_get(self, namespace, key, app_logging):
+        if self.result_cache is None:
+            return None
+        value = await asyncio.to_thread(self.result_cache.get, namespace, key)
+        if value is not None:
+            app_logging.info(f"Result cache hit for {namespace} key {key[:12]}")
+        return value
+
+
+    #store a result in the cache, if caching is enabled
+    async def _cache_set(self, namespace, key, value):
+        if self.result_cache is not None:
+            await asyncio.to_thread(self.result_cache.set, namespace, key, value)
     
     
+    #look up the checkpoints of a job, an empty dict if it is new or the job store is disabled
+    async def _job_get(self, job_key, app_logging):
+        if self.job_store is None:
+            return {}
+        job = await asyncio.to_thread(self.job_store.get, job_key) or {}
+        if job:
+            app_logging.info(f"Resuming job {job_key[:12]} after stage {job['stage']}")
+        return job
+
+
+    #record a completed stage of a job, if the job store is enabled
+    async def _job_checkpoint(self, job_key, stage, **fields):
+        if self.job_store is not None:
+            await asyncio.to_thread(self.job_store.checkpoint, job_key, stage, **fields)
+
+
+    #write the CV details, and mark the jobs whose output is now on disk as saved. In the "jsonl" mode and with an
+    #export that can be earlier CVs, while this one stays at llm_done with its CV details until its record is flushed
+    #writing a file, appending a buffer or a Parquet row group is disk work, so it runs in a worker thread and does not
+    #hold up the other documents on the event loop. The writer takes a lock, so concurrent writes are safe
+    async def _write_output(self, cv_details, file_name, file_hash, unique_key, job_key):
+        output_file, written_jobs = await asyncio.to_thread(self.output_writer.write, cv_details, file_name, file_hash, unique_key, job_key)
+        await self._jobs_saved(written_jobs)
+        return output_file
+
+
+    async def _jobs_saved(self, written_jobs):
+        for job_key, output_file in written_jobs:
+            await self._job_saved(job_key, output_file)
+
+
+    async def flush_output_async(self):
+        """Write the buffered CV details and mark their jobs as saved."""
+        await self._jobs_saved(await asyncio.to_thread(self.output_writer.flush))
+
+
+    async def close_output_async(self):
+        """Write the buffered CV details, close the output export and mark the jobs as saved."""
+        await self._jobs_saved(await asyncio.to_thread(self.output_writer.close))
+
+
+    def close_output(self):
+        """Synchronous entry point for close_output_async."""
+        return run_sync(self.close_output_async())
+
+
+    #a saved job only keeps where its output went. The OCR text and CV details are dropped, so the job store does not
+    #hold a copy of every CV's personal data after it is done; the result cache keeps them, with its own TTL
+    async def _job_saved(self, job_key, output_file):
+        await self._job_checkpoint(job_key, "saved", output_file=output_file, ocr_text=None, cv_details=None, sas_url=None,
+                             sas_expires_at=None, operation_location=None)
+
+
     #read the LLM prompt text file
     def _read_prompt(self, prompt_file_path):
         try:
@@ -91,86 +655,307 @@ class Application:
             exit(1)
        
     
-    #handle the vision processing
-    def _azure_vision(self, file_name, file_type, data, prompt):
-        #instantiate AzureBlobManager
-        blob_manager = AzureBlobManager(endpoint_url = self.config_variables["azure_storage_endpoint_url"],
-                                        tenant_id = self.config_variables["azure_storage_tenant_id"],
-                                        grant_type = self.config_variables["azure_storage_grant_type"],
-                                        client_id = self.config_variables["azure_storage_client_id"],
-                                        client_secret = self.config_variables["azure_storage_client_secret"],
-                                        scope = self.config_variables["azure_storage_scope"],
-                                        file_name=file_name,
-                                        app_logging = self.app_logging)
-        
-        #upload the CV file to Azure Storage
-        blob_manager.upload_file(self.config_variables["azure_storage_account_url"], 
-                                self.config_variables["azure_storage_account_container_name"], 
-                                self.config_variables["azure_storage_account_prefix"], 
-                                file_type,
-                                data,
-                                self.config_variables["azure_storage_file_tags"])
+    #handle the vision processing and return the OCR text, skipping the stages a previous run already completed
+    async def _azure_vision(self, file_name, file_type, app_logging, job_key, job):
+        unique_key = app_logging.extra["unique_key"]
+        stage_index = JOB_STAGES.index(job["stage"]) if job else 0
+
+        #all stages of all documents share one connection pool on this event loop
+        http_client = get_async_http_client(self.config_variables["http_max_connections"])
+
+        #the blob name starts with the job key, so files with the same name in different folders do not overwrite each other
+        base_name = file_name.replace("\\", "/").split("/")[-1]
+        blob_name = job.get("blob_name") or f"{job_key[:16]}_{base_name}"
+
+        #instantiate AsyncAzureBlobManager
+        blob_manager = AsyncAzureBlobManager(endpoint_url = self.config_variables["azure_storage_endpoint_url"],
+                                             tenant_id = self.config_variables["azure_storage_tenant_id"],
+                                             grant_type = self.config_variables["azure_storage_grant_type"],
+                                             client_id = self.config_variables["azure_storage_client_id"],
+                                             client_secret = self.config_variables["azure_storage_client_secret"],
+                                             scope = self.config_variables["azure_storage_scope"],
+                                             file_name=blob_name,
+                                             app_logging = app_logging,
+                                             http_client = http_client,
+                                             credential_cache = self.credential_cache,
+                                             resilience = self.resilience)
         
-        #get the SAS token URL
-        sas_token = blob_manager.get_user_delegated_sas_token(self.config_variables["azure_storage_account_url"],
-                                                        self.config_variables["azure_storage_account_container_name"],
-                                                        self.config_variables["azure_storage_account_prefix"],
-                                                        self.config_variables["azure_storage_sas_valid_hours"])
+        #get the access token up front, so its (usually cached) cost is measured on its own
+        with self.metrics.span(unique_key, "token"):
+            await blob_manager.get_token()
 
+        #stream the CV file to Azure Storage, in parallel blocks if it is large
+        if stage_index < JOB_STAGES.index("uploaded"):
+            #large photos and scans are shrunk first on the process pool, so less is uploaded and OCR'd
+            upload_file_name, upload_file_type = file_name, file_type
+            if self.image_preprocessor is not None:
+                with self.metrics.span(unique_key, "preprocess", bytes=os.path.getsize(file_name)):
+                    preprocessed = await self.image_preprocessor.preprocess(file_name, file_type, app_logging)
+                if preprocessed is not None:
+                    upload_file_name, upload_file_type = preprocessed
+                    self.metrics.increment("bytes", "preprocess_saved", os.path.getsize(file_name) - os.path.getsize(upload_file_name))
+
+            try:
+                with self.metrics.span(unique_key, "upload", bytes=os.path.getsize(upload_file_name)) as attributes:
+                    response = await blob_manager.upload_file_from_path(self.config_variables["azure_storage_account_url"], 
+                                            self.config_variables["azure_storage_account_container_name"], 
+                                            self.config_variables["azure_storage_account_prefix"], 
+                                            upload_file_type,
+                                            upload_file_name,
+                                            self.config_variables["azure_storage_file_tags"],
+                                            single_put_max_bytes = self.config_variables["upload_single_put_max_bytes"],
+                                            block_size = self.config_variables["upload_block_size_bytes"],
+                                            max_concurrency = self.config_variables["upload_max_concurrency"])
+            finally:
+                if upload_file_name != file_name:
+                    os.remove(upload_file_name)
+            if response is None:
+                raise DependencyUnavailableError("storage", "upload failed without a response, see the log")
+            if response.status_code >= 300:
+                #a large file fails either on one of its blocks or on the commit of the block list
+                stage = {"block": "block upload", "blocklist": "block commit"}.get(response.request.url.params.get("comp"), "upload")
+                raise DependencyUnavailableError("storage", f"{stage} failed with HTTP {response.status_code}")
+            self.metrics.increment("bytes", "upload", attributes["bytes"])
+            await self._job_checkpoint(job_key, "uploaded", blob_name=blob_name)
         
-        #instantiate AzureDocIntel for OCR 
-        ocr_manager = AzureDocIntel(self.config_variables["azure_vision_full_endpoint"],
-                                    self.config_variables["azure_vision_headers"],
-                                    sas_token,
-                                    self.app_logging)
+        #get the SAS token URL, reusing the one of a previous run while it is valid for longer than the OCR deadline
+        sas_token = job.get("sas_url")
+        if sas_token is None or job.get("sas_expires_at", 0) < time.time() + self.config_variables["azure_vision_poll_deadline_seconds"]:
+            with self.metrics.span(unique_key, "sas"):
+                sas_token = await blob_manager.get_user_delegated_sas_token(self.config_variables["azure_storage_account_url"],
+                                                                self.config_variables["azure_storage_account_container_name"],
+                                                                self.config_variables["azure_storage_account_prefix"],
+                                                                self.config_variables["azure_storage_sas_valid_hours"])
+            if sas_token is None:
+                raise DependencyUnavailableError("storage", "SAS token could not be generated, see the log")
+            await self._job_checkpoint(job_key, "sas_issued" if stage_index < JOB_STAGES.index("sas_issued") else None,
+                                 sas_url=sas_token, sas_expires_at=self._get_sas_expiry(sas_token))
+
+        #instantiate AsyncAzureDocIntel for OCR 
+        ocr_manager = AsyncAzureDocIntel(self.config_variables["azure_vision_full_endpoint"],
+                                         self.config_variables["azure_vision_headers"],
+                                         sas_token,
+                                         app_logging,
+                                         http_client,
+                                         OcrPollingPolicy(initial_delay=self.config_variables["azure_vision_poll_initial_seconds"],
+                                                          max_delay=self.config_variables["azure_vision_poll_max_seconds"],
+                                                          deadline=self.config_variables["azure_vision_poll_deadline_seconds"]),
+                                         self.resilience)
         
-        #get ocr data
-        ocr_response, ocr_text = ocr_manager.get_ocr_text()
+        #get ocr data, reopening the operation of a previous run if there is one. The operation location is
+        #checkpointed as soon as it is known, so a crash while polling does not pay for a second OCR
+        checkpoint_operation = lambda operation_location: self._job_checkpoint(job_key, "ocr_submitted", operation_location=operation_location)
+        ocr_response, ocr_text = await ocr_manager.get_ocr_text(job.get("operation_location"), checkpoint_operation)
+        if ocr_text is None and ocr_manager.poll_stats["status"] == "not_found":
+            await self._job_checkpoint(job_key, "sas_issued", operation_location=None)
+            ocr_manager = AsyncAzureDocIntel(ocr_manager.full_endpoint, ocr_manager.headers, sas_token, app_logging, http_client, ocr_manager.polling_policy,
+                                             self.resilience)
+            ocr_response, ocr_text = await ocr_manager.get_ocr_text(None, checkpoint_operation)
 
-        #process chunking and LLM response
-        if ocr_text:
-            llm_text = self._langchain_chunking(ocr_text, prompt)
-            return llm_text
-        return None
+        #a failed or canceled operation stays that way, so forget it and let the next run submit the document again
+        if ocr_text is None and ocr_manager.poll_stats["status"] in ["failed", "canceled"]:
+            await self._job_checkpoint(job_key, "sas_issued", operation_location=None)
+
+        #split the OCR time into the submit and the polling until a final status
+        poll_stats = ocr_manager.poll_stats
+        if poll_stats["submit_seconds"] is not None:
+            self.metrics.record(unique_key, "ocr_submit", poll_stats["submit_seconds"])
+        if poll_stats["time_to_result_seconds"] is not None:
+            self.metrics.record(unique_key, "ocr_poll", poll_stats["time_to_result_seconds"] - (poll_stats["submit_seconds"] or 0),
+                                "ok" if ocr_text else "error", polls=poll_stats["poll_count"], ocr_status=poll_stats["status"])
+            self.metrics.increment("polls", "ocr_poll", poll_stats["poll_count"])
+        if ocr_text is None:
+            status = poll_stats["status"] or "error"
+            raise DependencyUnavailableError("ocr_submit" if status.startswith("submit") else "ocr_poll", f"OCR ended with status {status}")
+        return ocr_text
+
+
+    #expiry of a SAS URL as epoch seconds, taken from its se parameter
+    @staticmethod
+    def _get_sas_expiry(sas_token):
+        expiry = parse_qs(urlparse(sas_token).query).get("se", [None])[0]
+        if expiry is None:
+            return 0
+        return datetime.strptime(expiry, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc).timestamp()
     
     
+    #chunk manager for OCR text, sized to the token budget of the prompt
+    def _get_chunk_manager(self, ocr_text, prompt, app_logging):
+        return LangchainChunkManager(ocr_text, "text", app_logging,
+                                     max_chunk_tokens=self._get_chunk_token_budget(prompt),
+                                     model_name=self.config_variables["azure_openai_deployment_name"],
+                                     overlap_ratio=self.config_variables["chunk_overlap_ratio"],
+                                     strip_layout_noise=self.config_variables["chunk_strip_layout_noise"],
+                                     page_edge_lines=self.config_variables["chunk_page_edge_lines"])
+
+
     #get text to pass to LLM using langchain
-    def _langchain_chunking(self, ocr_text, prompt):
-        langchain_manager = LangchainChunkManager(ocr_text, "text", self.app_logging)
-        langchain_text = langchain_manager.process()
+    async def _langchain_chunking(self, ocr_text, prompt, app_logging):
+        langchain_manager = self._get_chunk_manager(ocr_text, prompt, app_logging)
+        with self.metrics.span(app_logging.extra["unique_key"], "chunk") as attributes:
+            langchain_text = await asyncio.to_thread(langchain_manager.process)
+            attributes["chunks"] = len(langchain_text or [])
         
         if langchain_text:
-            llm_response = self._get_llm_response(langchain_text, prompt)
+            llm_response = await self._get_llm_response(langchain_text, prompt, app_logging)
             return llm_response
         return None
 
     
-    #get LLM response
-    def _get_llm_response(self, langchain_text, prompt):
-        llm_response = ""
-        for text in langchain_text:
+    #tokens left for CV text in one request: the context window minus the prompt, the expected completion and
+    #a small allowance for the chat message framing, optionally capped by CV_CHUNK_MAX_TOKENS
+    def _get_chunk_token_budget(self, prompt):
+        budget = (self.config_variables["azure_openai_context_tokens"]
+                  - count_tokens(prompt, self.config_variables["azure_openai_deployment_name"])
+                  - self.config_variables["azure_openai_completion_token_estimate"]
+                  - 100)
+        if self.config_variables["chunk_max_tokens"]:
+            budget = min(budget, self.config_variables["chunk_max_tokens"])
+        return max(budget, 1000)
+
+    
+    #get the shared LLM client for this prompt, rebuilding it if the event loop (and so the http client) changed
+    def _get_llm_manager(self, prompt):
+        http_client = get_async_http_client(self.config_variables["http_max_connections"])
+        llm_manager = self.llm_managers.get(prompt)
+        if llm_manager is None or llm_manager.http_async_client is not http_client:
             llm_manager = LangchainLLMManager(prompt,
-                                            text,
-                                            self.config_variables["azure_openai_endpoint"],
-                                            self.config_variables["azure_openai_deployment_name"],
-                                            self.config_variables["azure_openai_api_version"],
+                                              self.config_variables["azure_openai_endpoint"],
+                                              self.config_variables["azure_openai_deployment_name"],
+                                              self.config_variables["azure_openai_api_version"],
+                                              self.config_variables["azure_openai_key"],
+                                              self.config_variables["azure_openai_temperature"],
+                                              None,
+                                              self.app_logging,
+                                              http_client,
+                                              self.config_variables["azure_openai_max_concurrency"],
+                                              self.rate_limiter,
+                                              self.config_variables["azure_openai_max_retries"],
+                                              self.config_variables["azure_openai_completion_token_estimate"],
+                                              self.resilience)
+            self.llm_managers[prompt] = llm_manager
+        return llm_manager
+
+
+    #get the packing batcher of the shared LLM client for this prompt
+    def _get_llm_packer(self, prompt):
+        llm_manager = self._get_llm_manager(prompt)
+        llm_packer = self.llm_packers.get(prompt)
+        if llm_packer is None or llm_packer.llm_manager is not llm_manager:
+            #the whole context window minus the prompt and room for the packing instructions and CV markers
+            max_input_tokens = (self.config_variables["azure_openai_context_tokens"]
+                                - count_tokens(prompt, self.config_variables["azure_openai_deployment_name"])
+                                - 300)
+            llm_packer = LlmPackingBatcher(llm_manager,
+                                           max_input_tokens,
+                                           self.config_variables["azure_openai_completion_token_estimate"],
+                                           self.config_variables["packing_max_documents"],
+                                           self.config_variables["packing_max_wait_seconds"])
+            self.llm_packers[prompt] = llm_packer
+        return llm_packer
+
+
+    #short single-chunk CVs can share one request with other CVs when packing is enabled
+    def _can_pack(self, langchain_text):
+        return (self.config_variables["packing_enabled"]
+                and len(langchain_text) == 1
+                and count_tokens(langchain_text[0], self.config_variables["azure_openai_deployment_name"]) <= self.config_variables["packing_max_document_tokens"])
+
+
+    def _get_llm_batch_manager(self):
+        return AsyncAzureOpenAIBatchManager(self.config_variables["azure_openai_endpoint"],
                                             self.config_variables["azure_openai_key"],
+                                            self.config_variables["azure_openai_batch_api_version"],
+                                            self.config_variables["azure_openai_batch_deployment_name"],
                                             self.config_variables["azure_openai_temperature"],
-                                            None,
-                                            self.app_logging)
+                                            self.app_logging,
+                                            get_async_http_client(self.config_variables["http_max_connections"]),
+                                            self.config_variables["llm_batch_poll_seconds"],
+                                            resilience=self.resilience)
 
-            llm_response += llm_manager.generate_response()
-        return llm_response
-    
 
-    #save the cv response from the LLM
-    def _save_cv_details(self, cv_details):
-        """Save the CV details output to a file."""
-        with open("cv_details_output\\cv_details.json", "w") as f:
-            f.write(cv_details)
+    #chunk the queued documents and submit their requests as one or more Batch API jobs, keeping every chunk of a
+    #document in the same job. A manifest per job maps its requests back to the documents. Returns file name -> batch id
+    async def _submit_llm_batch_documents(self, queued, prompt):
+        llm_manager = self._get_llm_manager(prompt)
+        batch_manager = self._get_llm_batch_manager()
+        os.makedirs(self.config_variables["llm_batch_dir"], exist_ok=True)
+
+        groups = [([], {})]
+        for document in queued:
+            app_logging = self._get_document_logger(document["unique_key"], document["file_name"])
+            chunks = await asyncio.to_thread(self._get_chunk_manager(document["ocr_text"], prompt, app_logging).process)
+            if not chunks:
+                continue
+            requests, documents = groups[-1]
+            if requests and len(requests) + len(chunks) > self.config_variables["llm_batch_max_requests_per_file"]:
+                groups.append(([], {}))
+                requests, documents = groups[-1]
+            requests.extend((f"{document['job_key']}:{index}", llm_manager.build_chat_messages(chunk)) for index, chunk in enumerate(chunks))
+            documents[document["job_key"]] = {"file_name": document["file_name"], "file_hash": document["file_hash"],
+                                              "llm_key": document["llm_key"], "unique_key": document["unique_key"], "chunks": len(chunks),
+                                              "near_duplicate_scope": document["near_duplicate_scope"],
+                                              "near_duplicate_signature": document["near_duplicate_signature"]}
+
+        batch_ids = {}
+        for requests, documents in groups:
+            if not requests:
+                continue
+            input_path = os.path.join(self.config_variables["llm_batch_dir"], f"input_{time.strftime('%Y%m%d_%H%M%S')}_{self._generate_random_key()}.jsonl")
+            batch = await batch_manager.submit(requests, input_path)
+            if batch is None:
+                continue
+            manifest = {"batch_id": batch["id"], "input_file": input_path, "input_file_id": batch.get("input_file_id"),
+                        "created_at": time.time(), "requests": len(requests), "documents": documents}
+            with open(os.path.join(self.config_variables["llm_batch_dir"], f"{batch['id']}.json"), "w") as f:
+                json.dump(manifest, f, indent=2)
+            batch_ids.update({document["file_name"]: batch["id"] for document in documents.values()})
+        return batch_ids
+
+
+    #get LLM response, sending all chunks concurrently and merging their JSON results locally into one object
+    async def _get_llm_response(self, langchain_text, prompt, app_logging):
+        llm_manager = self._get_llm_manager(prompt)
+        stats = {}
+        with self.metrics.span(app_logging.extra["unique_key"], "llm", chunks=len(langchain_text)) as attributes:
+            if self._can_pack(langchain_text):
+                result = await self._get_llm_packer(prompt).extract(langchain_text[0], app_logging, stats)
+                llm_response = [result] if result is not None else None
+            else:
+                llm_response = await llm_manager.agenerate_json_responses(langchain_text, app_logging, stats)
+            attributes.update(stats)
+        self.metrics.increment("tokens", "llm", stats.get("tokens", 0))
+        self.metrics.increment("retries", "llm", stats.get("retries", 0))
+        if llm_response is None:
+            return None
+        return merge_llm_results(llm_response)
 
 
 # Start processing
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract structured CV details using Azure OCR and Azure OpenAI.")
+    parser.add_argument("source", nargs="?", default="c:\\temp\\cv_llm_app\\1.png",
+                        help="A CV file, or for --batch a directory, glob pattern or manifest file")
+    parser.add_argument("--prompt", default="prompt.txt", help="Path to the LLM prompt file")
+    parser.add_argument("--batch", action="store_true", help="Process many CV files concurrently")
+    parser.add_argument("--workers", type=int, default=None, help="Maximum number of CVs processed at once in batch mode")
+    parser.add_argument("--resume", action="store_true", help="Continue the unfinished jobs of an interrupted run")
+    parser.add_argument("--llm-batch", action="store_true", help="OCR the CVs now and queue their LLM extraction as Azure OpenAI Batch API jobs")
+    parser.add_argument("--collect-llm-batch", metavar="BATCH_ID", help="Save the results of a Batch API job submitted with --llm-batch")
+    parser.add_argument("--no-wait", action="store_true", help="With --collect-llm-batch, check the batch once instead of waiting for it")
+    args = parser.parse_args()
+
     app = Application()
-    app.process_files("c:\\temp\\cv_llm_app\\1.png", "prompt.txt")
\ No newline at end of file
+    if args.llm_batch or args.collect_llm_batch:
+        results = app.collect_llm_batch(args.collect_llm_batch, not args.no_wait) if args.collect_llm_batch else app.submit_llm_batch(args.source, args.prompt, args.workers)
+        for result in results:
+            print(f"{result['status']:<22} {result['file_name']}  {result.get('llm_batch_id') or result.get('error', '')}")
+    elif args.batch or args.resume:
+        results = app.resume_batch(args.prompt, args.workers) if args.resume else app.process_batch(args.source, args.prompt, args.workers)
+        for result in results:
+            print(f"{result['status']:<17} {result['elapsed_seconds']:>8.2f}s  {result['file_name']}  {result.get('error', '')}")
+    else:
+        app.process_files(args.source, args.prompt)
+    app.close_output()
+    if app.image_preprocessor is not None:
+        app.image_preprocessor.close()
@@ -0,0 +1,192 @@
+import os
+import re
+import json
+import time
+import uuid
+import asyncio
+from urllib.parse import parse_qs
+from main_application import Application
+from classes.async_http_client import close_async_http_client
+
+
+class ServerApplication:
+    def __init__(self):
+        """
+        Long-running HTTP service around Application, as a plain ASGI app. The config, credential cache, HTTP
+        connection pool and LLM client are created once and stay warm for every CV, instead of once per process.
+
+        POST /jobs?file_name=cv.pdf  body is the CV file, returns 202 with a job id, or 503 when the queue is full
+        GET  /jobs/<job id>          status of the job
+        GET  /jobs/<job id>/result   the extracted CV details once the job succeeded
+        GET  /health                 queue and worker state
+        GET  /metrics                per-stage metrics in the Prometheus text format
+        """
+        self.application = Application()
+        self.app_logging = self.application.app_logging
+        self.config_variables = self._load_config_variables()
+        self.prompt = self.application._read_prompt(self.config_variables["prompt_file"])
+
+        #jobs by id, and the bounded queue that gives backpressure when the workers cannot keep up
+        self.jobs = {}
+        self.queue = None
+        self.semaphore = None
+        self.workers = []
+        self.running = 0
+
+
+    #load the server config variables
+    def _load_config_variables(self):
+        return {
+            "prompt_file": os.environ.get("CV_SERVER_PROMPT_FILE", "prompt.txt"),
+            "host": os.environ.get("CV_SERVER_HOST", "127.0.0.1"),
+            "port": int(os.environ.get("CV_SERVER_PORT", 8000)),
+            "workers": int(os.environ.get("CV_SERVER_WORKERS", self.application.config_variables["batch_max_workers"])),
+            "queue_size": int(os.environ.get("CV_SERVER_QUEUE_SIZE", 100)),
+            "upload_dir": os.environ.get("CV_SERVER_UPLOAD_DIR", "server_uploads"),
+            "max_upload_bytes": int(os.environ.get("CV_SERVER_MAX_UPLOAD_BYTES", 50 * 1024 * 1024)),
+            "job_ttl_seconds": int(os.environ.get("CV_SERVER_JOB_TTL_SECONDS", 3600)),
+        }
+
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+
+        method, path = scope["method"], scope["path"].rstrip("/")
+        if method == "POST" and path == "/jobs":
+            return await self._create_job(scope, receive, send)
+        if method == "GET" and path == "/health":
+            return await self._send_json(send, 200, {"status": "ok", "queued": self.queue.qsize() if self.queue else 0,
+                                                     "running": self.running, "workers": self.config_variables["workers"], "jobs": len(self.jobs)})
+        if method == "GET" and path == "/metrics":
+            return await self._send(send, 200, self.application.metrics.to_prometheus().encode("utf-8"), "text/plain; version=0.0.4")
+
+        match = re.fullmatch(r"/jobs/([0-9a-f]{32})(/result)?", path)
+        if method == "GET" and match:
+            job = self.jobs.get(match.group(1))
+            if job is None:
+                return await self._send_json(send, 404, {"error": "Unknown job id"})
+            if match.group(2) is None:
+                return await self._send_json(send, 200, {key: value for key, value in job.items() if key != "cv_details"})
+            if job["status"] != "succeeded":
+                return await self._send_json(send, 409, {"error": f"Job is {job['status']}", "status": job["status"]})
+            return await self._send_json(send, 200, job["cv_details"])
+        return await self._send_json(send, 404, {"error": "Not found"})
+
+
+    #start the workers on the server's event loop, and stop them cleanly on shutdown
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                os.makedirs(self.config_variables["upload_dir"], exist_ok=True)
+                self.queue = asyncio.Queue(maxsize=self.config_variables["queue_size"])
+                self.semaphore = asyncio.Semaphore(self.config_variables["workers"])
+                self.workers = [asyncio.create_task(self._worker()) for _ in range(self.config_variables["workers"])]
+                self.workers.append(asyncio.create_task(self._expire_jobs()))
+                self.app_logging.info(f"Server started with {self.config_variables['workers']} workers")
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                for worker in self.workers:
+                    worker.cancel()
+                await asyncio.gather(*self.workers, return_exceptions=True)
+                await self.application.close_output_async()
+                self.application.export_metrics()
+                if self.application.image_preprocessor is not None:
+                    self.application.image_preprocessor.close()
+                await close_async_http_client()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+    #stream the uploaded CV to disk and queue it, refusing it when the queue is full
+    async def _create_job(self, scope, receive, send):
+        if self.queue.full():
+            return await self._send_json(send, 503, {"error": "Queue is full, retry later"}, {"Retry-After": "5"})
+
+        query = parse_qs(scope.get("query_string", b"").decode())
+        original_name = os.path.basename(query.get("file_name", ["cv"])[0].replace("\\", "/")) or "cv"
+        job_id = uuid.uuid4().hex
+        file_name = os.path.join(self.config_variables["upload_dir"], f"{job_id}_{original_name}")
+
+        size = 0
+        with open(file_name, "wb") as f:
+            more_body = True
+            while more_body:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    f.close()
+                    os.remove(file_name)
+                    return
+                chunk = message.get("body", b"")
+                size += len(chunk)
+                if size > self.config_variables["max_upload_bytes"]:
+                    f.close()
+                    os.remove(file_name)
+                    return await self._send_json(send, 413, {"error": f"CV is larger than {self.config_variables['max_upload_bytes']} bytes"})
+                f.write(chunk)
+                more_body = message.get("more_body", False)
+
+        job = {"job_id": job_id, "file_name": original_name, "status": "queued", "error": None, "queued_at": time.time(),
+               "finished_at": None, "elapsed_seconds": None, "unique_key": None, "cv_details": None}
+        try:
+            self.queue.put_nowait((job_id, file_name))
+        except asyncio.QueueFull:
+            os.remove(file_name)
+            return await self._send_json(send, 503, {"error": "Queue is full, retry later"}, {"Retry-After": "5"})
+        self.jobs[job_id] = job
+        return await self._send_json(send, 202, {"job_id": job_id, "status": "queued"}, {"Location": f"/jobs/{job_id}"})
+
+
+    #take CVs off the queue and run them through the warm Application, one at a time per worker
+    async def _worker(self):
+        while True:
+            job_id, file_name = await self.queue.get()
+            job = self.jobs.get(job_id)
+            self.running += 1
+            try:
+                if job is not None:
+                    job["status"] = "running"
+                    result = await self.application._process_batch_file(file_name, self.prompt, self.semaphore, keep_details=True)
+                    job.update({"status": result["status"], "error": result.get("error"), "unique_key": result["unique_key"],
+                                "elapsed_seconds": result["elapsed_seconds"], "cv_details": result.get("cv_details"),
+                                "finished_at": time.time()})
+            finally:
+                self.running -= 1
+                os.remove(file_name)
+                self.queue.task_done()
+
+
+    #forget finished jobs after CV_SERVER_JOB_TTL_SECONDS, so the job table does not grow forever. Buffered CV details
+    #are written out on the same schedule, so their jobs are marked saved without waiting for the shutdown
+    async def _expire_jobs(self):
+        while True:
+            await asyncio.sleep(60)
+            await self.application.flush_output_async()
+            self.application.export_metrics()
+            cutoff = time.time() - self.config_variables["job_ttl_seconds"]
+            for job_id in [job_id for job_id, job in self.jobs.items() if job["finished_at"] and job["finished_at"] < cutoff]:
+                del self.jobs[job_id]
+
+
+    async def _send(self, send, status, body, content_type, headers=None):
+        header_list = [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())]
+        header_list += [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()]
+        await send({"type": "http.response.start", "status": status, "headers": header_list})
+        await send({"type": "http.response.body", "body": body})
+
+
+    async def _send_json(self, send, status, payload, headers=None):
+        await self._send(send, status, json.dumps(payload).encode("utf-8"), "application/json", headers)
+
+
+# ASGI entry point, e.g. uvicorn server_application:app
+app = ServerApplication()
+
+
+# Start serving
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host=app.config_variables["host"], port=app.config_variables["port"])
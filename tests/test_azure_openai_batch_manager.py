@@ -0,0 +1,178 @@
+"""
+Tests for the Azure OpenAI Batch API flow against the local stand-ins in benchmarks/azure_stand_ins.py.
+
+Run from the repository root:
+    python -m unittest discover -s tests
+"""
+import os
+import json
+import shutil
+import logging
+import asyncio
+import tempfile
+import unittest
+from unittest import mock
+
+from benchmarks.azure_stand_ins import AzureStandInServer, SYNTHETIC_CV_DETAILS
+from benchmarks.run_benchmark import BENCHMARK_PROMPT, build_corpus
+from classes.async_http_client import close_async_http_client
+from classes.azure_openai_batch_manager import AsyncAzureOpenAIBatchManager
+
+MESSAGES = [{"role": "system", "content": "Extract the CV details as JSON."}, {"role": "user", "content": "Jane Doe"}]
+
+
+#run a coroutine on a new event loop and close that loop's shared client afterwards
+def run(coroutine):
+    async def _runner():
+        try:
+            return await coroutine
+        finally:
+            await close_async_http_client()
+    return asyncio.run(_runner())
+
+
+class BatchManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.stand_in = AzureStandInServer(latency_seconds=0.0, batch_running_seconds=0.0).start()
+        self.work_dir = tempfile.mkdtemp(prefix="cv_batch_test_")
+        self.manager = AsyncAzureOpenAIBatchManager(self.stand_in.base_url, "stand-in", "2024-10-21", "gpt-4o-batch", "0",
+                                                    logging.getLogger(__name__), poll_interval=0.05, deadline=5.0)
+
+    def tearDown(self):
+        self.stand_in.stop()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def test_build_request_lines(self):
+        content = self.manager.build_request_lines([("a:0", MESSAGES), ("b:1", MESSAGES)])
+        self.assertTrue(content.endswith("\n"))
+        lines = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([line["custom_id"] for line in lines], ["a:0", "b:1"])
+        for line in lines:
+            self.assertEqual(line["method"], "POST")
+            self.assertEqual(line["url"], "/chat/completions")
+            self.assertEqual(line["body"], {"model": "gpt-4o-batch", "messages": MESSAGES, "temperature": 0.0})
+
+    def test_build_request_lines_without_temperature(self):
+        self.manager.temperature = None
+        line = json.loads(self.manager.build_request_lines([("a:0", MESSAGES)]))
+        self.assertNotIn("temperature", line["body"])
+
+    def test_submit_and_get_results(self):
+        input_path = os.path.join(self.work_dir, "input.jsonl")
+        requests = [("a:0", MESSAGES), ("b:0", MESSAGES)]
+
+        async def submit_and_collect():
+            batch = await self.manager.submit(requests, input_path)
+            finished = await self.manager.wait_for_batch(batch["id"])
+            return batch, finished, await self.manager.get_results(finished)
+
+        batch, finished, results = run(submit_and_collect())
+        with open(input_path) as f:
+            self.assertEqual(f.read(), self.manager.build_request_lines(requests))
+        self.assertIn(batch["input_file_id"], self.stand_in.files)
+        self.assertEqual(finished["status"], "completed")
+        self.assertEqual(finished["request_counts"], {"total": 2, "completed": 2, "failed": 0})
+        self.assertEqual(set(results), {"a:0", "b:0"})
+        self.assertEqual(json.loads(results["a:0"]), SYNTHETIC_CV_DETAILS)
+
+    def test_failed_and_missing_lines_are_left_out(self):
+        self.stand_in.failed_batch_requests.add("b:0")
+        self.stand_in.missing_batch_requests.add("c:0")
+
+        async def submit_and_collect():
+            batch = await self.manager.submit([("a:0", MESSAGES), ("b:0", MESSAGES), ("c:0", MESSAGES)],
+                                              os.path.join(self.work_dir, "input.jsonl"))
+            finished = await self.manager.wait_for_batch(batch["id"])
+            return finished, await self.manager.get_results(finished)
+
+        finished, results = run(submit_and_collect())
+        self.assertEqual(finished["request_counts"], {"total": 3, "completed": 1, "failed": 2})
+        self.assertIsNotNone(finished["error_file_id"])
+        self.assertEqual(set(results), {"a:0"})
+
+    def test_batch_without_output_file(self):
+        self.assertEqual(run(self.manager.get_results({"id": "batch_1", "status": "failed", "output_file_id": None})), {})
+
+
+class CollectLlmBatchTest(unittest.TestCase):
+    def setUp(self):
+        #the batch completes at its first poll after 1s, so a test can choose which lines fail before collecting
+        self.stand_in = AzureStandInServer(latency_seconds=0.0, ocr_running_seconds=0.0, batch_running_seconds=1.0).start()
+        self.work_dir = tempfile.mkdtemp(prefix="cv_batch_test_")
+        environment = dict(self.stand_in.environment(), **{
+            "CV_LLM_BATCH_DIR": os.path.join(self.work_dir, "batch_jobs"),
+            "CV_LLM_BATCH_POLL_SECONDS": "0.1",
+            "CV_OUTPUT_DIR": os.path.join(self.work_dir, "output"),
+            "CV_OUTPUT_NAMING": "hash",
+            "CV_CACHE_ENABLED": "false",
+            "CV_NEAR_DUPLICATE_ENABLED": "false",
+            "CV_JOB_STORE_PATH": os.path.join(self.work_dir, "jobs", "cv_jobs.sqlite3"),
+            "CV_METRICS_JSONL_PATH": os.path.join(self.work_dir, "metrics", "spans.jsonl"),
+            "CV_METRICS_PROMETHEUS_PATH": os.path.join(self.work_dir, "metrics", "cv_pipeline.prom"),
+            "CV_LOG_FILE": os.path.join(self.work_dir, "audit_log", "cv_llm.log"),
+        })
+        self.environment = mock.patch.dict(os.environ, environment)
+        self.environment.start()
+
+        from main_application import Application
+        self.application = Application()
+        self.files = build_corpus(os.path.join(self.work_dir, "corpus"), 3, ["png"], 300, 400)
+        self.prompt_file = os.path.join(self.work_dir, "prompt.txt")
+        with open(self.prompt_file, "w") as f:
+            f.write(BENCHMARK_PROMPT)
+
+    def tearDown(self):
+        self.environment.stop()
+        self.stand_in.stop()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def _submit(self):
+        results = self.application.submit_llm_batch(self.files, self.prompt_file)
+        self.assertEqual([result["status"] for result in results], ["queued_for_llm_batch"] * len(self.files))
+        batch_id = results[0]["llm_batch_id"]
+        self.assertTrue(all(result["llm_batch_id"] == batch_id for result in results))
+        with open(os.path.join(self.application.config_variables["llm_batch_dir"], f"{batch_id}.json")) as f:
+            return batch_id, json.load(f)
+
+    def test_custom_ids_map_to_documents_and_chunks(self):
+        batch_id, manifest = self._submit()
+        with open(manifest["input_file"]) as f:
+            custom_ids = [json.loads(line)["custom_id"] for line in f]
+        expected = [f"{job_key}:{index}" for job_key, document in manifest["documents"].items() for index in range(document["chunks"])]
+        self.assertEqual(sorted(custom_ids), sorted(expected))
+        self.assertEqual(sorted(document["file_name"] for document in manifest["documents"].values()), sorted(self.files))
+
+        results = self.application.collect_llm_batch(batch_id)
+        self.assertEqual(sorted(result["file_name"] for result in results), sorted(self.files))
+        for result in results:
+            self.assertEqual(result["status"], "succeeded")
+            with open(result["output_file"]) as f:
+                self.assertEqual(json.load(f), SYNTHETIC_CV_DETAILS)
+
+    def test_failed_and_missing_lines_fail_only_their_documents(self):
+        batch_id, manifest = self._submit()
+        job_keys = list(manifest["documents"])
+        self.stand_in.failed_batch_requests.add(f"{job_keys[0]}:0")
+        self.stand_in.missing_batch_requests.add(f"{job_keys[1]}:0")
+
+        results = {result["file_name"]: result for result in self.application.collect_llm_batch(batch_id)}
+        failed_file, missing_file, succeeded_file = (manifest["documents"][job_key]["file_name"] for job_key in job_keys)
+        self.assertEqual(results[failed_file]["status"], "failed")
+        self.assertEqual(results[missing_file]["status"], "failed")
+        self.assertEqual(results[succeeded_file]["status"], "succeeded")
+        self.assertTrue(os.path.exists(results[succeeded_file]["output_file"]))
+
+    def test_expired_batch_keeps_the_requests_that_ran(self):
+        batch_id, manifest = self._submit()
+        job_keys = list(manifest["documents"])
+        self.stand_in.batch_final_status = "expired"
+        self.stand_in.missing_batch_requests.add(f"{job_keys[0]}:0")
+
+        results = {result["file_name"]: result for result in self.application.collect_llm_batch(batch_id)}
+        self.assertEqual(results[manifest["documents"][job_keys[0]]["file_name"]]["status"], "failed")
+        for job_key in job_keys[1:]:
+            self.assertEqual(results[manifest["documents"][job_key]["file_name"]]["status"], "succeeded")
+
+
+if __name__ == "__main__":
+    unittest.main()
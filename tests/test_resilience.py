@@ -0,0 +1,150 @@
+"""
+Tests for the circuit breaker and deadlines of the shared resilience layer.
+
+Run from the repository root:
+    python -m unittest discover -s tests
+"""
+import time
+import asyncio
+import logging
+import unittest
+
+import httpx
+from openai import BadRequestError
+
+from classes.resilience import ResilienceManager, EndpointPolicy, DependencyUnavailableError
+from classes.langchain_llm import LangchainLLMManager
+
+LOGGER = logging.getLogger(__name__)
+
+
+#a manager whose circuits open after one failure and let a trial through at once
+def half_open_manager(endpoint):
+    resilience = ResilienceManager(default_policy=EndpointPolicy(max_attempts=1, initial_delay=0), failure_threshold=1, reset_seconds=0)
+    resilience.record_failure(endpoint, LOGGER)
+    return resilience
+
+
+class StubLLM:
+    def __init__(self, error=None, delay=0.0):
+        self.error = error
+        self.delay = delay
+
+    async def ainvoke(self, messages):
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return "answer"
+
+
+def llm_manager(resilience, llm):
+    manager = LangchainLLMManager.__new__(LangchainLLMManager)
+    manager.rate_limiter = None
+    manager.resilience = resilience
+    manager.semaphore = asyncio.Semaphore(1)
+    manager.llm = llm
+    return manager
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_cancelled_trial_releases_the_circuit(self):
+        resilience = half_open_manager("storage")
+
+        async def handler(request):
+            await asyncio.sleep(10)
+
+        async def cancel_trial():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+                task = asyncio.create_task(resilience.request(client, "storage", "GET", "http://stand-in", LOGGER))
+                await asyncio.sleep(0.05)
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+
+        asyncio.run(cancel_trial())
+        self.assertEqual(resilience.breaker("storage").state, "half_open")
+        self.assertTrue(resilience.breaker("storage").allow())
+
+    def test_unexpected_error_of_a_trial_counts_as_failure(self):
+        resilience = half_open_manager("storage")
+
+        def handler(request):
+            raise ValueError("unexpected")
+
+        async def send():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+                await resilience.request(client, "storage", "GET", "http://stand-in", LOGGER)
+
+        with self.assertRaises(ValueError):
+            asyncio.run(send())
+        self.assertEqual(resilience.breaker("storage").state, "open")
+
+    def test_request_that_is_not_the_trial_does_not_release_it(self):
+        resilience = half_open_manager("storage")
+        breaker, trial = resilience.check_circuit("storage")
+        self.assertTrue(trial)
+        with self.assertRaises(DependencyUnavailableError):
+            resilience.check_circuit("storage")
+
+    def test_llm_4xx_closes_the_circuit(self):
+        resilience = half_open_manager("llm")
+        response = httpx.Response(400, request=httpx.Request("POST", "http://stand-in"))
+        manager = llm_manager(resilience, StubLLM(BadRequestError("content filter", response=response, body=None)))
+
+        with self.assertRaises(BadRequestError):
+            asyncio.run(manager._ainvoke(["message"], 10, LOGGER))
+        self.assertEqual(resilience.breaker("llm").state, "closed")
+
+    def test_cancelled_llm_trial_releases_the_circuit(self):
+        resilience = half_open_manager("llm")
+        manager = llm_manager(resilience, StubLLM(delay=10))
+
+        async def cancel_trial():
+            task = asyncio.create_task(manager._ainvoke(["message"], 10, LOGGER))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(cancel_trial())
+        self.assertTrue(resilience.breaker("llm").allow())
+
+
+class DeadlineTest(unittest.TestCase):
+    def test_timeout_is_cut_to_the_deadline(self):
+        resilience = ResilienceManager(default_policy=EndpointPolicy(timeout=30.0, max_attempts=1))
+        timeouts = []
+
+        def handler(request):
+            timeouts.append(request.extensions["timeout"]["read"])
+            return httpx.Response(200)
+
+        async def send():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+                await resilience.request(client, "ocr_poll", "GET", "http://stand-in", LOGGER, deadline=time.monotonic() + 2.0)
+
+        asyncio.run(send())
+        self.assertLessEqual(timeouts[0], 2.0)
+
+    def test_retries_stop_at_the_deadline(self):
+        resilience = ResilienceManager(default_policy=EndpointPolicy(max_attempts=20, initial_delay=0.1, max_delay=0.1, jitter=0.0),
+                                       failure_threshold=100)
+        attempts = []
+
+        def handler(request):
+            attempts.append(request)
+            return httpx.Response(503)
+
+        async def send():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+                await resilience.request(client, "ocr_poll", "GET", "http://stand-in", LOGGER, deadline=time.monotonic() + 0.35)
+
+        start = time.monotonic()
+        with self.assertRaisesRegex(DependencyUnavailableError, "deadline"):
+            asyncio.run(send())
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertLessEqual(len(attempts), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()